@@ -1,10 +1,16 @@
+import glob
+import hashlib
 import json
 import os
 import queue
 import re
 import shutil
 import sys
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from itertools import repeat
 from pathlib import Path
 from threading import (
     Event,
@@ -13,18 +19,29 @@ from threading import (
 )
 from typing import (
     Callable,
+    Dict,
+    Iterator,
+    List,
     Optional,
     Sequence,
     Set,
     Tuple
 )
 
+import numpy as np
 import picollm
 import pvcheetah
 import pvorca
 from pvrecorder import PvRecorder
 from pvspeaker import PvSpeaker
 
+# the picoLLM device auto-tuner lives in the LLM voice assistant recipe
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'llm-voice-assistant', 'python', 'cli'))
+from autotune import tuned_device  # noqa: E402
+
+INDEX_VERSION = 1
+
 
 def print_async(get_text: Callable[[], str], refresh_sec: float = 0.1, end: str = '\n') -> Tuple[Event, Thread]:
     stop_event = Event()
@@ -96,18 +113,22 @@ def print_async(get_text: Callable[[], str], refresh_sec: float = 0.1, end: str
     return stop_event, thread
 
 
-def chunk_document(
+def normalize_document(text: str) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def chunk_spans(
         text: str,
         chunk_size: int = 1200,
         chunk_overlap: int = 250,
-) -> Sequence[str]:
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = re.sub(r"\n{3,}", "\n\n", text).strip()
+) -> Sequence[Tuple[int, int]]:
+    """Returns the start and end offsets of the chunks of a document that was already normalized."""
 
     if chunk_overlap >= (chunk_size // 2):
         raise ValueError(f"`chunk_overlap` must be smaller than {chunk_size // 2}.")
 
-    chunks = list()
+    spans = list()
     start = 0
 
     while start < len(text):
@@ -118,41 +139,354 @@ def chunk_document(
             if paragraph_break > start + int(chunk_size * 0.5):
                 end = paragraph_break
 
-        chunk = text[start:end].strip()
+        chunk = text[start:end]
+        stripped_chunk = chunk.strip()
 
-        if len(chunk) > 0:
-            chunks.append(chunk)
+        if len(stripped_chunk) > 0:
+            chunk_start = start + len(chunk) - len(chunk.lstrip())
+            spans.append((chunk_start, chunk_start + len(stripped_chunk)))
 
         if end >= len(text):
             break
 
         start = max(0, end - chunk_overlap)
 
-    return chunks
+    return spans
+
+
+def chunk_document(
+        text: str,
+        chunk_size: int = 1200,
+        chunk_overlap: int = 250,
+) -> Sequence[str]:
+    text = normalize_document(text)
+    return [text[start:end] for start, end in chunk_spans(text, chunk_size, chunk_overlap)]
+
+
+def chunk_hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def read_normalized(path: str, block_size: int = 1 << 20) -> Iterator[str]:
+    """
+    Reads a document in blocks and yields it normalized as `normalize_document` would. The whitespace at the end of a
+    block is held back until the next one, so runs of newlines are never split between blocks and the trailing
+    whitespace of the document is dropped.
+    """
+
+    held = ""
+    started = False
+
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+
+            text = held + block
+            stripped = text.rstrip()
+            held = text[len(stripped):]
+
+            if not started:
+                stripped = stripped.lstrip()
+                started = len(stripped) > 0
+
+            if len(stripped) > 0:
+                yield re.sub(r"\n{3,}", "\n\n", stripped.replace("\r\n", "\n").replace("\r", "\n"))
+
+
+def stream_chunks(
+        path: str,
+        chunk_size: int = 1200,
+        chunk_overlap: int = 250,
+        block_size: int = 1 << 20,
+) -> Iterator[Tuple[int, int, str]]:
+    """
+    Yields the start offset, end offset, and text of the chunks of a document, the same as `chunk_spans` on the whole
+    normalized document, while only holding a few blocks of it in memory.
+    """
+
+    if chunk_overlap >= (chunk_size // 2):
+        raise ValueError(f"`chunk_overlap` must be smaller than {chunk_size // 2}.")
+
+    blocks = read_normalized(path, block_size)
+    buffer = ""
+    base = 0
+    start = 0
+    done = False
+
+    while True:
+        # a chunk can only be cut once it is known whether the document continues past it
+        while not done and base + len(buffer) <= start + chunk_size:
+            block = next(blocks, None)
+            if block is None:
+                done = True
+            else:
+                # the text before the current chunk is only dropped here, so it is copied once per block
+                buffer = buffer[start - base:] + block
+                base = start
+
+        if start >= base + len(buffer):
+            break
+
+        length = base + len(buffer)
+        end = min(start + chunk_size, length)
+
+        if end < length:
+            paragraph_break = buffer.rfind("\n\n", start - base, end - base)
+            if paragraph_break + base > start + int(chunk_size * 0.5):
+                end = paragraph_break + base
+
+        chunk = buffer[start - base:end - base]
+        stripped_chunk = chunk.strip()
+
+        if len(stripped_chunk) > 0:
+            chunk_start = start + len(chunk) - len(chunk.lstrip())
+            yield chunk_start, chunk_start + len(stripped_chunk), stripped_chunk
+
+        if end >= length:
+            break
+
+        start = max(0, end - chunk_overlap)
+
+
+def find_documents(paths: Sequence[str], pattern: str = "*.txt") -> List[str]:
+    """Expands directories (to their files that match `pattern`, recursively) and globs into a list of documents."""
+
+    documents = list()
+    for path in paths:
+        if os.path.isdir(path):
+            documents.extend(str(x) for x in sorted(Path(path).rglob(pattern)) if x.is_file())
+        elif glob.has_magic(path):
+            documents.extend(x for x in sorted(glob.glob(path, recursive=True)) if os.path.isfile(x))
+        else:
+            documents.append(path)
+
+    return list(dict.fromkeys(documents))
+
+
+def chunk_file(path: str, chunk_size: int, chunk_overlap: int) -> Tuple[List[Tuple[int, int]], List[str], int]:
+    spans = list()
+    chunks = list()
+    for start, end, chunk in stream_chunks(path, chunk_size, chunk_overlap):
+        spans.append((start, end))
+        chunks.append(chunk)
+
+    return spans, chunks, os.path.getsize(path)
+
+
+def ingest_documents(
+        paths: Sequence[str],
+        chunk_size: int,
+        chunk_overlap: int,
+        num_workers: int = 1,
+) -> Tuple[List[str], List[Tuple[int, int]], List[int]]:
+    """
+    Chunks the documents in a process pool, one document per task, and returns the chunks of all of them in order with
+    the offsets of each chunk in its normalized document and the index of the document it comes from.
+    """
+
+    chunks = list()
+    spans = list()
+    sources = list()
+    num_bytes = 0
+
+    start_sec = time.perf_counter()
+    if num_workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(paths))) as executor:
+            results = list(executor.map(chunk_file, paths, repeat(chunk_size), repeat(chunk_overlap)))
+    else:
+        results = [chunk_file(x, chunk_size, chunk_overlap) for x in paths]
+    elapsed_sec = max(time.perf_counter() - start_sec, 1e-9)
+
+    for i, (document_spans, document_chunks, document_bytes) in enumerate(results):
+        chunks.extend(document_chunks)
+        spans.extend(document_spans)
+        sources.extend([i] * len(document_chunks))
+        num_bytes += document_bytes
 
+    print(
+        f"[OK] Broke {len(paths)} document{'s' if len(paths) != 1 else ''} ({num_bytes / 1e6:.2f} MB) into "
+        f"{len(chunks)} chunks in {elapsed_sec:.2f} s ({num_bytes / 1e6 / elapsed_sec:.2f} MB/s, "
+        f"{len(chunks) / elapsed_sec:.0f} chunks/s)")
 
-def as_vector(x: object) -> Sequence[float]:
+    return chunks, spans, sources
+
+
+def as_vector(x: object) -> np.ndarray:
     if hasattr(x, "embedding"):
         x = getattr(x, "embedding")
-    return [float(y) for y in x]
+    return np.asarray(x, dtype=np.float32)
 
 
-def normalize_vector(vector: Sequence[float]) -> Sequence[float]:
-    norm = sum(x * x for x in vector) ** 0.5
+def normalize_vector(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
     if norm == 0:
         raise ValueError("Cannot normalize zero vector.")
 
-    return [x / norm for x in vector]
+    return vector / norm
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Returns the indices of the `top_k` highest scores, highest first, without sorting all of them."""
+
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    indices = np.argpartition(scores, len(scores) - top_k)[len(scores) - top_k:]
+    return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for approximate retrieval. The embeddings are clustered around k-means centroids, and a question
+    is only scored against the chunks of the `nprobe` lists whose centroids are closest to it.
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, indices: np.ndarray) -> None:
+        self.centroids = centroids
+        self.offsets = offsets
+        self.indices = indices
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def _assign(embeddings: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+        labels = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            labels[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+        return labels
+
+    @classmethod
+    def build(
+            cls,
+            embeddings: np.ndarray,
+            num_lists: int,
+            num_iterations: int = 10,
+            samples_per_list: int = 64,
+            seed: int = 0,
+    ) -> 'IVFIndex':
+        num_lists = max(1, min(num_lists, len(embeddings)))
+        rng = np.random.default_rng(seed)
+
+        # the centroids are trained on a sample, which is as good as all the rows for a few dozen rows per list
+        sample_size = min(len(embeddings), num_lists * samples_per_list)
+        sample = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))], np.float32)
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+
+        for _ in range(num_iterations):
+            labels = cls._assign(sample, centroids)
+            counts = np.bincount(labels, minlength=num_lists)
+            non_empty = counts > 0
+
+            sums = np.zeros_like(centroids)
+            starts = (np.cumsum(counts) - counts)[non_empty]
+            sums[non_empty] = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts, axis=0)
+            sums[~non_empty] = sample[rng.choice(len(sample), int(np.sum(~non_empty)))]
+
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        labels = cls._assign(embeddings, centroids)
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=num_lists))
+
+        return cls(
+            centroids=centroids.astype(np.float32),
+            offsets=offsets,
+            indices=np.argsort(labels, kind="stable").astype(np.int64))
+
+    def search(
+            self,
+            embeddings: np.ndarray,
+            query: np.ndarray,
+            top_k: int,
+            nprobe: int,
+            mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices and scores of the `top_k` best chunks in the lists of the `nprobe` closest centroids. If
+        `mask` is given, only the chunks it is `True` for are considered.
+        """
+
+        lists = top_k_indices(self.centroids @ query.astype(np.float32, copy=False), nprobe)
+        # sorted rows are read from a memory-mapped matrix in order
+        candidates = np.sort(np.concatenate([self.indices[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+
+        scores = embeddings[candidates] @ query.astype(embeddings.dtype, copy=False)
+        best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, offsets=self.offsets, indices=self.indices)
+
+    @classmethod
+    def load(cls, path: str, num_embeddings: int) -> 'IVFIndex':
+        with np.load(path) as data:
+            index = cls(centroids=data["centroids"], offsets=data["offsets"], indices=data["indices"])
+
+        if index.offsets[-1] != num_embeddings or len(index.indices) != num_embeddings:
+            raise ValueError(f"IVF index covers {len(index.indices)} chunks, but there are {num_embeddings} chunks.")
+
+        return index
+
+
+def evaluate_ivf_index(
+        embeddings: np.ndarray,
+        index: IVFIndex,
+        top_k: int,
+        num_queries: int = 100,
+        seed: int = 0,
+) -> Dict[str, object]:
+    """
+    Measures the recall@k and the latency of the index against exact search for doubling values of `nprobe`, until the
+    recall is perfect. The queries are the midpoints of random pairs of chunks, which, like questions, are close to but
+    not on the chunks.
+    """
+
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, len(embeddings), size=(num_queries, 2))
+    queries = np.asarray(embeddings[pairs[:, 0]], np.float32) + np.asarray(embeddings[pairs[:, 1]], np.float32)
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    start_sec = time.perf_counter()
+    exact = [set(top_k_indices(embeddings @ x.astype(embeddings.dtype), top_k).tolist()) for x in queries]
+    exact_ms = (time.perf_counter() - start_sec) * 1e3 / num_queries
+
+    report = list()
+    nprobe = 1
+    while True:
+        nprobe = min(nprobe, index.num_lists)
+        start_sec = time.perf_counter()
+        found = [index.search(embeddings, x, top_k, nprobe)[0] for x in queries]
+        latency_ms = (time.perf_counter() - start_sec) * 1e3 / num_queries
+        recall = sum(len(expected.intersection(x.tolist())) for expected, x in zip(exact, found))
+        recall /= max(1, sum(len(x) for x in exact))
+        report.append({"nprobe": nprobe, "recall": round(recall, 4), "latency_ms": round(latency_ms, 4)})
+
+        if nprobe == index.num_lists or recall == 1:
+            break
+        nprobe *= 2
+
+    return {"top_k": top_k, "exact_latency_ms": round(exact_ms, 4), "nprobe": report}
 
 
-def dot_product(a: Sequence[float], b: Sequence[float]) -> float:
-    return sum(x * y for x, y in zip(a, b))
+def print_ivf_report(report: Dict[str, object]) -> None:
+    print(f"[OK] IVF recall@{report['top_k']} against exact search ({report['exact_latency_ms']:.3f} ms/question)")
+    for x in report["nprobe"]:
+        print(f"    nprobe {x['nprobe']:>4}: recall {x['recall']:.3f}, {x['latency_ms']:.3f} ms/question")
 
 
 def generate_embeddings(
         embedding_llm: picollm.PicoLLM,
         chunks: Sequence[str],
-) -> Sequence[Sequence[float]]:
+) -> np.ndarray:
     status = f"Generating embeddings 0/{len(chunks)}"
     status_lock = Lock()
 
@@ -176,86 +510,161 @@ def generate_embeddings(
         status_event.set()
         status_thread.join()
 
-    return embeddings
+    if len(embeddings) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(embeddings)
 
 
 def save_embeddings(
         path: str,
-        document_path: str,
+        document_paths: Sequence[str],
+        model_id: str,
         chunk_size: int,
         chunk_overlap: int,
         chunks: Sequence[str],
-        embeddings: Sequence[Sequence[float]],
+        spans: Sequence[Tuple[int, int]],
+        sources: Sequence[int],
+        embeddings: np.ndarray,
+        dtype: str = "float32",
+        index: Optional[IVFIndex] = None,
+        index_report: Optional[Dict[str, object]] = None,
 ) -> None:
+    """
+    Saves the embeddings as a binary index: a `.npy` matrix with one normalized embedding per row, next to a JSON
+    manifest at `path` that holds the document, offsets, and SHA-256 of every chunk, the chunking parameters, and the
+    model. An IVF index is saved next to the matrix (`.ivf.npz`).
+    """
+
     output_path = Path(path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
+    matrix_path = Path(f"{output_path}.npy")
+
+    matrix = np.asarray(embeddings, dtype=dtype)
+    # the previous matrix may still be memory-mapped (e.g., when an index is updated in place), so it is replaced
+    # instead of being overwritten
+    temp_path = Path(f"{matrix_path}.{os.getpid()}.tmp")
+    with open(temp_path, "wb") as f:
+        np.save(f, matrix)
+    os.replace(temp_path, matrix_path)
+
+    manifest = {
+        "version": INDEX_VERSION,
+        "documents": list(document_paths),
+        "model": model_id,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "matrix_path": matrix_path.name,
+        "dtype": matrix.dtype.name,
+        "shape": list(matrix.shape),
+        "spans": [list(x) for x in spans],
+        "sources": list(sources),
+        "hashes": [chunk_hash(x) for x in chunks],
+    }
+
+    if index is not None:
+        index_path = Path(f"{output_path}.ivf.npz")
+        index.save(str(index_path))
+        manifest["ivf"] = {
+            "path": index_path.name,
+            "num_lists": index.num_lists,
+            "report": index_report,
+        }
 
-    output_path.write_text(
-        json.dumps(
-            {
-                "document_path": document_path,
-                "chunk_size": chunk_size,
-                "chunk_overlap": chunk_overlap,
-                "chunks": list(chunks),
-                "embeddings": [list(x) for x in embeddings],
-            },
-            ensure_ascii=False,
-        ),
-        encoding="utf-8")
+    output_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
 
     print(f"[OK] Saved embeddings to `{output_path}`")
 
 
 def load_embeddings(
         path: str,
+        embedding_llm: picollm.PicoLLM,
         chunks: Sequence[str],
-) -> Sequence[Sequence[float]]:
-    input_path = Path(path)
-    data = json.loads(input_path.read_text(encoding="utf-8"))
+) -> Tuple[np.ndarray, Optional[IVFIndex], int]:
+    """
+    Loads an index saved by `save_embeddings` for the current chunks. Saved embeddings are looked up by the embedding
+    model and the SHA-256 of each chunk, so after the document is edited only the new or changed chunks are embedded
+    again. If every chunk matches, the matrix is opened with `mmap`, so it is paged in as it is used instead of being
+    read up front. Returns the embeddings, the IVF index if one was saved with them, and the number of chunks embedded.
+    """
 
-    loaded_chunks = data.get("chunks")
-    embeddings = data.get("embeddings")
+    input_path = Path(path)
+    manifest = json.loads(input_path.read_text(encoding="utf-8"))
 
-    if not isinstance(loaded_chunks, list):
-        raise ValueError("Invalid embeddings file: missing `chunks` list.")
+    if "embeddings" in manifest:
+        raise ValueError(
+            "Embeddings file is in the old JSON format. Generate the embeddings again with `--save_embeddings_path`.")
 
-    if not isinstance(embeddings, list):
-        raise ValueError("Invalid embeddings file: missing `embeddings` list.")
+    if manifest.get("version") != INDEX_VERSION:
+        raise ValueError(f"Embeddings file has version {manifest.get('version')}, but {INDEX_VERSION} is expected.")
 
-    if len(loaded_chunks) != len(chunks):
+    saved = np.load(input_path.parent / manifest["matrix_path"], mmap_mode="r")
+    if list(saved.shape) != manifest["shape"]:
         raise ValueError(
-            f"Embeddings file has {len(loaded_chunks)} chunks, but the current document produced {len(chunks)} chunks.")
+            f"Embeddings matrix has shape {list(saved.shape)}, but the manifest expects {manifest['shape']}.")
 
-    for i, (loaded_chunk, current_chunk) in enumerate(zip(loaded_chunks, chunks)):
-        if loaded_chunk != current_chunk:
-            raise ValueError(
-                f"Embeddings file does not match the current document. Chunk {i} is different.")
+    hashes = [chunk_hash(x) for x in chunks]
+    if manifest["model"] == embedding_llm.model and manifest["hashes"] == hashes:
+        index = None
+        if "ivf" in manifest:
+            index = IVFIndex.load(str(input_path.parent / manifest["ivf"]["path"]), num_embeddings=len(saved))
 
-    normalized_embeddings = [
-        normalize_vector(as_vector(x))
-        for x in embeddings
-    ]
+        print(f"[OK] Loaded embeddings from `{input_path}`")
+        return saved, index, 0
 
-    print(f"[OK] Loaded embeddings from `{input_path}`")
-    return normalized_embeddings
+    # embeddings of another model are never reused, even for the same chunks
+    rows = dict()
+    if manifest["model"] == embedding_llm.model:
+        rows = {x: i for i, x in reversed(list(enumerate(manifest["hashes"])))}
+
+    reused = [i for i, x in enumerate(hashes) if x in rows]
+    missing = [i for i, x in enumerate(hashes) if x not in rows]
+
+    generated = generate_embeddings(embedding_llm=embedding_llm, chunks=[chunks[i] for i in missing])
+    dimension = saved.shape[1] if len(reused) > 0 else generated.shape[1]
+    if len(missing) > 0 and len(reused) > 0 and generated.shape[1] != dimension:
+        raise ValueError(f"Saved embeddings have {dimension} dimensions, but the model produced {generated.shape[1]}.")
+
+    embeddings = np.empty((len(chunks), dimension), dtype=np.float32)
+    if len(reused) > 0:
+        embeddings[reused] = saved[[rows[hashes[i]] for i in reused]]
+    if len(missing) > 0:
+        embeddings[missing] = generated
+
+    index = None
+    if "ivf" in manifest and len(chunks) > 0:
+        # the lists of the saved index refer to the rows of the previous document
+        index = IVFIndex.build(embeddings=embeddings, num_lists=manifest["ivf"]["num_lists"])
+        print(f"[OK] Rebuilt IVF index with {index.num_lists} lists")
+
+    print(f"[OK] Updated embeddings from `{input_path}`: reused {len(reused)}, recomputed {len(missing)}")
+    return embeddings, index, len(missing)
 
 
 def retrieve_chunks(
         question: str,
         embedding_llm: picollm.PicoLLM,
         chunks: Sequence[str],
-        embeddings: Sequence[Sequence[float]],
+        embeddings: np.ndarray,
         top_k: int,
+        index: Optional[IVFIndex] = None,
+        nprobe: int = 8,
+        mask: Optional[np.ndarray] = None,
 ) -> Sequence[Tuple[float, str]]:
     question_embedding = normalize_vector(as_vector(embedding_llm.generate_embeddings(question)))
 
-    scored = [
-        (dot_product(question_embedding, embedding), chunk)
-        for embedding, chunk in zip(embeddings, chunks)
-    ]
+    if index is not None:
+        indices, scores = index.search(embeddings, question_embedding, top_k, nprobe, mask)
+        return [(float(x), chunks[i]) for i, x in zip(indices, scores)]
+
+    if mask is not None:
+        rows = np.flatnonzero(mask)
+        scores = embeddings[rows] @ question_embedding.astype(embeddings.dtype, copy=False)
+        return [(float(scores[i]), chunks[rows[i]]) for i in top_k_indices(scores, top_k)]
+
+    # the rows are normalized, so one matrix-vector product gives the cosine similarity of every chunk
+    scores = embeddings @ question_embedding.astype(embeddings.dtype, copy=False)
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return scored[:top_k]
+    return [(float(scores[i]), chunks[i]) for i in top_k_indices(scores, top_k)]
 
 
 def build_prompt(
@@ -471,8 +880,23 @@ def main() -> None:
         help='Absolute path to the picoLLM chat model file (`.pllm`).')
     parser.add_argument(
         '--document_path',
-        default=os.path.join(os.path.dirname(__file__), '..', 'res', 'CPAL-1.0.txt'),
-        help="Absolute or relative path to the document to index.")
+        nargs='+',
+        default=[os.path.join(os.path.dirname(__file__), '..', 'res', 'CPAL-1.0.txt')],
+        help="Absolute or relative paths to the documents to index. Directories and glob patterns (e.g., "
+             "`docs/**/*.txt`) are expanded, and all the documents go into a single index.")
+    parser.add_argument(
+        '--document_pattern',
+        default='*.txt',
+        help="Pattern of the files to index in the directories given to `--document_path`.")
+    parser.add_argument(
+        '--num_ingest_workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes that chunk the documents in parallel.")
+    parser.add_argument(
+        '--source_filter',
+        nargs='+',
+        help="Only retrieve chunks of the documents whose paths match one of these patterns (e.g., `*/policies/*`).")
     parser.add_argument(
         '--cheetah_model_path',
         help="Absolute path to the Cheetah model file.")
@@ -488,7 +912,10 @@ def main() -> None:
              "most suitable device. If set to `gpu`, picoLLM uses the first available GPU. To select a specific GPU, "
              "set this argument to `gpu:${GPU_INDEX}`, where `${GPU_INDEX}` is the index of the target GPU. If set to "
              "`cpu`, picoLLM runs on the CPU with the default number of threads. To specify the number of threads, set "
-             "this argument to `cpu:${NUM_THREADS}`, where `${NUM_THREADS}` is the desired number of threads.")
+             "this argument to `cpu:${NUM_THREADS}`, where `${NUM_THREADS}` is the desired number of threads. If set "
+             "to `best` after `autotune.py` was run for the model, the fastest device it found is used. If set to "
+             "`tuned`, the model is tuned on the first launch instead (which can take minutes) and the fastest device "
+             "is used from then on.")
     parser.add_argument(
         "--top_k",
         type=int,
@@ -511,10 +938,28 @@ def main() -> None:
         help="Number of overlapping characters between adjacent chunks.")
     parser.add_argument(
         "--save_embeddings_path",
-        help="Path to save generated document embeddings as JSON.")
+        help="Path to save generated document embeddings to. The path holds a JSON manifest and the embeddings are "
+             "written to a binary matrix next to it (`${PATH}.npy`).")
     parser.add_argument(
         "--load_embeddings_path",
-        help="Path to load document embeddings from JSON instead of regenerating them.")
+        help="Path to load document embeddings from instead of regenerating them. Only the chunks that are not in the "
+             "saved embeddings are embedded.")
+    parser.add_argument(
+        "--embeddings_dtype",
+        choices=["float32", "float16"],
+        default="float32",
+        help="Precision of the saved embeddings. `float16` halves the size of the index.")
+    parser.add_argument(
+        "--ivf_num_lists",
+        type=int,
+        default=0,
+        help="Number of lists of an approximate (IVF) index to build over the embeddings. A few times the square root "
+             "of the number of chunks works well. If set to `0`, every chunk is scored for every question.")
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=8,
+        help="Number of IVF lists to search for each question. Higher values trade speed for recall.")
     parser.add_argument(
         '--audio_device_index',
         type=int,
@@ -539,10 +984,23 @@ def main() -> None:
         print('--access_key, --picollm_embedding_model_path and --picollm_chat_model_path are required arguments')
         return
 
-    document_path = args.document_path
+    document_paths = find_documents(args.document_path, args.document_pattern)
+    if len(document_paths) == 0:
+        print(f"No documents found in {', '.join(args.document_path)}")
+        return
     cheetah_model_path = args.cheetah_model_path
     endpoint_duration_sec = args.endpoint_duration_sec
     picollm_device = args.picollm_device
+    embedding_device = picollm_device
+    chat_device = picollm_device
+    if picollm_device in ('best', 'tuned'):
+        # tuning only runs when asked for, as it loads each model once per candidate device
+        tuning_access_key = access_key if picollm_device == 'tuned' else None
+        embedding_device = tuned_device(
+            picollm_embedding_model_path,
+            access_key=tuning_access_key,
+            workload='embed') or 'best'
+        chat_device = tuned_device(picollm_chat_model_path, access_key=tuning_access_key) or 'best'
     top_k = args.top_k
     completion_token_limit = args.completion_token_limit
     chunk_size = args.chunk_size
@@ -561,7 +1019,7 @@ def main() -> None:
         embedding_llm = picollm.create(
             access_key=access_key,
             model_path=picollm_embedding_model_path,
-            device=picollm_device)
+            device=embedding_device)
         print(
             f"[OK] picoLLM Inference [V{embedding_llm.version}] "
             f"[{os.path.basename(picollm_embedding_model_path).replace('.pllm', '')}]")
@@ -577,7 +1035,7 @@ def main() -> None:
         chat_llm = picollm.create(
             access_key=access_key,
             model_path=picollm_chat_model_path,
-            device=picollm_device)
+            device=chat_device)
         print(
             f"[OK] picoLLM Inference [V{chat_llm.version}] "
             f"[{os.path.basename(picollm_chat_model_path).replace('.pllm', '')}]")
@@ -592,32 +1050,57 @@ def main() -> None:
         speaker = PvSpeaker(sample_rate=orca.sample_rate, bits_per_sample=16)
         speaker.start()
 
-        with open(document_path, 'r', encoding='utf-8') as f:
-            chunks = chunk_document(
-                text=f.read(),
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap)
+        chunks, spans, sources = ingest_documents(
+            paths=document_paths,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            num_workers=args.num_ingest_workers)
+
+        mask = None
+        if args.source_filter is not None:
+            selected = [any(fnmatch(x, pattern) for pattern in args.source_filter) for x in document_paths]
+            mask = np.array([selected[x] for x in sources], dtype=bool)
+            print(f"[OK] Retrieving from {sum(selected)} of {len(document_paths)} documents ({int(mask.sum())} chunks)")
 
-        print(f"[OK] Broke `{os.path.basename(document_path)}` into {len(chunks)} chunks")
+        index = None
+        index_built = False
+        index_report = None
 
         if load_embeddings_path is not None:
-            embeddings = load_embeddings(
+            embeddings, index, num_generated = load_embeddings(
                 path=load_embeddings_path,
+                embedding_llm=embedding_llm,
                 chunks=chunks)
         else:
             embeddings = generate_embeddings(
                 embedding_llm=embedding_llm,
                 chunks=chunks)
+            num_generated = len(chunks)
             print("[OK] Generated embeddings")
 
-            if save_embeddings_path is not None:
-                save_embeddings(
-                    path=save_embeddings_path,
-                    document_path=document_path,
-                    chunk_size=chunk_size,
-                    chunk_overlap=chunk_overlap,
-                    chunks=chunks,
-                    embeddings=embeddings)
+        if index is None and args.ivf_num_lists > 0 and len(chunks) > 0:
+            index = IVFIndex.build(embeddings=embeddings, num_lists=args.ivf_num_lists)
+            print(f"[OK] Built IVF index with {index.num_lists} lists")
+            index_built = True
+
+        if index is not None and (index_built or num_generated > 0 or save_embeddings_path is not None):
+            index_report = evaluate_ivf_index(embeddings=embeddings, index=index, top_k=top_k)
+            print_ivf_report(index_report)
+
+        if save_embeddings_path is not None:
+            save_embeddings(
+                path=save_embeddings_path,
+                document_paths=document_paths,
+                model_id=embedding_llm.model,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                chunks=chunks,
+                spans=spans,
+                sources=sources,
+                embeddings=embeddings,
+                dtype=args.embeddings_dtype,
+                index=index,
+                index_report=index_report)
 
         print()
 
@@ -658,7 +1141,10 @@ def main() -> None:
                 embedding_llm=embedding_llm,
                 chunks=chunks,
                 embeddings=embeddings,
-                top_k=top_k)
+                top_k=top_k,
+                index=index,
+                nprobe=args.nprobe,
+                mask=mask)
 
             prompt = build_prompt(
                 chat_llm=chat_llm,
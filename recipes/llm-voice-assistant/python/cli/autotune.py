@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import platform
+import re
+import sys
+import time
+from argparse import ArgumentParser
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+import picollm
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'pico-cookbook', 'picollm_autotune.json')
+
+PROMPT = (
+    "Summarize the following paragraph in one sentence. "
+    "A voice assistant listens for a wake word, transcribes the request of the user as it is spoken, and sends the "
+    "transcript to a large language model. The answer of the model is streamed to a speech synthesizer sentence by "
+    "sentence, so that the assistant starts talking before the whole answer is generated. All of this runs on the "
+    "device, which keeps the audio private and the latency low, but also means that the model has to share a few CPU "
+    "cores with speech recognition and synthesis. Choosing how many threads the model uses is therefore a trade-off "
+    "between the speed of the model and the responsiveness of everything else.")
+
+
+def cpu_model() -> str:
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r', encoding='utf-8') as fd:
+            for line in fd:
+                if line.startswith('model name') or line.startswith('Model'):
+                    return line.split(':', 1)[1].strip()
+    return platform.processor() or platform.machine()
+
+
+def num_cpus() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def load_cache(cache_path: str) -> Dict[str, Any]:
+    cache = {'models': dict(), 'devices': dict()}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as fd:
+            cache.update(json.load(fd))
+    return cache
+
+
+def save_cache(cache_path: str, cache: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as fd:
+        json.dump(cache, fd, indent=2)
+
+
+def model_hash(model_path: str, cache: Dict[str, Any]) -> str:
+    model_path = os.path.realpath(model_path)
+    stat = os.stat(model_path)
+
+    entry = cache['models'].get(model_path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(model_path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            sha256.update(block)
+
+    cache['models'][model_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+    return sha256.hexdigest()
+
+
+def device_key(model_path: str, workload: str, cache: Dict[str, Any]) -> str:
+    """The same model can be tuned as a chat model and as an embedding model, so each workload has its own entry."""
+
+    return f'{model_hash(model_path, cache)}:{workload}'
+
+
+def tuned_device(
+        model_path: str,
+        access_key: Optional[str] = None,
+        workload: str = 'generate',
+        cache_path: str = DEFAULT_CACHE_PATH) -> Optional[str]:
+    """
+    Returns the fastest device found by `autotune.py` for the model and workload on this CPU. If it was not tuned yet
+    and an `access_key` is given, the model is tuned now, once, and the result is saved for later launches. Otherwise,
+    returns `None`. Recipes pass the `access_key` only when started with `--picollm_device tuned`, as tuning loads the
+    model once per candidate device and can take minutes.
+    """
+
+    try:
+        cache = load_cache(cache_path)
+        num_models = len(cache['models'])
+        entry = cache['devices'].get(cpu_model(), dict()).get(device_key(model_path, workload, cache))
+        if len(cache['models']) != num_models:
+            save_cache(cache_path, cache)
+    except (OSError, ValueError, KeyError) as e:
+        sys.stderr.write(f'Ignoring the auto-tuned picoLLM device: {e}\n')
+        return None
+
+    if entry is not None:
+        return entry['device']
+    if access_key is None:
+        return None
+
+    print('No picoLLM device was tuned for this model yet. Tuning it once, which may take minutes ...', flush=True)
+    try:
+        return autotune(access_key, model_path, workload=workload, num_runs=1, cache_path=cache_path)
+    except (OSError, ValueError, picollm.PicoLLMError) as e:
+        sys.stderr.write(f'Failed to tune the picoLLM device: {e}\n')
+        return None
+
+
+def candidate_devices(library_path: Optional[str] = None) -> List[str]:
+    max_threads = num_cpus()
+    devices = list()
+    for description in picollm.available_devices(library_path=library_path):
+        device = description.split(' ')[0]
+        if device.startswith('gpu'):
+            devices.append(device)
+        elif device.startswith('cpu'):
+            match = re.search(r'\((\d+) threads\)', description)
+            if match is not None:
+                max_threads = min(max_threads, int(match.group(1)))
+
+    num_threads = 1
+    while num_threads < max_threads:
+        devices.append(f'cpu:{num_threads}')
+        num_threads *= 2
+    devices.append(f'cpu:{max_threads}')
+
+    return devices
+
+
+def benchmark(
+        pllm: picollm.PicoLLM,
+        completion_token_limit: int,
+        num_runs: int) -> Dict[str, float]:
+    dialog = pllm.get_dialog()
+    dialog.add_human_request(PROMPT)
+    prompt = dialog.prompt()
+
+    result = None
+    for i in range(num_runs + 1):
+        first_token_sec = [0.]
+
+        def stream_callback(_: str) -> None:
+            if first_token_sec[0] == 0.:
+                first_token_sec[0] = time.perf_counter()
+
+        start_sec = time.perf_counter()
+        res = pllm.generate(
+            prompt=prompt,
+            completion_token_limit=completion_token_limit,
+            seed=0,
+            stream_callback=stream_callback)
+        end_sec = time.perf_counter()
+
+        # The first run only warms up the caches.
+        if i == 0 or first_token_sec[0] == 0.:
+            continue
+
+        run = {
+            'prefill_tps': res.usage.prompt_tokens / (first_token_sec[0] - start_sec),
+            'generate_tps': (res.usage.completion_tokens - 1) / max(end_sec - first_token_sec[0], 1e-6),
+            'total_sec': end_sec - start_sec,
+        }
+        if result is None or run['total_sec'] < result['total_sec']:
+            result = run
+
+    return result
+
+
+def benchmark_embeddings(pllm: picollm.PicoLLM, num_runs: int) -> Dict[str, float]:
+    texts = [x.strip() + '.' for x in PROMPT.split('.') if len(x.strip()) > 0]
+    num_tokens = sum(len(pllm.tokenize(x, bos=True, eos=False)) for x in texts)
+
+    result = None
+    for i in range(num_runs + 1):
+        start_sec = time.perf_counter()
+        for text in texts:
+            pllm.generate_embeddings(text)
+        end_sec = time.perf_counter()
+
+        # The first run only warms up the caches.
+        if i == 0:
+            continue
+
+        run = {
+            'embed_tps': num_tokens / max(end_sec - start_sec, 1e-6),
+            'total_sec': end_sec - start_sec,
+        }
+        if result is None or run['total_sec'] < result['total_sec']:
+            result = run
+
+    return result
+
+
+def autotune(
+        access_key: str,
+        model_path: str,
+        workload: str = 'generate',
+        devices: Optional[Sequence[str]] = None,
+        completion_token_limit: int = 32,
+        num_runs: int = 3,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        log: Callable[[str], None] = print) -> Optional[str]:
+    """
+    Benchmarks the model on each device, saves the fastest one for the model and this CPU, and returns it. Chat models
+    are timed on a prompt and a short completion (`generate`), and embedding models on embedding sentences (`embed`).
+    """
+
+    if devices is None:
+        devices = candidate_devices()
+
+    cache = load_cache(cache_path)
+    key = device_key(model_path, workload, cache)
+    log(f"Tuning `{os.path.basename(model_path)}` ({key[:12]}) for `{workload}` on {cpu_model()}")
+
+    results = dict()
+    for device in devices:
+        try:
+            pllm = picollm.create(
+                access_key=access_key,
+                model_path=model_path,
+                device=device)
+        except picollm.PicoLLMError as e:
+            log(f"{device:<10} failed: {e}")
+            continue
+
+        try:
+            if workload == 'embed':
+                result = benchmark_embeddings(pllm, num_runs)
+            else:
+                result = benchmark(pllm, completion_token_limit, num_runs)
+        finally:
+            pllm.release()
+
+        if result is None:
+            log(f"{device:<10} generated no tokens")
+            continue
+
+        results[device] = result
+        if workload == 'embed':
+            log(f"{device:<10} embed {result['embed_tps']:7.1f} tokens/s, total {result['total_sec']:.2f}s")
+        else:
+            log(
+                f"{device:<10} prefill {result['prefill_tps']:7.1f} tokens/s, generate {result['generate_tps']:6.1f} "
+                f"tokens/s, total {result['total_sec']:.2f}s")
+
+    if len(results) == 0:
+        log('No device could run the model')
+        return None
+
+    best = min(results, key=lambda x: results[x]['total_sec'])
+    cache['devices'].setdefault(cpu_model(), dict())[key] = {
+        'device': best,
+        'workload': workload,
+        'model_path': os.path.realpath(model_path),
+        'completion_token_limit': completion_token_limit,
+        'results': results,
+    }
+    save_cache(cache_path, cache)
+    log(f"Saved `{best}` to `{cache_path}`")
+    return best
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description='Finds the fastest picoLLM device for a model on this machine. Recipes started with '
+                    '`--picollm_device best` (the default) or `--picollm_device tuned` use it from then on.')
+    parser.add_argument(
+        '--access_key',
+        required=True,
+        help='`AccessKey` obtained from `Picovoice Console` (https://console.picovoice.ai/).')
+    parser.add_argument(
+        '--picollm_model_path',
+        required=True,
+        help='Absolute path to the file containing LLM parameters (`.pllm`).')
+    parser.add_argument(
+        '--workload',
+        choices=['generate', 'embed'],
+        default='generate',
+        help='What the model is used for: `generate` for chat models and `embed` for embedding models.')
+    parser.add_argument(
+        '--devices',
+        nargs='+',
+        help='Devices to try (e.g., `cpu:2 cpu:4 gpu:0`). By default, every available GPU and powers of two of the '
+             'number of CPU threads.')
+    parser.add_argument(
+        '--completion_token_limit',
+        type=int,
+        default=32,
+        help='Number of tokens to generate in each run.')
+    parser.add_argument(
+        '--num_runs',
+        type=int,
+        default=3,
+        help='Number of measured runs per device. The fastest one is kept.')
+    parser.add_argument(
+        '--cache_path',
+        default=DEFAULT_CACHE_PATH,
+        help='Path of the file that keeps the fastest device per model and CPU.')
+    args = parser.parse_args()
+
+    best = autotune(
+        access_key=args.access_key,
+        model_path=args.picollm_model_path,
+        workload=args.workload,
+        devices=args.devices,
+        completion_token_limit=args.completion_token_limit,
+        num_runs=args.num_runs,
+        cache_path=args.cache_path)
+    if best is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import random
+import time
+from argparse import ArgumentParser
+from typing import Sequence, Set, Tuple
+
+from main import CompletionText
+
+STOP_PHRASES = {
+    '</s>',  # Llama-2, Mistral, and Mixtral
+    '<end_of_turn>',  # Gemma
+    '<|endoftext|>',  # Phi-2
+    '<|eot_id|>',  # Llama-3
+    '<|end|>', '<|user|>', '<|assistant|>',  # Phi-3
+}
+
+WORDS = [
+    ' the', ' a', ' voice', ' assistant', ' answer', ' is', ' short', ' but', ' informative', ' and', ' it', ' runs',
+    ' on', '-device', '.', ',', ' <', '|', '</', 'end', '\n', ' token', ' s', '>',
+]
+
+
+class RescanCompletionText(object):
+    """Previous implementation, which rescans the whole completion for every stop phrase on every token."""
+
+    def __init__(self, stop_phrases: Set[str]) -> None:
+        self.stop_phrases = stop_phrases
+        self.start: int = 0
+        self.text: str = ''
+        self.new_tokens: str = ''
+
+    def append(self, text: str) -> None:
+        self.text += text
+        end = len(self.text)
+
+        for stop_phrase in self.stop_phrases:
+            if stop_phrase in self.text:
+                contains = self.text.index(stop_phrase)
+                if end > contains:
+                    end = contains
+            for i in range(len(stop_phrase) - 1, 0, -1):
+                if self.text.endswith(stop_phrase[:i]):
+                    ends = len(self.text) - i
+                    if end > ends:
+                        end = ends
+                    break
+
+        start = self.start
+        self.start = end
+        self.new_tokens = self.text[start:end]
+
+    def get_new_tokens(self) -> str:
+        return self.new_tokens
+
+
+def run(completion_class, tokens, stop_phrases: Set[str] = STOP_PHRASES) -> Tuple[float, str]:
+    completion = completion_class(stop_phrases)
+    text = ''
+    start_sec = time.perf_counter()
+    for token in tokens:
+        completion.append(token)
+        text += completion.get_new_tokens()
+    return time.perf_counter() - start_sec, text
+
+
+def reference_completion(stop_phrases: Set[str], tokens: Sequence[str]) -> str:
+    """
+    Naive reference: the completion stops at the first token that completes a stop phrase, and is cut at the earliest
+    stop phrase in it.
+    """
+
+    text = ''
+    for token in tokens:
+        text += token
+        starts = [text.index(x) for x in stop_phrases if x in text]
+        if len(starts) > 0:
+            return text[:min(starts)]
+    return text
+
+
+def check(num_checks: int) -> None:
+    """
+    Compares the streaming implementation with the naive reference on random sets of short stop phrases over a small
+    alphabet, where the phrases often overlap and are suffixes of one another, streamed as random tokens.
+    """
+
+    for _ in range(num_checks):
+        stop_phrases = {
+            ''.join(random.choice('abc') for _ in range(random.randint(1, 4)))
+            for _ in range(random.randint(1, 4))
+        }
+        # the last token cannot be part of a stop phrase, so nothing is held back at the end
+        tokens = [
+            ''.join(random.choice('abc') for _ in range(random.randint(1, 3)))
+            for _ in range(random.randint(1, 8))
+        ] + ['.']
+
+        expected_text = reference_completion(stop_phrases, tokens)
+        _, streaming_text = run(CompletionText, tokens, stop_phrases)
+        if expected_text != streaming_text:
+            raise RuntimeError(
+                f'The completion for {sorted(stop_phrases)} and {tokens} is {streaming_text!r}, not {expected_text!r}')
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--num_tokens',
+        type=int,
+        default=4096,
+        help='Number of tokens in each completion.')
+    parser.add_argument(
+        '--num_runs',
+        type=int,
+        default=5,
+        help='Number of completions to stream through each implementation.')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for the random completions.')
+    parser.add_argument(
+        '--num_checks',
+        type=int,
+        default=20000,
+        help='Number of random stop phrase sets to compare the implementations on before timing them.')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    check(args.num_checks)
+    print(f'Checked {args.num_checks} random stop phrase sets')
+
+    rescan_sec = 0.
+    streaming_sec = 0.
+    for _ in range(args.num_runs):
+        tokens = [random.choice(WORDS) for _ in range(args.num_tokens - 1)] + ['</s>']
+
+        elapsed_sec, rescan_text = run(RescanCompletionText, tokens)
+        rescan_sec += elapsed_sec
+        elapsed_sec, streaming_text = run(CompletionText, tokens)
+        streaming_sec += elapsed_sec
+
+        if rescan_text != streaming_text:
+            raise RuntimeError('The implementations produced different completions.')
+
+    num_tokens = args.num_tokens * args.num_runs
+    print(f'Rescan: {round(rescan_sec * 1e6 / num_tokens, 2)} us/token')
+    print(f'Streaming: {round(streaming_sec * 1e6 / num_tokens, 2)} us/token')
+    print(f'Speedup: {round(rescan_sec / streaming_sec, 1)}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import json
+import signal
+import socket
+import struct
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from threading import Lock, Thread
+
+from pvrecorder import PvRecorder
+from pvspeaker import PvSpeaker
+
+HEADER = struct.Struct('<cI')
+AUDIO = b'A'
+PCM = b'P'
+EVENT = b'E'
+
+
+def receive(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if len(chunk) == 0:
+            raise EOFError()
+        data += chunk
+    return bytes(data)
+
+
+def main() -> None:
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--socket_path',
+        default='/tmp/llm-voice-assistant.sock',
+        help='Path of the Unix domain socket the server listens on.')
+    parser.add_argument(
+        '--audio_device_index',
+        type=int,
+        default=-1,
+        help='Index of input audio device')
+    args = parser.parse_args()
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(args.socket_path)
+
+    kind, length = HEADER.unpack(receive(connection, HEADER.size))
+    ready = json.loads(receive(connection, length))
+    if ready['event'] != 'ready':
+        print(f"Rejected by the server: {ready['reason']}")
+        return
+
+    recorder = PvRecorder(device_index=args.audio_device_index, frame_length=512)
+    speaker = PvSpeaker(sample_rate=ready['sample_rate'], bits_per_sample=16, buffer_size_secs=1)
+    pcm_queue = deque()
+    # the receiver clears the queue on an interrupt while the main loop is writing from it
+    pcm_lock = Lock()
+    stop = [False]
+
+    def handler(_, __) -> None:
+        stop[0] = True
+    signal.signal(signal.SIGINT, handler)
+
+    def receiver():
+        try:
+            while not stop[0]:
+                kind, length = HEADER.unpack(receive(connection, HEADER.size))
+                payload = receive(connection, length)
+                if kind == PCM:
+                    with pcm_lock:
+                        pcm_queue.append(memoryview(payload).cast('h'))
+                elif kind == EVENT:
+                    event = json.loads(payload)
+                    if event['event'] == 'wake':
+                        print('\n$ Wake word detected, utter your request or question ...', flush=True)
+                    elif event['event'] == 'transcript':
+                        print(f"User > {event['text']}", flush=True)
+                        print('LLM > ', end='', flush=True)
+                    elif event['event'] == 'answer':
+                        print(event['text'], end='', flush=True)
+                    elif event['event'] == 'interrupted':
+                        with pcm_lock:
+                            pcm_queue.clear()
+                    elif event['event'] == 'done':
+                        print(f"\n[Spans: {event['spans']}]", flush=True)
+                    elif event['event'] == 'rejected':
+                        print(f"\n[Request rejected: {event['reason']}]", flush=True)
+        except (EOFError, OSError):
+            stop[0] = True
+
+    receiver_thread = Thread(target=receiver, daemon=True)
+    receiver_thread.start()
+
+    print(f"[Session {ready['session']}] $ Say `Picovoice` ...", flush=True)
+    recorder.start()
+    speaker.start()
+    try:
+        while not stop[0]:
+            pcm = recorder.read()
+            connection.sendall(HEADER.pack(AUDIO, len(pcm) * 2) + struct.pack('%dh' % len(pcm), *pcm))
+            with pcm_lock:
+                while len(pcm_queue) > 0:
+                    written = speaker.write(pcm_queue[0])
+                    if written < len(pcm_queue[0]):
+                        pcm_queue[0] = pcm_queue[0][written:]
+                        break
+                    pcm_queue.popleft()
+    finally:
+        recorder.delete()
+        speaker.delete()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
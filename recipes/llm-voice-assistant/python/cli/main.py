@@ -1,15 +1,23 @@
+import hashlib
 import json
+import multiprocessing
 import os
+import pickle
+import re
 import signal
 import sys
 import time
 from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict, deque
+from functools import partial
 from itertools import chain
-from multiprocessing import Pipe, Process, active_children
+from multiprocessing import Pipe, Process, active_children, resource_tracker
 # noinspection PyProtectedMember
-from multiprocessing.connection import Connection
-from threading import Thread
-from typing import Optional, Sequence, Set
+from multiprocessing.connection import Connection, wait
+from multiprocessing.shared_memory import SharedMemory
+from threading import Event, Lock, Thread, get_native_id
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
 
 
 import picollm
@@ -19,15 +27,104 @@ import pvporcupine
 from pvrecorder import PvRecorder
 from pvspeaker import PvSpeaker
 
+from autotune import tuned_device
+from metrics import Metrics, MetricsExporter
+
 
 class Commands:
     START = 'start'
     CLOSE = 'close'
     PROCESS = 'process'
     SYNTHESIZE = 'synthesize'
-    SPEAK = 'speak'
     FLUSH = 'flush'
     INTERRUPT = 'interrupt'
+    CONFIRM = 'confirm'
+    SEGMENT = 'segment'
+    STANDBY = 'standby'
+    WAKE = 'wake'
+
+
+def normalize_transcript(text: str) -> str:
+    return re.sub(r'[^\w]+', ' ', text).strip().lower()
+
+
+def resident_memory_bytes() -> Optional[int]:
+    # the second field of `statm` is the resident set size in pages. it is only available on Linux.
+    try:
+        with open('/proc/self/statm', 'r') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class CPUPlan(object):
+    """
+    Partitions the cores between speech recognition (the main process, which also records and plays audio), speech
+    synthesis (the Orca process), and the LLM (the picoLLM process), so that picoLLM cannot starve the real-time parts.
+    Hyper-threads of the same physical core are always kept together.
+    """
+
+    ROLES = ('asr', 'tts', 'llm')
+    # below this, giving two cores to audio costs picoLLM more speed than it saves the real-time parts (e.g., on a
+    # Raspberry Pi's four cores)
+    AUTO_MIN_CORES = 6
+
+    def __init__(self, cpus: Dict[str, List[int]]) -> None:
+        self.cpus = cpus
+
+    @staticmethod
+    def parse_cpu_list(text: str) -> List[int]:
+        cpus = []
+        for part in text.split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                cpus.extend(range(int(first), int(last) + 1))
+            else:
+                cpus.append(int(part))
+        return cpus
+
+    @staticmethod
+    def physical_cores(cpus: Sequence[int]) -> List[List[int]]:
+        cores = dict()
+        for cpu in sorted(cpus):
+            try:
+                with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', 'r') as f:
+                    siblings = f.read().strip()
+            except OSError:
+                siblings = str(cpu)
+            cores.setdefault(siblings, []).append(cpu)
+        return list(cores.values())
+
+    @classmethod
+    def create(cls, spec: str) -> Optional['CPUPlan']:
+        if spec == 'none' or not hasattr(os, 'sched_setaffinity'):
+            return None
+
+        if spec == 'auto':
+            cores = cls.physical_cores(os.sched_getaffinity(0))
+            if len(cores) < cls.AUTO_MIN_CORES:
+                return None
+            return cls({'asr': cores[0], 'tts': cores[1], 'llm': list(chain.from_iterable(cores[2:]))})
+
+        cpus = dict()
+        for part in spec.split(';'):
+            role, cpu_list = part.split('=')
+            if role.strip() not in cls.ROLES:
+                raise ValueError(f'Unknown role `{role}` in CPU plan `{spec}`')
+            cpus[role.strip()] = cls.parse_cpu_list(cpu_list.strip())
+        missing = [x for x in cls.ROLES if x not in cpus]
+        if len(missing) > 0:
+            raise ValueError(f"CPU plan `{spec}` is missing {', '.join(missing)}")
+        return cls(cpus)
+
+    def num_threads(self, role: str) -> int:
+        return len(self.physical_cores(self.cpus[role]))
+
+    def apply(self, role: str) -> None:
+        os.sched_setaffinity(0, self.cpus[role])
+
+    def __str__(self) -> str:
+        return ', '.join(f"{x} {','.join(str(y) for y in self.cpus[x])}" for x in self.ROLES)
 
 
 class RTFProfiler:
@@ -44,6 +141,11 @@ class RTFProfiler:
         self._compute_sec += time.perf_counter() - self._tick_sec
         self._audio_sec += (len(audio) / self._sample_rate) if audio is not None else 0.
 
+    def totals(self) -> Tuple[float, float]:
+        """Returns the seconds spent synthesizing and the seconds of audio synthesized since the last `rtf()`."""
+
+        return self._compute_sec, self._audio_sec
+
     def rtf(self) -> float:
         if self._audio_sec > 0:
             rtf = self._compute_sec / self._audio_sec
@@ -81,108 +183,894 @@ class TPSProfiler(object):
         self._start_sec = 0.
 
 
+class IPCProfiler(object):
+    def __init__(self) -> None:
+        self._num_messages = 0
+        self._num_bytes = 0
+
+    def send(self, connection: Connection, message: Any) -> None:
+        buffer = pickle.dumps(message)
+        connection.send_bytes(buffer)
+        self._num_messages += 1
+        self._num_bytes += len(buffer)
+
+    def recv(self, connection: Connection) -> Any:
+        buffer = connection.recv_bytes()
+        self._num_messages += 1
+        self._num_bytes += len(buffer)
+        return pickle.loads(buffer)
+
+    def stats(self) -> Tuple[int, int]:
+        stats = self._num_messages, self._num_bytes
+        self._num_messages = 0
+        self._num_bytes = 0
+        return stats
+
+    def reset(self) -> None:
+        self._num_messages = 0
+        self._num_bytes = 0
+
+
+class PCMRingBuffer(object):
+    """
+    Single-producer/single-consumer ring of int16 samples in shared memory. The producer only advances the write index
+    and the consumer only advances the read index, hence no lock is needed. Both indices grow monotonically.
+
+    The producer can also split the samples into segments by marking where each one ends. The ends are kept in a small
+    table, which the consumer frees by counting the segments it has finished.
+    """
+
+    MAX_SEGMENTS = 64
+    _HEADER_SIZE = 32 + (MAX_SEGMENTS * 8)
+
+    def __init__(self, capacity: int, name: Optional[str] = None) -> None:
+        self.capacity = capacity
+        self._shared_memory = SharedMemory(
+            name=name,
+            create=name is None,
+            size=self._HEADER_SIZE + (capacity * 2))
+        # write index, read index, number of segments ended (by the producer) and finished (by the consumer)
+        self._indices = self._shared_memory.buf[:32].cast('Q')
+        self._segment_ends = self._shared_memory.buf[32:self._HEADER_SIZE].cast('Q')
+        self._samples = self._shared_memory.buf[self._HEADER_SIZE:self._HEADER_SIZE + (capacity * 2)].cast('h')
+        if name is None:
+            for i in range(4):
+                self._indices[i] = 0
+        elif os.name == 'posix':
+            # the creating process owns the segment, so the attaching one must not unlink it when it exits
+            # noinspection PyProtectedMember
+            resource_tracker.unregister(self._shared_memory._name, 'shared_memory')
+
+    def __reduce__(self):
+        return PCMRingBuffer, (self.capacity, self._shared_memory.name)
+
+    @property
+    def write_index(self) -> int:
+        return self._indices[0]
+
+    @property
+    def read_index(self) -> int:
+        return self._indices[1]
+
+    @property
+    def num_segments(self) -> int:
+        return self._indices[2]
+
+    def available(self) -> int:
+        return self._indices[0] - self._indices[1]
+
+    def end_segment(self) -> bool:
+        num_segments = self._indices[2]
+        if num_segments - self._indices[3] >= self.MAX_SEGMENTS:
+            return False
+        self._segment_ends[num_segments % self.MAX_SEGMENTS] = self._indices[0]
+        self._indices[2] = num_segments + 1
+        return True
+
+    def segment_end(self, segment: int) -> Optional[int]:
+        if segment >= self._indices[2]:
+            return None
+        return self._segment_ends[segment % self.MAX_SEGMENTS]
+
+    def finish_segments(self, num_segments: int) -> None:
+        self._indices[3] = num_segments
+
+    def write(self, pcm: Sequence[int]) -> int:
+        write_index = self._indices[0]
+        length = min(len(pcm), self.capacity - (write_index - self._indices[1]))
+        offset = 0
+        while offset < length:
+            position = (write_index + offset) % self.capacity
+            chunk_length = min(length - offset, self.capacity - position)
+            self._samples[position:position + chunk_length] = array('h', pcm[offset:offset + chunk_length])
+            offset += chunk_length
+        self._indices[0] = write_index + length
+        return length
+
+    def read(self, max_length: int) -> memoryview:
+        """
+        Returns a view of the oldest readable samples in shared memory, which stay readable until `advance()`. The view
+        saves copying the samples in this process, but `PvSpeaker.write()` still packs them into a new buffer for the
+        device.
+        """
+
+        read_index = self._indices[1]
+        position = read_index % self.capacity
+        length = min(self._indices[0] - read_index, self.capacity - position, max_length)
+        return self._samples[position:position + length]
+
+    def advance(self, length: int) -> None:
+        self._indices[1] += length
+
+    def seek(self, index: int) -> None:
+        self._indices[1] = index
+
+    def close(self) -> None:
+        self._indices.release()
+        self._segment_ends.release()
+        self._samples.release()
+        self._shared_memory.close()
+
+    def unlink(self) -> None:
+        self._shared_memory.unlink()
+
+
+class FrameRingBuffer(object):
+    """
+    Single-producer/single-consumer ring of fixed-length audio frames in shared memory. Every slot is tagged with the
+    sequence number of the frame it holds, so the consumer can tell when the producer has lapped it and count the frames
+    it lost instead of processing a torn or skipped stream.
+    """
+
+    _WRITING = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, frame_length: int, capacity: int, name: Optional[str] = None) -> None:
+        self.frame_length = frame_length
+        self.capacity = capacity
+        self._shared_memory = SharedMemory(
+            name=name,
+            create=name is None,
+            size=8 + (capacity * 8) + (capacity * frame_length * 2))
+        self._write_sequence = self._shared_memory.buf[:8].cast('Q')
+        self._sequences = self._shared_memory.buf[8:8 + (capacity * 8)].cast('Q')
+        self._frames = self._shared_memory.buf[8 + (capacity * 8):].cast('h')
+        self.read_sequence = 0
+        self.num_dropped = 0
+        if name is None:
+            self._write_sequence[0] = 0
+            for i in range(capacity):
+                self._sequences[i] = self._WRITING
+        elif os.name == 'posix':
+            # noinspection PyProtectedMember
+            resource_tracker.unregister(self._shared_memory._name, 'shared_memory')
+
+    def __reduce__(self):
+        return FrameRingBuffer, (self.frame_length, self.capacity, self._shared_memory.name)
+
+    def write(self, pcm: Sequence[int]) -> None:
+        sequence = self._write_sequence[0]
+        slot = sequence % self.capacity
+        self._sequences[slot] = self._WRITING
+        self._frames[slot * self.frame_length:(slot + 1) * self.frame_length] = array('h', pcm)
+        self._sequences[slot] = sequence
+        self._write_sequence[0] = sequence + 1
+
+    def read(self) -> Optional[List[int]]:
+        while self.read_sequence < self._write_sequence[0]:
+            lag = self._write_sequence[0] - self.read_sequence
+            if lag > self.capacity:
+                self.num_dropped += lag - self.capacity
+                self.read_sequence += lag - self.capacity
+
+            slot = self.read_sequence % self.capacity
+            pcm = self._frames[slot * self.frame_length:(slot + 1) * self.frame_length].tolist()
+            sequence = self._sequences[slot]
+            self.read_sequence += 1
+            if sequence == self.read_sequence - 1:
+                return pcm
+            # the producer overwrote the slot while it was being copied
+            self.num_dropped += 1
+
+        return None
+
+    @property
+    def num_written(self) -> int:
+        return self._write_sequence[0]
+
+    def close(self) -> None:
+        self._write_sequence.release()
+        self._sequences.release()
+        self._frames.release()
+        self._shared_memory.close()
+
+    def unlink(self) -> None:
+        self._shared_memory.unlink()
+
+
+class Tracer(object):
+    """
+    Stamps each utterance as it moves through the pipeline and exports one record per utterance. All processes stamp
+    with `time.perf_counter()`, which reads the system-wide monotonic clock, so stamps from the workers and the main
+    process are comparable. Only the last `max_records` records are kept in memory for `records()` and `summary()`, as
+    the trace file already has all of them.
+    """
+
+    EVENTS = ('wake', 'reloaded', 'endpoint', 'prompt', 'first_token', 'first_pcm', 'first_write', 'last_sample')
+    MAX_RECORDS = 1000
+    SPANS = (
+        ('reload', 'wake', 'reloaded'),
+        ('listen', 'wake', 'endpoint'),
+        ('transcribe', 'endpoint', 'prompt'),
+        ('prefill', 'prompt', 'first_token'),
+        ('synthesize', 'first_token', 'first_pcm'),
+        ('buffer', 'first_pcm', 'first_write'),
+        ('playback', 'first_write', 'last_sample'),
+        ('response', 'endpoint', 'first_write'),
+    )
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            trace_format: str = 'jsonl',
+            metrics: Optional[Metrics] = None,
+            max_records: Optional[int] = MAX_RECORDS) -> None:
+        self.metrics = metrics
+        self._format = trace_format
+        self._file = open(path, 'w', encoding='utf-8') if path is not None else None
+        self._lock = Lock()
+        self._num_utterances = 0
+        self._records = deque(maxlen=max_records)
+        self.current: Optional[Dict[str, Any]] = None
+
+        if self._file is not None and self._format == 'chrome':
+            self._file.write('[\n')
+
+    def begin(self) -> None:
+        with self._lock:
+            current = self.current
+        if current is not None:
+            self.finish(current, interrupted=True)
+        self.count_metric('wakes_total')
+        with self._lock:
+            self._num_utterances += 1
+            self.current = {
+                'utterance': self._num_utterances,
+                'wall_time': time.time(),
+                'events': {'wake': time.perf_counter()}
+            }
+
+    def stamp(self, event: str, time_sec: Optional[float] = None, record: Optional[Dict[str, Any]] = None) -> None:
+        with self._lock:
+            record = record if record is not None else self.current
+            if record is not None and event not in record['events']:
+                record['events'][event] = time_sec if time_sec is not None else time.perf_counter()
+
+    def finish(self, record: Optional[Dict[str, Any]], interrupted: bool = False) -> None:
+        with self._lock:
+            if record is None or 'interrupted' in record:
+                return
+            if record is self.current:
+                self.current = None
+            record['interrupted'] = interrupted
+            record['spans'] = dict()
+            for name, begin, end in self.SPANS:
+                if begin in record['events'] and end in record['events']:
+                    record['spans'][name] = record['events'][end] - record['events'][begin]
+                    if self.metrics is not None:
+                        self.metrics.observe('stage_latency_seconds', record['spans'][name], stage=name)
+            if interrupted:
+                self.count_metric('interrupts_total')
+            self._records.append(record)
+            if self._file is not None:
+                self._write(record)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        events = record['events']
+        if self._format == 'chrome':
+            for i, (name, begin, end) in enumerate(self.SPANS):
+                if name in record['spans']:
+                    self._file.write(json.dumps({
+                        'name': name,
+                        'cat': 'interrupted' if record['interrupted'] else 'utterance',
+                        'ph': 'X',
+                        'ts': round(events[begin] * 1e6),
+                        'dur': round(record['spans'][name] * 1e6),
+                        'pid': record['utterance'],
+                        'tid': i,
+                        'args': {'utterance': record['utterance']}
+                    }) + ',\n')
+        else:
+            wake_sec = events['wake']
+            self._file.write(json.dumps({
+                'utterance': record['utterance'],
+                'wall_time': record['wall_time'],
+                'interrupted': record['interrupted'],
+                'events': {k: round(events[k] - wake_sec, 6) for k in self.EVENTS if k in events},
+                'spans': {k: round(v, 6) for k, v in record['spans'].items()}
+            }) + '\n')
+        self._file.flush()
+
+    def records(self) -> Sequence[Dict[str, Any]]:
+        with self._lock:
+            return list(self._records)
+
+    def set_metric(self, name: str, value: float) -> None:
+        if self.metrics is not None:
+            self.metrics.set(name, value)
+
+    def count_metric(self, name: str, value: float = 1) -> None:
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
+
+    @staticmethod
+    def create_metrics() -> Metrics:
+        metrics = Metrics('llm_voice_assistant')
+        metrics.counter('wakes_total', 'Wake words detected.')
+        metrics.counter('interrupts_total', 'Utterances cut short by the next wake word.')
+        metrics.counter('playback_underruns_total', 'Times playback ran out of synthesized audio.')
+        metrics.counter('audio_frames_dropped_total', 'Microphone frames lost because the main process fell behind.')
+        metrics.gauge('porcupine_rtf', 'Real-time factor of Porcupine up to the last wake word.')
+        metrics.gauge('cheetah_rtf', 'Real-time factor of Cheetah for the last request.')
+        metrics.gauge('orca_rtf', 'Real-time factor of Orca for the last answer.')
+        metrics.gauge('picollm_tps', 'Tokens per second of picoLLM for the last answer.')
+        metrics.histogram('stage_latency_seconds', 'Duration of each stage of an utterance (see `--trace_path`).')
+        return metrics
+
+    def summary(self) -> Dict[str, Tuple[float, float]]:
+        def percentile(values: Sequence[float], q: float) -> float:
+            return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+        with self._lock:
+            records = [x for x in self._records if not x['interrupted']]
+        summary = dict()
+        for name, _, _ in self.SPANS:
+            values = sorted(x['spans'][name] for x in records if name in x['spans'])
+            if len(values) > 0:
+                summary[name] = (percentile(values, 0.5), percentile(values, 0.95))
+        return summary
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                if self._format == 'chrome':
+                    self._file.write('{}]\n')
+                self._file.close()
+                self._file = None
+
+
 class CompletionText(object):
+    """
+    Streams the completion while holding back any text that is, or could become, a stop phrase. The stop phrases are
+    matched with an Aho-Corasick automaton whose state carries over between tokens, so each token costs time
+    proportional to its own length.
+    """
+
     def __init__(self, stop_phrases: Set[str]) -> None:
         self.stop_phrases = stop_phrases
-        self.start: int = 0
-        self.text: str = ''
+        self._transitions = [dict()]
+        self._failures = [0]
+        self._depths = [0]
+        self._match_lengths = [0]
+
+        for stop_phrase in stop_phrases:
+            state = 0
+            for character in stop_phrase:
+                if character not in self._transitions[state]:
+                    self._transitions[state][character] = len(self._transitions)
+                    self._transitions.append(dict())
+                    self._failures.append(0)
+                    self._depths.append(self._depths[state] + 1)
+                    self._match_lengths.append(0)
+                state = self._transitions[state][character]
+            self._match_lengths[state] = len(stop_phrase)
+
+        states = deque(self._transitions[0].values())
+        while len(states) > 0:
+            state = states.popleft()
+            for character, next_state in self._transitions[state].items():
+                states.append(next_state)
+                self._failures[next_state] = self._next_state(self._failures[state], character)
+                # a state that is not a stop phrase itself may still end with one, through its failure link
+                if self._match_lengths[next_state] == 0:
+                    self._match_lengths[next_state] = self._match_lengths[self._failures[next_state]]
+
+        self.state: int = 0
+        self.pending: str = ''
+        self.stopped: bool = False
         self.new_tokens: str = ''
 
+    def _next_state(self, state: int, character: str) -> int:
+        while state > 0 and character not in self._transitions[state]:
+            state = self._failures[state]
+        return self._transitions[state].get(character, 0)
+
     def reset(self):
-        self.start: int = 0
-        self.text: str = ''
+        self.state: int = 0
+        self.pending: str = ''
+        self.stopped: bool = False
         self.new_tokens: str = ''
 
     def append(self, text: str) -> None:
-        self.text += text
-        end = len(self.text)
-
-        for stop_phrase in self.stop_phrases:
-            if stop_phrase in self.text:
-                contains = self.text.index(stop_phrase)
-                if end > contains:
-                    end = contains
-            for i in range(len(stop_phrase) - 1, 0, -1):
-                if self.text.endswith(stop_phrase[:i]):
-                    ends = len(self.text) - i
-                    if end > ends:
-                        end = ends
-                    break
-
-        start = self.start
-        self.start = end
-        self.new_tokens = self.text[start:end]
+        if self.stopped:
+            self.new_tokens = ''
+            return
+
+        pending = self.pending + text
+        state = self.state
+        stop = -1
+        for i, character in enumerate(text):
+            state = self._next_state(state, character)
+            if self._match_lengths[state] > 0:
+                # a longer stop phrase that ends later in the same token may start before this one
+                start = len(self.pending) + i + 1 - self._match_lengths[state]
+                stop = start if stop < 0 else min(stop, start)
+
+        if stop >= 0:
+            self.stopped = True
+            self.new_tokens = pending[:stop]
+            self.pending = ''
+            return
+
+        # the state is the longest suffix that is still the start of a stop phrase, so it is all that is held back
+        end = len(pending) - self._depths[state]
+        self.state = state
+        self.pending = pending[end:]
+        self.new_tokens = pending[:end]
 
     def get_new_tokens(self) -> str:
         return self.new_tokens
 
 
+class DialogHistory(object):
+    """
+    Keeps the latest turns of the conversation that fit in a token budget. When the budget is exceeded, the oldest turns
+    are dropped until half of the budget is used. The prompt therefore only changes at its start once every few turns,
+    and the context cached by picoLLM remains a prefix of the next prompt in between.
+    """
+
+    def __init__(self, pllm: picollm.PicoLLM, system: Optional[str], token_budget: int) -> None:
+        self.pllm = pllm
+        self.system = system
+        self.token_budget = token_budget
+        self.turns = deque()
+        self.num_tokens = 0
+        self.cached_tokens = []
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.pllm.tokenize(text, bos=False, eos=False))
+
+    def prompt(self, request: str) -> str:
+        if self.system is not None:
+            dialog = self.pllm.get_dialog(system=self.system, history=None)
+        else:
+            dialog = self.pllm.get_dialog(history=None)
+        for human, llm, _ in self.turns:
+            dialog.add_human_request(human)
+            dialog.add_llm_response(llm)
+        dialog.add_human_request(request)
+        return dialog.prompt()
+
+    def prefill_tokens(self, prompt: str) -> Tuple[int, int]:
+        tokens = self.pllm.tokenize(prompt, bos=True, eos=False)
+        num_cached = 0
+        for cached, token in zip(self.cached_tokens, tokens):
+            if cached != token:
+                break
+            num_cached += 1
+        return len(tokens) - num_cached, len(tokens)
+
+    def set_cached(self, text: str) -> None:
+        self.cached_tokens = self.pllm.tokenize(text, bos=True, eos=False)
+
+    def reset(self, pllm: picollm.PicoLLM) -> None:
+        self.pllm = pllm
+        self.cached_tokens = []
+
+    def load(self, turns: Sequence[Tuple[str, str, int]]) -> None:
+        self.turns = deque(tuple(x) for x in turns)
+        self.num_tokens = sum(x[2] for x in self.turns)
+
+    def add(self, prompt: str, request: str, response: str) -> None:
+        self.set_cached(prompt + response)
+        if self.token_budget <= 0:
+            return
+
+        num_tokens = self._count_tokens(request) + self._count_tokens(response)
+        self.turns.append((request, response, num_tokens))
+        self.num_tokens += num_tokens
+        if self.num_tokens > self.token_budget:
+            while len(self.turns) > 0 and self.num_tokens > (self.token_budget // 2):
+                self.num_tokens -= self.turns.popleft()[2]
+
+
+class PCMBuffer(object):
+    """Plays back PCM that is already in memory through the reading side of `PCMRingBuffer`'s interface."""
+
+    def __init__(self, pcm: array) -> None:
+        self._pcm = memoryview(pcm)
+        self._index = 0
+
+    def available(self) -> int:
+        return len(self._pcm) - self._index
+
+    def read(self, max_length: int) -> memoryview:
+        return self._pcm[self._index:self._index + max_length]
+
+    def advance(self, length: int) -> None:
+        self._index += length
+
+
+class SegmentSource(object):
+    """
+    Plays back an answer whose sentences are synthesized in parallel by several Orca workers, in the order they were
+    handed out. Each worker writes its sentences one after another to its own `PCMRingBuffer` and marks where each one
+    ends, so reading moves on to the ring of the next sentence at those marks.
+    """
+
+    def __init__(self, pcm_buffers: Sequence[PCMRingBuffer]) -> None:
+        self.pcm_buffers = pcm_buffers
+        self.first_segments: List[Optional[int]] = [None] * len(pcm_buffers)
+        self.num_segments = [0] * len(pcm_buffers)
+        self.segments = deque()
+
+    def add(self, worker: int) -> None:
+        self.segments.append((worker, self.num_segments[worker]))
+        self.num_segments[worker] += 1
+
+    def sync(self, worker: int, index: int, first_segment: int) -> None:
+        pcm_buffer = self.pcm_buffers[worker]
+        pcm_buffer.seek(index)
+        pcm_buffer.finish_segments(first_segment)
+        self.first_segments[worker] = first_segment
+
+    def _current(self) -> Tuple[Optional[PCMRingBuffer], Optional[int]]:
+        while len(self.segments) > 0:
+            worker, segment = self.segments[0]
+            if self.first_segments[worker] is None:
+                return None, None
+            pcm_buffer = self.pcm_buffers[worker]
+            segment += self.first_segments[worker]
+            end = pcm_buffer.segment_end(segment)
+            if end is None or pcm_buffer.read_index < end:
+                return pcm_buffer, end
+            pcm_buffer.finish_segments(segment + 1)
+            self.segments.popleft()
+        return None, None
+
+    def available(self) -> int:
+        pcm_buffer, end = self._current()
+        if pcm_buffer is None:
+            return 0
+        if end is None:
+            return pcm_buffer.available()
+        return min(pcm_buffer.available(), end - pcm_buffer.read_index)
+
+    def read(self, max_length: int) -> memoryview:
+        pcm_buffer, end = self._current()
+        if pcm_buffer is None:
+            return memoryview(array('h'))
+        if end is not None:
+            max_length = min(max_length, end - pcm_buffer.read_index)
+        return pcm_buffer.read(max_length)
+
+    def advance(self, length: int) -> None:
+        pcm_buffer, _ = self._current()
+        pcm_buffer.advance(length)
+
+
+class AnswerCache(object):
+    """
+    Caches the text and the synthesized PCM of answers, keyed on the normalized request and everything else that shapes
+    the answer (system prompt, models, and speech rate). The latest entries are kept in memory and, optionally, in a
+    directory whose size is capped by deleting the least recently used files.
+
+    An answer is recorded as it is generated and played, and only stored once it has been played to the end.
+    """
+
+    def __init__(self, capacity: int, cache_dir: Optional[str], disk_capacity_bytes: int, identity: str) -> None:
+        self._capacity = capacity
+        self._cache_dir = cache_dir
+        self._disk_capacity_bytes = disk_capacity_bytes
+        self._identity = identity
+        self._entries = OrderedDict()
+        self._recording: Optional[Tuple[str, str, array]] = None
+        self.hits = 0
+        self.misses = 0
+
+        if self._cache_dir is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+    def key(self, request: str) -> str:
+        return hashlib.sha256(f'{self._identity}\0{normalize_transcript(request)}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f'{key}.answer')
+
+    def get(self, key: str) -> Optional[Tuple[str, array]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self._cache_dir is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                text = f.read(int.from_bytes(f.read(4), 'little')).decode('utf-8')
+                pcm = array('h')
+                pcm.frombytes(f.read())
+            os.utime(self._path(key))
+            entry = (text, pcm)
+            self._store(key, entry)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _store(self, key: str, entry: Tuple[str, array]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def _save(self, key: str, entry: Tuple[str, array]) -> None:
+        text = entry[0].encode('utf-8')
+        path = self._path(key)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(len(text).to_bytes(4, 'little'))
+            f.write(text)
+            f.write(entry[1].tobytes())
+        os.replace(f'{path}.tmp', path)
+
+        paths = [os.path.join(self._cache_dir, x) for x in os.listdir(self._cache_dir) if x.endswith('.answer')]
+        stats = sorted(((os.stat(x), x) for x in paths), key=lambda x: x[0].st_mtime_ns)
+        size = sum(x[0].st_size for x in stats)
+        for stat, path in stats:
+            if size <= self._disk_capacity_bytes:
+                break
+            os.remove(path)
+            size -= stat.st_size
+
+    def record(self, key: str) -> None:
+        self._recording = (key, '', array('h'))
+
+    def record_text(self, text: str) -> None:
+        if self._recording is not None:
+            key, recorded, pcm = self._recording
+            self._recording = (key, recorded + text, pcm)
+
+    def record_pcm(self, pcm: memoryview) -> None:
+        if self._recording is not None:
+            self._recording[2].frombytes(pcm.tobytes())
+
+    def commit(self) -> None:
+        if self._recording is not None:
+            key, text, pcm = self._recording
+            self._recording = None
+            self._store(key, (text, pcm))
+            if self._cache_dir is not None:
+                try:
+                    self._save(key, (text, pcm))
+                except OSError as e:
+                    sys.stderr.write(f'Failed to save the answer to the cache: {e}\n')
+
+    def abort(self) -> None:
+        self._recording = None
+
+
+class PlayoutBuffer(object):
+    """
+    Chooses how much synthesized audio to buffer before an answer starts playing. Audio is produced at a rate set by
+    both picoLLM and Orca. If that rate is below real-time, an answer of `D` seconds needs a warmup of `D * (1 - rate)`
+    to play without gaps. The rate and the duration of the answers are tracked with moving averages. On top of that, the
+    gaps heard in the last answer are added as a margin, which slowly decays while answers play continuously.
+    """
+
+    MAX_WARMUP_SEC = 10.
+    MARGIN_DECAY = 0.9
+
+    def __init__(self, min_warmup_sec: float) -> None:
+        self.min_warmup_sec = min_warmup_sec
+        self.rate: Optional[float] = None
+        self.duration_sec = 0.
+        self.margin_sec = 0.
+        self.num_underruns = 0
+
+    def warmup_sec(self) -> float:
+        warmup_sec = self.margin_sec
+        if self.rate is not None and self.rate < 1:
+            warmup_sec += self.duration_sec * (1 - self.rate)
+        return min(max(warmup_sec, self.min_warmup_sec), self.MAX_WARMUP_SEC)
+
+    def update(
+            self,
+            duration_sec: float,
+            production_sec: float,
+            orca_rtf: Optional[float],
+            num_underruns: int,
+            underrun_sec: float) -> None:
+        if production_sec > 0:
+            rate = duration_sec / production_sec
+            if orca_rtf is not None and orca_rtf > 0:
+                rate = min(rate, 1 / orca_rtf)
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        self.duration_sec = duration_sec if self.duration_sec == 0 else (self.duration_sec + duration_sec) / 2
+        self.margin_sec = self.margin_sec + underrun_sec if num_underruns > 0 else self.margin_sec * self.MARGIN_DECAY
+        self.num_underruns += num_underruns
+
+
 class Speaker:
+    # PCM from Orca lands in shared memory without waking the main loop, so while audio is expected, the main loop
+    # wakes up at least once per this many samples to move it to the speaker
+    FRAME_LENGTH = 256
+
     def __init__(
             self,
             speaker: PvSpeaker,
-            config):
+            pcm_buffer: PCMRingBuffer,
+            tracer: Tracer,
+            config,
+            answer_cache: Optional[AnswerCache] = None):
         self.speaker = speaker
+        self.pcm_buffer = pcm_buffer
+        self.source = pcm_buffer
+        self.tracer = tracer
         self.config = config
+        self.answer_cache = answer_cache
+        self.playout = PlayoutBuffer(self.config['orca_warmup_sec'])
         self.orca_warmup = self.speaker.sample_rate * self.config['orca_warmup_sec']
+        self.orca_rtf: Optional[float] = None
+        self.first_pcm_sec = 0.
+        self.flush_sec = 0.
+        self.playback_start_sec = 0.
+        self.num_written = 0
+        self.num_underruns = 0
+        self.underrun_sec = 0.
+        self.starving = False
         self.started = False
+        self.synced = False
         self.speaking = False
         self.flushing = False
-        self.pcm_buffer = []
         self.future = None
+        self.utterance_end_sec = 0.
+        self.playback_delay_sec = -1.
 
     def close(self):
         self.interrupt()
 
-    def start(self):
+    def timeout(self) -> Optional[float]:
+        """Returns how long the main loop may wait for a message before the speaker needs to run, if at all."""
+
+        if not self.synced:
+            return None
+        return self.FRAME_LENGTH / self.speaker.sample_rate
+
+    def start(self, utterance_end_sec: float):
         self.started = True
+        self.utterance_end_sec = utterance_end_sec
+        self.playback_delay_sec = -1.
+        if self.config['orca_warmup_mode'] == 'adaptive':
+            self.orca_warmup = self.speaker.sample_rate * self.playout.warmup_sec()
+        self.orca_rtf = None
+        self.first_pcm_sec = 0.
+        self.flush_sec = 0.
+        self.num_written = 0
+        self.num_underruns = 0
+        self.underrun_sec = 0.
+        self.starving = False
+
+    def play(self, pcm: array, utterance_end_sec: float):
+        self.start(utterance_end_sec)
+        self.source = PCMBuffer(pcm)
+        self.synced = True
+        self.flushing = True
 
-    def process(self, pcm: Optional[Sequence[int]]):
-        if self.started and pcm is not None:
-            self.pcm_buffer.extend(pcm)
+    def sync(self, index: int):
+        if self.started:
+            self.source = self.pcm_buffer
+            self.pcm_buffer.seek(index)
+            self.synced = True
 
-    def flush(self):
+    def attach(self, source: SegmentSource):
+        if self.started:
+            self.source = source
+            self.synced = True
+
+    def flush(self, orca_rtf: Optional[float] = None):
         self.flushing = True
+        self.flush_sec = time.perf_counter()
+        self.orca_rtf = orca_rtf
 
     def interrupt(self):
         self.started = False
+        self.synced = False
+        if self.answer_cache is not None:
+            self.answer_cache.abort()
         if self.speaking:
             self.speaking = False
             self.flushing = False
-            self.pcm_buffer.clear()
             self.speaker.stop()
 
     def tick(self):
-        def stop():
+        def stop(record):
             self.speaker.flush()
+            self.tracer.stamp('last_sample', record=record)
+            self.tracer.finish(record)
             self.speaker.stop()
             ppn_prompt = self.config['ppn_prompt']
             print(f'$ Say {ppn_prompt} ...', flush=True)
-        if not self.speaking and len(self.pcm_buffer) > self.orca_warmup:
+        if not self.synced:
+            return
+        if self.first_pcm_sec == 0. and self.source.available() > 0:
+            self.first_pcm_sec = time.perf_counter()
+        if not self.speaking and (self.source.available() > self.orca_warmup or self.flushing):
             self.speaking = True
             self.speaker.start()
-        if self.speaking and len(self.pcm_buffer) > 0:
-            written = self.speaker.write(self.pcm_buffer)
+            self.playback_start_sec = time.perf_counter()
+        if self.speaking and self.num_written > 0 and not (self.flushing and self.source.available() == 0):
+            # the speaker has run dry if it has been playing for longer than the audio written to it
+            starved_sec = time.perf_counter() - self.playback_start_sec - self.num_written / self.speaker.sample_rate
+            if starved_sec > 0:
+                if not self.starving:
+                    self.num_underruns += 1
+                    self.starving = True
+                self.playback_start_sec += starved_sec
+                self.underrun_sec += starved_sec
+        if self.speaking and self.source.available() > 0:
+            pcm = self.source.read(self.speaker.sample_rate)
+            written = self.speaker.write(pcm)
             if written > 0:
-                del self.pcm_buffer[:written]
-        elif self.speaking and self.flushing and len(self.pcm_buffer) == 0:
+                self.num_written += written
+                self.starving = False
+                if self.answer_cache is not None and not isinstance(self.source, PCMBuffer):
+                    with pcm[:written] as recorded:
+                        self.answer_cache.record_pcm(recorded)
+                self.source.advance(written)
+                if self.playback_delay_sec == -1:
+                    self.playback_delay_sec = time.perf_counter() - self.utterance_end_sec
+                    self.tracer.stamp('first_write')
+            pcm.release()
+        elif self.speaking and self.flushing and self.source.available() == 0:
+            if not isinstance(self.source, PCMBuffer):
+                warmup_sec = self.orca_warmup / self.speaker.sample_rate
+                self.playout.update(
+                    duration_sec=self.num_written / self.speaker.sample_rate,
+                    production_sec=self.flush_sec - self.first_pcm_sec,
+                    orca_rtf=self.orca_rtf,
+                    num_underruns=self.num_underruns,
+                    underrun_sec=self.underrun_sec)
+                self.tracer.count_metric('playback_underruns_total', self.num_underruns)
+                if self.config['profile']:
+                    print(
+                        f'[Playout: {round(warmup_sec, 2)} sec warmup, {self.num_underruns} underruns '
+                        f'({self.playout.num_underruns} in total), '
+                        f'next warmup {round(self.playout.warmup_sec(), 2)} sec]')
+            if self.config['profile']:
+                print(f'[Playback Delay: {round(self.playback_delay_sec, 2)} sec]')
+            if self.answer_cache is not None:
+                self.answer_cache.commit()
             self.started = False
+            self.synced = False
             self.speaking = False
             self.flushing = False
-            Thread(target=stop).start()
+            Thread(target=stop, args=(self.tracer.current,)).start()
 
 
 class Synthesizer:
+    PCM_BUFFER_SEC = 30
+
     def __init__(
             self,
             speaker: Speaker,
             orca_connection: Connection,
             orca_process: Process,
+            tracer: Tracer,
             config):
         self.speaker = speaker
+        self.tracer = tracer
         self.orca_connection = orca_connection
         self.orca_process = orca_process
         self.config = config
+        self.ipc_profiler = IPCProfiler()
+        self.standby_reply = None
 
     def close(self):
         try:
@@ -193,14 +1081,17 @@ class Synthesizer:
             self.orca_process.kill()
 
     def start(self, utterance_end_sec):
-        self.speaker.start()
-        self.orca_connection.send({'command': Commands.START, 'utterance_end_sec': utterance_end_sec})
+        self.speaker.start(utterance_end_sec)
+        self.ipc_profiler.reset()
+        self.ipc_profiler.send(
+            self.orca_connection,
+            {'command': Commands.START, 'utterance_end_sec': utterance_end_sec})
 
     def process(self, text: str):
-        self.orca_connection.send({'command': Commands.PROCESS, 'text': text})
+        self.ipc_profiler.send(self.orca_connection, {'command': Commands.PROCESS, 'text': text})
 
     def flush(self):
-        self.orca_connection.send({'command': Commands.FLUSH})
+        self.ipc_profiler.send(self.orca_connection, {'command': Commands.FLUSH})
 
     def interrupt(self):
         try:
@@ -209,109 +1100,376 @@ class Synthesizer:
         except Exception as e:
             sys.stderr.write(str(e))
 
+    def standby(self):
+        self.standby_reply = None
+        self.orca_connection.send({'command': Commands.STANDBY})
+
+    def wake(self):
+        self.standby_reply = None
+        self.orca_connection.send({'command': Commands.WAKE})
+
     def tick(self):
         while self.orca_connection.poll():
-            message = self.orca_connection.recv()
-            if message['command'] == Commands.SPEAK:
-                self.speaker.process(message['pcm'])
+            message = self.ipc_profiler.recv(self.orca_connection)
+            if message['command'] in (Commands.STANDBY, Commands.WAKE):
+                self.standby_reply = message
+            elif message['command'] == Commands.START:
+                self.speaker.sync(message['index'])
             elif message['command'] == Commands.FLUSH:
+                if message['first_pcm_sec'] > 0:
+                    self.tracer.stamp('first_pcm', message['first_pcm_sec'])
+                self.tracer.set_metric('orca_rtf', message['profile'])
                 if self.config['profile']:
                     rtf = message['profile']
                     delay = message['delay']
+                    num_messages, num_bytes = self.ipc_profiler.stats()
                     print(f'[Orca RTF: {round(rtf, 2)}]')
+                    print(f'[Orca IPC: {num_messages} messages, {num_bytes} bytes]')
                     print(f"[Delay: {round(delay, 2)} sec]")
-                self.speaker.flush()
+                self.speaker.flush(message['profile'])
 
     @staticmethod
-    def create_worker(config):
+    def create_worker(config, create_orca: Callable[..., pvorca.Orca] = pvorca.create):
         main_connection, process_connection = Pipe()
-        process = Process(target=Synthesizer.worker, args=(process_connection, config))
+        process = Process(target=Synthesizer.worker, args=(process_connection, config, create_orca))
         process.start()
         return main_connection, process
 
     @staticmethod
-    def worker(connection: Connection, config):
+    def worker(connection: Connection, config, create_orca: Callable[..., pvorca.Orca] = pvorca.create):
         def handler(_, __) -> None:
             pass
         signal.signal(signal.SIGINT, handler)
 
-        orca = pvorca.create(access_key=config['access_key'])
-        orca_stream = orca.stream_open(speech_rate=config['orca_speech_rate'])
+        if config.get('cpu_plan_cpus') is not None:
+            CPUPlan(config['cpu_plan_cpus']).apply('tts')
+
+        def load():
+            orca_ = create_orca(access_key=config['access_key'])
+            return orca_, orca_.stream_open(speech_rate=config['orca_speech_rate'])
+
+        orca, orca_stream = load()
+        pcm_buffer = PCMRingBuffer(orca.sample_rate * Synthesizer.PCM_BUFFER_SEC)
         connection.send(orca.sample_rate)
-        connection.send({'version': orca.version})
+        connection.send({'version': orca.version, 'pcm_buffer': pcm_buffer})
 
         orca_profiler = RTFProfiler(orca.sample_rate)
         utterance_end_sec = 0
         delay_sec = -1
+        first_pcm_sec = 0.
 
         try:
             close = False
             synthesizing = False
             flushing = False
-            text_queue = []
+            text_queue = deque()
+            pcm_queue = deque()
+            flush_message = None
+
+            # `None` in the text queue ends the current segment, and in the PCM queue marks where it ends
+            def write_pcm():
+                while len(pcm_queue) > 0:
+                    pcm = pcm_queue[0]
+                    if pcm is None:
+                        if not pcm_buffer.end_segment():
+                            break
+                        pcm_queue.popleft()
+                        continue
+                    written = pcm_buffer.write(pcm)
+                    if written < len(pcm):
+                        pcm_queue[0] = pcm[written:]
+                        break
+                    pcm_queue.popleft()
+
             while not close:
-                time.sleep(0.1)
+                wait([connection], timeout=None if len(pcm_queue) == 0 else 0.01)
                 while connection.poll():
                     message = connection.recv()
                     if message['command'] == Commands.CLOSE:
                         close = True
                         synthesizing = False
                         flushing = False
-                        text_queue = []
+                        text_queue.clear()
+                    elif message['command'] == Commands.STANDBY:
+                        if orca is not None:
+                            orca_stream.close()
+                            orca.delete()
+                            orca, orca_stream = None, None
+                        connection.send({'command': Commands.STANDBY, 'rss': resident_memory_bytes()})
+                    elif message['command'] == Commands.WAKE:
+                        load_sec = time.perf_counter()
+                        if orca is None:
+                            orca, orca_stream = load()
+                        connection.send({'command': Commands.WAKE, 'load_sec': time.perf_counter() - load_sec})
                     elif message['command'] == Commands.START:
+                        if orca is None:
+                            orca, orca_stream = load()
                         synthesizing = True
+                        pcm_queue.clear()
+                        flush_message = None
                         utterance_end_sec = message['utterance_end_sec']
+                        connection.send({
+                            'command': Commands.START,
+                            'index': pcm_buffer.write_index,
+                            'segment': pcm_buffer.num_segments
+                        })
                     elif message['command'] == Commands.PROCESS:
                         if synthesizing:
                             text_queue.append(message['text'])
+                    elif message['command'] == Commands.SEGMENT:
+                        if synthesizing:
+                            text_queue.append(None)
                     elif message['command'] == Commands.FLUSH:
                         flushing = True
                     elif message['command'] == Commands.INTERRUPT:
                         synthesizing = False
                         flushing = False
-                        text_queue = []
-                        orca_stream.flush()
+                        text_queue.clear()
+                        pcm_queue.clear()
+                        flush_message = None
+                        if orca_stream is not None:
+                            orca_stream.flush()
                         orca_profiler.reset()
                         utterance_end_sec = 0
                         delay_sec = -1
+                        first_pcm_sec = 0.
                 while len(text_queue) > 0:
-                    text = text_queue.pop(0)
+                    text = text_queue.popleft()
                     if synthesizing:
                         orca_profiler.tick()
-                        pcm = orca_stream.synthesize(text)
+                        pcm = orca_stream.synthesize(text) if text is not None else orca_stream.flush()
                         orca_profiler.tock(pcm)
                         if pcm is not None:
-                            connection.send({'command': Commands.SPEAK, 'pcm': pcm})
-                            if delay_sec == -1:
-                                delay_sec = time.perf_counter() - utterance_end_sec
+                            pcm_queue.append(pcm)
+                        if text is None:
+                            pcm_queue.append(None)
+                        write_pcm()
+                        if pcm is not None and len(pcm) > 0 and delay_sec == -1:
+                            first_pcm_sec = time.perf_counter()
+                            delay_sec = first_pcm_sec - utterance_end_sec
                 if synthesizing and flushing and len(text_queue) == 0:
                     synthesizing = False
                     flushing = False
                     orca_profiler.tick()
                     pcm = orca_stream.flush()
                     orca_profiler.tock(pcm)
-                    connection.send({'command': Commands.SPEAK, 'pcm': pcm})
-                    connection.send({'command': Commands.FLUSH, 'profile': orca_profiler.rtf(), 'delay': delay_sec})
+                    if pcm is not None:
+                        pcm_queue.append(pcm)
+                    compute_sec, audio_sec = orca_profiler.totals()
+                    flush_message = {
+                        'command': Commands.FLUSH,
+                        'compute_sec': compute_sec,
+                        'audio_sec': audio_sec,
+                        'profile': orca_profiler.rtf(),
+                        'delay': delay_sec,
+                        'first_pcm_sec': first_pcm_sec
+                    }
                     utterance_end_sec = 0
                     delay_sec = -1
+                    first_pcm_sec = 0.
                 elif flushing:
                     flushing = False
+                write_pcm()
+                if flush_message is not None and len(pcm_queue) == 0:
+                    connection.send(flush_message)
+                    flush_message = None
         finally:
-            orca_stream.close()
-            orca.delete()
+            if orca is not None:
+                orca_stream.close()
+                orca.delete()
+            pcm_buffer.close()
+            pcm_buffer.unlink()
+
+
+class ParallelSynthesizer(Synthesizer):
+    """
+    Synthesizes an answer on several Orca workers. The first sentence is streamed to the first worker as it is
+    generated, just like with a single worker, so that the first audio comes as early as possible. Every later sentence
+    is handed out whole to the next worker in turn, and `SegmentSource` plays the sentences back in order.
+    """
+
+    SENTENCE_END = re.compile(r'[.!?;:]+["\')\]]*\s+|\n+')
+    _TAIL_LENGTH = 8
+
+    def __init__(
+            self,
+            speaker: Speaker,
+            orca_connections: Sequence[Connection],
+            orca_processes: Sequence[Process],
+            pcm_buffers: Sequence[PCMRingBuffer],
+            tracer: Tracer,
+            config):
+        super().__init__(speaker, orca_connections[0], orca_processes[0], tracer, config)
+        self.orca_connections = orca_connections
+        self.orca_processes = orca_processes
+        self.pcm_buffers = pcm_buffers
+        self.source: Optional[SegmentSource] = None
+        self.streaming = False
+        self.streamed = ''
+        self.text = ''
+        self.next_worker = 0
+        self.pending_starts = [0] * len(orca_connections)
+        self.flush_messages = dict()
+        self.standby_replies = dict()
+
+    def close(self):
+        for orca_connection, orca_process in zip(self.orca_connections, self.orca_processes):
+            try:
+                orca_connection.send({'command': Commands.CLOSE})
+                orca_process.join(1.0)
+            except Exception as e:
+                sys.stderr.write(str(e))
+                orca_process.kill()
+
+    def start(self, utterance_end_sec):
+        self.speaker.start(utterance_end_sec)
+        self.ipc_profiler.reset()
+        self.source = SegmentSource(self.pcm_buffers)
+        self.source.add(0)
+        self.speaker.attach(self.source)
+        self.streaming = True
+        self.streamed = ''
+        self.text = ''
+        self.next_worker = 1 % len(self.orca_connections)
+        self.flush_messages = dict()
+        for i, orca_connection in enumerate(self.orca_connections):
+            self.pending_starts[i] += 1
+            self.ipc_profiler.send(orca_connection, {'command': Commands.START, 'utterance_end_sec': utterance_end_sec})
+
+    def _send_segment(self, worker: int, text: str):
+        if len(text) > 0:
+            self.ipc_profiler.send(self.orca_connections[worker], {'command': Commands.PROCESS, 'text': text})
+        self.ipc_profiler.send(self.orca_connections[worker], {'command': Commands.SEGMENT})
+
+    def _dispatch(self, text: str):
+        if len(text.strip()) == 0:
+            return
+        worker = self.next_worker
+        self.next_worker = (worker + 1) % len(self.orca_connections)
+        self.source.add(worker)
+        self._send_segment(worker, text)
+
+    def process(self, text: str):
+        # text of an interrupted answer can still be on its way from picoLLM
+        if self.source is None:
+            return
+        if self.streaming:
+            # the end of the first sentence can straddle two batches of tokens
+            tail = self.streamed[-self._TAIL_LENGTH:]
+            match = self.SENTENCE_END.search(tail + text)
+            if match is None:
+                self.streamed += text
+                self.ipc_profiler.send(self.orca_connections[0], {'command': Commands.PROCESS, 'text': text})
+                return
+            end = match.end() - len(tail)
+            self.streaming = False
+            self._send_segment(0, text[:end])
+            text = text[end:]
+
+        self.text += text
+        match = self.SENTENCE_END.search(self.text)
+        while match is not None:
+            self._dispatch(self.text[:match.end()])
+            self.text = self.text[match.end():]
+            match = self.SENTENCE_END.search(self.text)
+
+    def flush(self):
+        if self.source is None:
+            return
+        if self.streaming:
+            self.streaming = False
+            self._send_segment(0, '')
+        else:
+            self._dispatch(self.text)
+        self.text = ''
+        for orca_connection in self.orca_connections:
+            self.ipc_profiler.send(orca_connection, {'command': Commands.FLUSH})
+
+    def interrupt(self):
+        try:
+            for orca_connection in self.orca_connections:
+                orca_connection.send({'command': Commands.INTERRUPT})
+            self.speaker.interrupt()
+        except Exception as e:
+            sys.stderr.write(str(e))
+        self.source = None
+
+    def standby(self):
+        self.standby_reply = None
+        self.standby_replies = dict()
+        for orca_connection in self.orca_connections:
+            orca_connection.send({'command': Commands.STANDBY})
+
+    def wake(self):
+        self.standby_reply = None
+        self.standby_replies = dict()
+        for orca_connection in self.orca_connections:
+            orca_connection.send({'command': Commands.WAKE})
+
+    def tick(self):
+        for worker, orca_connection in enumerate(self.orca_connections):
+            while orca_connection.poll():
+                message = self.ipc_profiler.recv(orca_connection)
+                if message['command'] in (Commands.STANDBY, Commands.WAKE):
+                    self.standby_replies[worker] = message
+                    if len(self.standby_replies) == len(self.orca_connections):
+                        replies = self.standby_replies.values()
+                        rss = [x.get('rss') for x in replies]
+                        self.standby_reply = {
+                            'command': message['command'],
+                            'rss': sum(rss) if None not in rss else None,
+                            'load_sec': max(x.get('load_sec', 0.) for x in replies)
+                        }
+                elif message['command'] == Commands.START:
+                    # replies to the starts of interrupted answers are skipped
+                    self.pending_starts[worker] -= 1
+                    if self.pending_starts[worker] == 0 and self.source is not None:
+                        self.source.sync(worker, message['index'], message['segment'])
+                elif message['command'] == Commands.FLUSH and self.pending_starts[worker] == 0:
+                    self.flush_messages[worker] = message
+                    if len(self.flush_messages) == len(self.orca_connections):
+                        self._flushed()
+
+    def _flushed(self):
+        messages = [self.flush_messages[i] for i in range(len(self.orca_connections))]
+        self.flush_messages = dict()
+        if messages[0]['first_pcm_sec'] > 0:
+            self.tracer.stamp('first_pcm', messages[0]['first_pcm_sec'])
+
+        rtfs = [x['profile'] for x in messages]
+        # the time all the workers spent synthesizing this answer over the audio they synthesized for it, so that a
+        # worker that synthesized more of the answer weighs more
+        audio_sec = sum(x['audio_sec'] for x in messages)
+        rtf = sum(x['compute_sec'] for x in messages) / audio_sec if audio_sec > 0 else 0.
+        self.tracer.set_metric('orca_rtf', rtf)
+        if self.config['profile']:
+            num_messages, num_bytes = self.ipc_profiler.stats()
+            print(
+                f"[Orca RTF: {round(rtf, 2)} ({', '.join(str(round(x, 2)) for x in rtfs)} on {len(rtfs)} workers)]")
+            print(f'[Orca IPC: {num_messages} messages, {num_bytes} bytes]')
+            print(f"[Delay: {round(messages[0]['delay'], 2)} sec]")
+        self.speaker.flush(rtf)
 
 
 class Generator:
+    NICENESS = 5
+
     def __init__(
             self,
             synthesizer: Synthesizer,
             pllm_connection: Connection,
             pllm_process: Process,
-            config):
+            tracer: Tracer,
+            config,
+            answer_cache: Optional[AnswerCache] = None):
         self.synthesizer = synthesizer
+        self.tracer = tracer
         self.pllm_connection = pllm_connection
         self.pllm_process = pllm_process
         self.config = config
+        self.answer_cache = answer_cache
+        self.ipc_profiler = IPCProfiler()
+        self.standby_reply = None
 
     def close(self):
         try:
@@ -321,55 +1479,202 @@ class Generator:
             sys.stderr.write(str(e))
             self.pllm_process.kill()
 
+    def answer_from_cache(self, text: str, utterance_end_sec) -> bool:
+        if self.answer_cache is None:
+            return False
+
+        key = self.answer_cache.key(text)
+        entry = self.answer_cache.get(key)
+        if self.config['profile']:
+            print(
+                f"[Answer cache: {'hit' if entry is not None else 'miss'} "
+                f"({self.answer_cache.hits} hits, {self.answer_cache.misses} misses)]")
+        if entry is None:
+            self.answer_cache.record(key)
+            return False
+
+        ppn_prompt = self.config['ppn_prompt']
+        print(f'LLM (say {ppn_prompt} to interrupt) > {entry[0]}', flush=True)
+        self.synthesizer.speaker.play(entry[1], utterance_end_sec)
+        return True
+
     def process(self, text: str, utterance_end_sec):
         ppn_prompt = self.config['ppn_prompt']
         print(f'LLM (say {ppn_prompt} to interrupt) > ', end='', flush=True)
 
         self.synthesizer.start(utterance_end_sec)
-        self.pllm_connection.send({'command': Commands.PROCESS, 'text': text})
+        self.ipc_profiler.reset()
+        self.ipc_profiler.send(self.pllm_connection, {'command': Commands.PROCESS, 'text': text})
+        self.tracer.stamp('prompt')
+
+    def speculate(self, text: str):
+        self.ipc_profiler.reset()
+        self.ipc_profiler.send(self.pllm_connection, {'command': Commands.PROCESS, 'text': text, 'speculative': True})
+
+    def confirm(self, utterance_end_sec):
+        ppn_prompt = self.config['ppn_prompt']
+        print(f'LLM (say {ppn_prompt} to interrupt) > ', end='', flush=True)
+
+        self.synthesizer.start(utterance_end_sec)
+        self.ipc_profiler.send(self.pllm_connection, {'command': Commands.CONFIRM})
+        self.tracer.stamp('prompt')
+
+    def cancel(self):
+        self.pllm_connection.send({'command': Commands.INTERRUPT})
 
     def interrupt(self):
         self.pllm_connection.send({'command': Commands.INTERRUPT})
         self.synthesizer.interrupt()
 
+    def standby(self):
+        self.standby_reply = None
+        self.pllm_connection.send({'command': Commands.STANDBY})
+
+    def wake(self):
+        self.standby_reply = None
+        self.pllm_connection.send({'command': Commands.WAKE})
+
     def tick(self):
+        text = ''
         while self.pllm_connection.poll():
-            message = self.pllm_connection.recv()
-            if message['command'] == Commands.SYNTHESIZE:
+            message = self.ipc_profiler.recv(self.pllm_connection)
+            if message['command'] in (Commands.STANDBY, Commands.WAKE):
+                self.standby_reply = message
+            elif message['command'] == Commands.SYNTHESIZE:
                 print(message['text'], end='', flush=True)
-                self.synthesizer.process(message['text'])
+                text += message['text']
+                if self.answer_cache is not None:
+                    self.answer_cache.record_text(message['text'])
             elif message['command'] == Commands.FLUSH:
+                if len(text) > 0:
+                    self.synthesizer.process(text)
+                    text = ''
+                if message['first_token_sec'] > 0:
+                    self.tracer.stamp('first_token', message['first_token_sec'])
                 print('', flush=True)
+                self.tracer.set_metric('picollm_tps', message['profile'])
                 if self.config['profile']:
                     tps = message['profile']
+                    num_messages, num_bytes = self.ipc_profiler.stats()
                     print(f'[picoLLM TPS: {round(tps, 2)}]')
+                    print(
+                        f"[picoLLM prefill: {message['prefill_tokens']} of {message['prompt_tokens']} prompt tokens, "
+                        f"{message['history_tokens']} history tokens]")
+                    print(f'[picoLLM IPC: {num_messages} messages, {num_bytes} bytes]')
                 self.synthesizer.flush()
+        if len(text) > 0:
+            self.synthesizer.process(text)
+
+    @staticmethod
+    def prompt_prefix(pllm: picollm.PicoLLM, system: Optional[str]) -> str:
+        prompts = list()
+        for request in ('a', 'b'):
+            dialog = pllm.get_dialog(system=system) if system is not None else pllm.get_dialog()
+            dialog.add_human_request(request)
+            prompts.append(dialog.prompt())
+        return os.path.commonprefix(prompts)
 
     @staticmethod
-    def create_worker(config):
+    def model_hash(model_path: str, cache_dir: str) -> Optional[str]:
+        # stand-in engines (e.g., the fake backend of `replay.py`) have no model file to hash
+        model_path = os.path.realpath(model_path)
+        if not os.path.isfile(model_path):
+            return None
+        stat = os.stat(model_path)
+        index_path = os.path.join(cache_dir, 'models.json')
+
+        index = dict()
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as fd:
+                index = json.load(fd)
+
+        entry = index.get(model_path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(model_path, 'rb') as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b''):
+                sha256.update(block)
+
+        index[model_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+        with open(index_path, 'w', encoding='utf-8') as fd:
+            json.dump(index, fd, indent=2)
+
+        return sha256.hexdigest()
+
+    @staticmethod
+    def prepare_context(pllm: picollm.PicoLLM, prefix: str, config) -> str:
+        cache_dir = config['picollm_context_cache_dir']
+        context_path = None
+        model_hash = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            model_hash = Generator.model_hash(config['picollm_model_path'], cache_dir)
+        if model_hash is not None:
+            key = hashlib.sha256('\0'.join([
+                model_hash,
+                config['picollm_device'],
+                prefix
+            ]).encode('utf-8')).hexdigest()
+            context_path = os.path.realpath(os.path.join(cache_dir, f'{key}.ctx'))
+
+            if os.path.exists(context_path):
+                try:
+                    pllm.context_load(context_path)
+                    return 'loaded'
+                except picollm.PicoLLMError as e:
+                    sys.stderr.write(f'Failed to load the cached context, prefilling it instead: {e}\n')
+
+        pllm.generate(prompt=prefix, completion_token_limit=1)
+        if context_path is None:
+            return 'prefilled'
+
+        pllm.context_save(context_path)
+        return 'saved'
+
+    @staticmethod
+    def create_worker(config, create_pllm: Callable[..., picollm.PicoLLM] = picollm.create):
         main_connection, process_connection = Pipe()
-        process = Process(target=Generator.worker, args=(process_connection, config))
+        process = Process(target=Generator.worker, args=(process_connection, config, create_pllm))
         process.start()
         return main_connection, process
 
     @staticmethod
-    def worker(connection: Connection, config):
+    def worker(connection: Connection, config, create_pllm: Callable[..., picollm.PicoLLM] = picollm.create):
         def handler(_, __) -> None:
             pass
         signal.signal(signal.SIGINT, handler)
 
-        pllm = picollm.create(
-            access_key=config['access_key'],
-            model_path=config['picollm_model_path'],
-            device=config['picollm_device'],
-            enable_context_caching=True)
+        if config.get('cpu_plan_cpus') is not None:
+            CPUPlan(config['cpu_plan_cpus']).apply('llm')
+        if config.get('audio_priority', False):
+            os.nice(Generator.NICENESS)
 
-        connection.send({'version': pllm.version, 'model': pllm.model})
+        def load() -> picollm.PicoLLM:
+            return create_pllm(
+                access_key=config['access_key'],
+                model_path=config['picollm_model_path'],
+                device=config['picollm_device'],
+                enable_context_caching=True)
 
-        if config['picollm_system_prompt'] is not None:
-            dialog = pllm.get_dialog(system=config['picollm_system_prompt'])
-        else:
-            dialog = pllm.get_dialog()
+        pllm = load()
+
+        short_answers_instruction = "You are a voice assistant and your answers are very short but informative"
+        system = config['picollm_system_prompt']
+        if config['short_answers']:
+            system = f"{short_answers_instruction}. {system}" if system is not None else short_answers_instruction
+
+        history = DialogHistory(pllm, system, config['picollm_history_token_budget'])
+        prefix = Generator.prompt_prefix(pllm, system)
+        prepend_short_answers_instruction = config['short_answers'] and short_answers_instruction not in prefix
+        context_sec = time.perf_counter()
+        context = Generator.prepare_context(pllm, prefix, config) if system is not None else None
+        context_sec = time.perf_counter() - context_sec
+        if context is not None:
+            history.set_cached(prefix)
+
+        connection.send({'version': pllm.version, 'model': pllm.model, 'context': context, 'context_sec': context_sec})
 
         pllm_profiler = TPSProfiler()
 
@@ -381,42 +1686,132 @@ class Generator:
             '<|end|>', '<|user|>', '<|assistant|>',  # Phi-3
         }
         completion = CompletionText(stop_phrases)
+        batch = ['', 0.]
+        first_token_sec = [0.]
+        request_id = [None]
+
+        def send_batch():
+            if len(batch[0]) > 0:
+                connection.send({'command': Commands.SYNTHESIZE, 'text': batch[0], 'id': request_id[0]})
+                batch[0] = ''
+                batch[1] = time.perf_counter()
+                if first_token_sec[0] == 0.:
+                    first_token_sec[0] = batch[1]
+
+        # every request and interrupt starts a new epoch. a speculative completion is held back until the main process
+        # confirms its epoch, i.e. the final transcript matches the partial one it was started on.
+        epoch = [0]
+        confirmed_epoch = [0]
+        generation_epoch = [0]
+        decided = Event()
+
+        def confirmed():
+            return confirmed_epoch[0] == generation_epoch[0]
 
         def llm_callback(text):
             pllm_profiler.tock()
             completion.append(text)
-            new_tokens = completion.get_new_tokens()
-            if len(new_tokens) > 0:
-                connection.send({'command': Commands.SYNTHESIZE, 'text': new_tokens})
-
+            batch[0] += completion.get_new_tokens()
+            if confirmed() and time.perf_counter() - batch[1] >= config['token_batch_sec']:
+                send_batch()
+
+        # `STANDBY` releases picoLLM and `WAKE` loads it again. both are handled between requests, in the order they
+        # were received. the lock keeps `interrupt` away from an instance that is being released.
+        engine = [pllm]
+        engine_lock = Lock()
+        engine_commands = deque()
+
+        def interrupt():
+            with engine_lock:
+                if engine[0] is not None:
+                    engine[0].interrupt()
+
+        def wake():
+            pllm_ = load()
+            history.reset(pllm_)
+            if system is not None and Generator.prepare_context(pllm_, prefix, config) is not None:
+                history.set_cached(prefix)
+            with engine_lock:
+                engine[0] = pllm_
+
+        # every request is answered with either `FLUSH` or `INTERRUPT`, tagged with its (optional) ID, so that the
+        # main process knows when the worker is free again
         close = [False]
         prompt = [None]
+        skipped = deque()
+        prompt_ready = Event()
 
         def event_manager():
             while not close[0]:
                 message = connection.recv()
                 if message['command'] == Commands.CLOSE:
                     close[0] = True
-                    pllm.interrupt()
+                    interrupt()
+                    prompt_ready.set()
+                    decided.set()
                     return
                 elif message['command'] == Commands.INTERRUPT:
-                    pllm.interrupt()
+                    epoch[0] += 1
+                    if prompt[0] is not None:
+                        skipped.append(prompt[0].get('id'))
+                        prompt[0] = None
+                    interrupt()
+                    decided.set()
+                elif message['command'] in (Commands.STANDBY, Commands.WAKE):
+                    engine_commands.append(message['command'])
+                    prompt_ready.set()
                 elif message['command'] == Commands.PROCESS:
-                    prompt[0] = message['text']
+                    epoch[0] += 1
+                    if not message.get('speculative', False):
+                        confirmed_epoch[0] = epoch[0]
+                    prompt[0] = message
+                    prompt_ready.set()
+                elif message['command'] == Commands.CONFIRM:
+                    confirmed_epoch[0] = epoch[0]
+                    decided.set()
         Thread(target=event_manager).start()
 
         try:
             while not close[0]:
-                if prompt[0] is not None:
-                    short_answers_instruction = \
-                        "You are a voice assistant and your answers are very short but informative"
-                    dialog.add_human_request(
-                        f"{short_answers_instruction}. {prompt[0]}" if config['short_answers'] else prompt[0])
+                prompt_ready.wait()
+                prompt_ready.clear()
+                while len(engine_commands) > 0:
+                    command = engine_commands.popleft()
+                    if command == Commands.STANDBY:
+                        if engine[0] is not None:
+                            with engine_lock:
+                                pllm, engine[0] = engine[0], None
+                            pllm.release()
+                        connection.send({'command': Commands.STANDBY, 'rss': resident_memory_bytes()})
+                    else:
+                        load_sec = time.perf_counter()
+                        if engine[0] is None:
+                            wake()
+                        connection.send({'command': Commands.WAKE, 'load_sec': time.perf_counter() - load_sec})
+                while len(skipped) > 0:
+                    connection.send({'command': Commands.INTERRUPT, 'id': skipped.popleft()})
+                message = prompt[0]
+                if message is not None:
                     prompt[0] = None
+                    if engine[0] is None:
+                        wake()
+                    pllm = engine[0]
+                    request_id[0] = message.get('id')
+                    if 'turns' in message:
+                        history.load(message['turns'])
+                    request = message['text']
+                    if prepend_short_answers_instruction:
+                        request = f"{short_answers_instruction}. {request}"
+                    generation_epoch[0] = epoch[0]
+                    dialog_prompt = history.prompt(request)
+                    prefill_tokens, prompt_tokens = history.prefill_tokens(dialog_prompt)
 
                     completion.reset()
+                    batch[0] = ''
+                    batch[1] = 0.
+                    first_token_sec[0] = 0.
                     result = pllm.generate(
-                        prompt=dialog.prompt(),
+                        prompt=dialog_prompt,
                         completion_token_limit=config['picollm_completion_token_limit'],
                         stop_phrases=stop_phrases,
                         presence_penalty=config['picollm_presence_penalty'],
@@ -425,13 +1820,34 @@ class Generator:
                         top_p=config['picollm_top_p'],
                         stream_callback=llm_callback)
 
-                    dialog.add_llm_response(result.completion)
+                    while not confirmed() and epoch[0] == generation_epoch[0] and not close[0]:
+                        decided.wait()
+                        decided.clear()
+                    if not confirmed():
+                        history.set_cached(dialog_prompt + result.completion)
+                        connection.send({'command': Commands.INTERRUPT, 'id': request_id[0]})
+                        continue
+
+                    history.add(dialog_prompt, request, result.completion)
                     if result.endpoint != picollm.PicoLLMEndpoints.INTERRUPTED:
-                        connection.send({'command': Commands.FLUSH, 'profile': pllm_profiler.tps()})
-                else:
-                    time.sleep(0.25)
+                        send_batch()
+                        flush_message = {
+                            'command': Commands.FLUSH,
+                            'id': request_id[0],
+                            'profile': pllm_profiler.tps(),
+                            'first_token_sec': first_token_sec[0],
+                            'prefill_tokens': prefill_tokens,
+                            'prompt_tokens': prompt_tokens,
+                            'history_tokens': history.num_tokens
+                        }
+                        if 'turns' in message:
+                            flush_message['turns'] = list(history.turns)
+                        connection.send(flush_message)
+                    else:
+                        connection.send({'command': Commands.INTERRUPT, 'id': request_id[0]})
         finally:
-            pllm.release()
+            if engine[0] is not None:
+                engine[0].release()
 
 
 class Listener:
@@ -440,8 +1856,10 @@ class Listener:
             generator: Generator,
             porcupine: pvporcupine.Porcupine,
             cheetah: pvcheetah.Cheetah,
+            tracer: Tracer,
             config):
         self.generator = generator
+        self.tracer = tracer
         self.porcupine = porcupine
         self.cheetah = cheetah
         self.config = config
@@ -453,20 +1871,34 @@ class Listener:
         self.user_request = ''
         self.tick_count = 0
 
+        self.stable_frames = 0
+        self.speculation = None
+        self.speculation_sec = 0.
+        self.num_speculations = 0
+        self.num_speculation_hits = 0
+
     def close(self):
         pass
 
+    def cancel_speculation(self):
+        if self.speculation is not None:
+            self.generator.cancel()
+            self.speculation = None
+
     def process(self, pcm: Optional[Sequence[int]]):
         if self.sleeping:
             self.porcupine_profiler.tick()
             wake_word_detected = self.porcupine.process(pcm) == 0
             self.porcupine_profiler.tock(pcm)
             if wake_word_detected:
+                self.tracer.begin()
                 self.sleeping = False
                 self.tick_count = 4
                 self.generator.interrupt()
+                porcupine_rtf = self.porcupine_profiler.rtf()
+                self.tracer.set_metric('porcupine_rtf', porcupine_rtf)
                 if self.config['profile']:
-                    print(f'[Porcupine RTF: {round(self.porcupine_profiler.rtf(), 2)}]')
+                    print(f'[Porcupine RTF: {round(porcupine_rtf, 2)}]')
                 self.porcupine_profiler.reset()
                 self.cheetah_profiler.reset()
         elif self.listening:
@@ -476,8 +1908,19 @@ class Listener:
             if len(partial_transcript) > 0:
                 self.user_request += partial_transcript
                 print(partial_transcript, end='', flush=True)
+                self.stable_frames = 0
+                self.cancel_speculation()
+            elif self.config['speculative_frames'] > 0 and self.speculation is None and \
+                    len(normalize_transcript(self.user_request)) > 0:
+                self.stable_frames += 1
+                if self.stable_frames >= self.config['speculative_frames']:
+                    self.speculation = self.user_request
+                    self.speculation_sec = time.perf_counter()
+                    self.num_speculations += 1
+                    self.generator.speculate(self.speculation)
             if endpoint_reached:
                 utterance_end_sec = time.perf_counter()
+                self.tracer.stamp('endpoint', utterance_end_sec)
                 self.sleeping = True
                 self.listening = False
                 self.cheetah_profiler.tick()
@@ -486,10 +1929,28 @@ class Listener:
                 if len(remaining_transcript) > 0:
                     self.user_request += remaining_transcript
                 print(remaining_transcript, flush=True)
+                cheetah_rtf = self.cheetah_profiler.rtf()
+                self.tracer.set_metric('cheetah_rtf', cheetah_rtf)
                 if self.config['profile']:
-                    print(f'[Cheetah RTF: {round(self.cheetah_profiler.rtf(), 2)}]')
-                self.generator.process(self.user_request, utterance_end_sec)
+                    print(f'[Cheetah RTF: {round(cheetah_rtf, 2)}]')
+                if self.generator.answer_from_cache(self.user_request, utterance_end_sec):
+                    self.cancel_speculation()
+                elif self.speculation is not None and \
+                        normalize_transcript(self.speculation) == normalize_transcript(self.user_request):
+                    self.num_speculation_hits += 1
+                    if self.config['profile']:
+                        print(
+                            f'[Speculation: hit, started {round(utterance_end_sec - self.speculation_sec, 2)} sec '
+                            f'early ({self.num_speculation_hits}/{self.num_speculations} correct)]')
+                    self.speculation = None
+                    self.generator.confirm(utterance_end_sec)
+                else:
+                    if self.speculation is not None and self.config['profile']:
+                        print(f'[Speculation: miss ({self.num_speculation_hits}/{self.num_speculations} correct)]')
+                    self.cancel_speculation()
+                    self.generator.process(self.user_request, utterance_end_sec)
                 self.user_request = ''
+                self.stable_frames = 0
         elif self.tick_count > 0:
             self.tick_count -= 1
         else:
@@ -498,25 +1959,202 @@ class Listener:
             print('User > ', end='', flush=True)
 
 
+class Standby:
+    """
+    Releases picoLLM and Orca in their workers after the assistant has been idle for a while, and loads them again as
+    soon as the wake word is detected, so that loading overlaps with the user speaking the request.
+    """
+
+    def __init__(
+            self,
+            listener: Listener,
+            generator: Generator,
+            synthesizer: Synthesizer,
+            tracer: Tracer,
+            config):
+        self.listener = listener
+        self.generator = generator
+        self.synthesizer = synthesizer
+        self.tracer = tracer
+        self.config = config
+        self.idle_sec = config['standby_min'] * 60
+        self.active_sec = time.perf_counter()
+        self.standing_by = False
+        self.reporting = False
+        self.record = None
+        self.load_sec = None
+
+    def tick(self):
+        now_sec = time.perf_counter()
+        speaker = self.synthesizer.speaker
+        if not self.listener.sleeping or speaker.started or speaker.speaking:
+            self.active_sec = now_sec
+            if self.standing_by:
+                self.standing_by = False
+                self.generator.wake()
+                self.synthesizer.wake()
+                self.record = self.tracer.current
+                self.load_sec = None
+                if self.config['profile']:
+                    print('[Standby: reloading picoLLM and Orca]', flush=True)
+        elif self.idle_sec > 0 and not self.standing_by and now_sec - self.active_sec >= self.idle_sec:
+            self.standing_by = True
+            self.reporting = True
+            self.generator.standby()
+            self.synthesizer.standby()
+            if self.config['profile']:
+                print('[Standby: releasing picoLLM and Orca until the wake word]', flush=True)
+
+        generator_reply = self.generator.standby_reply
+        synthesizer_reply = self.synthesizer.standby_reply
+        if generator_reply is None or synthesizer_reply is None:
+            return
+
+        if generator_reply['command'] == Commands.STANDBY and self.reporting:
+            self.reporting = False
+            if self.config['profile']:
+                def megabytes(rss: Optional[int]) -> str:
+                    return f'{round(rss / (1024 * 1024))} MB' if rss is not None else 'unknown'
+
+                print(
+                    f"[Standby: resident memory {megabytes(generator_reply['rss'])} (picoLLM worker), "
+                    f"{megabytes(synthesizer_reply['rss'])} (Orca worker), "
+                    f"{megabytes(resident_memory_bytes())} (main)]",
+                    flush=True)
+        elif generator_reply['command'] == Commands.WAKE and self.record is not None:
+            if self.load_sec is None:
+                self.load_sec = (generator_reply['load_sec'], synthesizer_reply['load_sec'])
+                self.tracer.stamp('reloaded', record=self.record)
+            # reported once the answer is over, so that it does not interrupt the answer's text
+            events = self.record['events']
+            if 'interrupted' in self.record:
+                if self.config['profile'] and 'first_write' in events:
+                    print(
+                        f'[Cold wake: picoLLM reloaded in {round(self.load_sec[0], 2)} sec, Orca in '
+                        f'{round(self.load_sec[1], 2)} sec, first audio '
+                        f"{round(events['first_write'] - events['wake'], 2)} sec after the wake word]",
+                        flush=True)
+                self.record = None
+
+
 class Recorder:
+    NICENESS = -10
+    BUFFER_SEC = 10
+
     def __init__(
             self,
             listener: Listener,
-            recorder: PvRecorder):
+            create_recorder: Callable[[int], PvRecorder],
+            frame_length: int,
+            sample_rate: int,
+            config):
         self.listener = listener
-        self.recorder = recorder
-        self.recording = False
+        self.create_recorder = create_recorder
+        self.frame_length = frame_length
+        self.config = config
+        self.ring = FrameRingBuffer(frame_length, int(self.BUFFER_SEC * sample_rate / frame_length))
+        self.connection, self.recorder_connection = Pipe(duplex=False)
+        self.num_dropped = 0
+
+        self.recorder = None
+        self.recorder_thread = None
+        self.recorder_process = None
+        if config['audio_capture'] == 'process':
+            self.stop_event = multiprocessing.Event()
+        else:
+            self.stop_event = Event()
+            self.recorder = create_recorder(frame_length)
+
+    @property
+    def sentinels(self) -> List[Any]:
+        return [self.recorder_process.sentinel] if self.recorder_process is not None else []
 
     def close(self):
-        if self.recording:
-            self.recorder.stop()
+        self.stop_event.set()
+        if self.recorder_thread is not None:
+            self.recorder_thread.join()
+        if self.recorder_process is not None:
+            self.recorder_process.join(1)
+        if self.recorder is not None:
+            self.recorder.delete()
+        if self.config['profile']:
+            print(f'[Capture: {self.ring.num_written} frames, {self.ring.num_dropped} dropped]')
+        self.ring.close()
+        self.ring.unlink()
+
+    def start(self):
+        if self.config['audio_capture'] == 'process':
+            self.recorder_process = Process(
+                target=Recorder.worker,
+                args=(
+                    self.ring,
+                    self.recorder_connection,
+                    self.stop_event,
+                    self.create_recorder,
+                    self.frame_length,
+                    self.config['audio_priority']))
+            self.recorder_process.start()
+        else:
+            self.recorder_thread = Thread(
+                target=Recorder.capture,
+                args=(
+                    self.ring,
+                    self.recorder_connection,
+                    self.stop_event,
+                    self.recorder,
+                    self.config['audio_priority']))
+            self.recorder_thread.start()
 
     def tick(self):
-        if not self.recording:
-            self.recording = True
-            self.recorder.start()
-        pcm = self.recorder.read()
-        self.listener.process(pcm)
+        while self.connection.poll():
+            self.connection.recv_bytes()
+        pcm = self.ring.read()
+        while pcm is not None:
+            self.listener.process(pcm)
+            pcm = self.ring.read()
+        if self.ring.num_dropped > self.num_dropped:
+            self.listener.tracer.count_metric('audio_frames_dropped_total', self.ring.num_dropped - self.num_dropped)
+            sys.stderr.write(f'Dropped {self.ring.num_dropped - self.num_dropped} audio frames\n')
+            self.num_dropped = self.ring.num_dropped
+
+    @staticmethod
+    def capture(
+            ring: FrameRingBuffer,
+            connection: Connection,
+            stop_event: Event,
+            recorder: PvRecorder,
+            priority: bool):
+        if priority:
+            try:
+                os.setpriority(os.PRIO_PROCESS, get_native_id(), Recorder.NICENESS)
+            except (AttributeError, OSError) as e:
+                sys.stderr.write(f'Failed to raise the priority of audio capture: {e}\n')
+        recorder.start()
+        try:
+            while not stop_event.is_set():
+                ring.write(recorder.read())
+                connection.send_bytes(b'')
+        finally:
+            recorder.stop()
+
+    @staticmethod
+    def worker(
+            ring: FrameRingBuffer,
+            connection: Connection,
+            stop_event: Event,
+            create_recorder: Callable[[int], PvRecorder],
+            frame_length: int,
+            priority: bool):
+        def handler(_, __) -> None:
+            pass
+        signal.signal(signal.SIGINT, handler)
+
+        recorder = create_recorder(frame_length)
+        try:
+            Recorder.capture(ring, connection, stop_event, recorder, priority)
+        finally:
+            recorder.delete()
+            ring.close()
 
 
 REQUIRED_ARGS = [
@@ -534,17 +2172,33 @@ DEFAULT_ARGS = {
     'picollm_temperature': 0,
     'picollm_top_p': 1,
     'picollm_system_prompt': None,
+    'picollm_context_cache_dir': None,
+    'picollm_history_token_budget': 0,
+    'speculative_frames': 0,
+    'answer_cache_size': 0,
+    'answer_cache_dir': None,
+    'answer_cache_disk_mb': 256,
     'orca_warmup_sec': 0,
+    'orca_warmup_mode': 'adaptive',
+    'cpu_plan': 'auto',
+    'audio_priority': False,
+    'audio_capture': 'process',
+    'standby_min': 0,
     'orca_speech_rate': 1.0,
+    'orca_workers': 1,
+    'token_batch_sec': 0.02,
     'porcupine_sensitivity': 0.5,
     'short_answers': False,
-    'profile': False
+    'profile': False,
+    'trace_path': None,
+    'trace_format': 'jsonl',
+    'metrics_address': None,
+    'metrics_textfile_path': None,
+    'metrics_textfile_interval_sec': 15
 }
 
 
-def main():
-    sys.stdout.reconfigure(encoding='utf-8')
-
+def create_parser() -> ArgumentParser:
     parser = ArgumentParser()
     parser.add_argument(
         '--config',
@@ -569,7 +2223,9 @@ def main():
              "select a specific GPU device, set this argument to `gpu:${GPU_INDEX}`, where `${GPU_INDEX}` is the index "
              "of the target GPU. If set to `cpu`, the engine will run on the CPU with the default number of threads. "
              "To specify the number of threads, set this argument to `cpu:${NUM_THREADS}`, where `${NUM_THREADS}` is "
-             "the desired number of threads.")
+             "the desired number of threads. If set to `best` after `autotune.py` was run for the model, the fastest "
+             "device it found is used. If set to `tuned`, the model is tuned on the first launch instead (which can "
+             "take minutes) and the fastest device is used from then on.")
     parser.add_argument(
         '--picollm_completion_token_limit',
         type=int,
@@ -603,21 +2259,108 @@ def main():
         type=str,
         help="A text prompt to give to the llm prior to it's input to instruct it on how to behave."
     )
+    parser.add_argument(
+        '--picollm_history_token_budget',
+        type=int,
+        help="Maximum number of tokens of earlier turns to include in the prompt. When exceeded, the oldest turns are "
+             "dropped until half of it is used. Set to `0` to only include the latest request.")
+    parser.add_argument(
+        '--speculative_frames',
+        type=int,
+        help="Number of frames the partial transcript must stay unchanged before picoLLM starts processing it, ahead "
+             "of the endpoint. The answer is only spoken if the final transcript matches. Set to `0` to wait for the "
+             "endpoint.")
+    parser.add_argument(
+        '--picollm_context_cache_dir',
+        help="Directory to cache the processed system prompt in. If set, later launches with the same model, device, "
+             "and system prompt load it instead of processing the system prompt again.")
+    parser.add_argument(
+        '--answer_cache_size',
+        type=int,
+        help="Number of answers (text and synthesized audio) to keep in memory and replay when the same request is "
+             "made again. Set to `0` to disable the cache. It is disabled with `--picollm_history_token_budget` above "
+             "`0`, as the answers then depend on the earlier turns.")
+    parser.add_argument(
+        '--answer_cache_dir',
+        help="Directory to also keep cached answers in, so that they survive restarts.")
+    parser.add_argument(
+        '--answer_cache_disk_mb',
+        type=float,
+        help="Maximum size of `--answer_cache_dir` in megabytes. The least recently used answers are deleted first.")
     parser.add_argument(
         '--orca_warmup_sec',
         type=float,
         help="Duration of the synthesized audio to buffer before streaming it out. A higher value helps slower "
-             "(e.g., Raspberry Pi) to keep up with real-time at the cost of increasing the initial delay.")
+             "(e.g., Raspberry Pi) to keep up with real-time at the cost of increasing the initial delay. With "
+             "`--orca_warmup_mode adaptive`, this is the minimum.")
+    parser.add_argument(
+        '--orca_warmup_mode',
+        choices=['adaptive', 'fixed'],
+        help="If set to `adaptive`, the warmup is chosen before every answer from how fast audio was produced for the "
+             "previous answers and whether their playback had gaps. If set to `fixed`, `--orca_warmup_sec` is always "
+             "used.")
     parser.add_argument(
         '--orca_speech_rate',
         type=float,
         help="Rate of speech of the generated audio.")
+    parser.add_argument(
+        '--token_batch_sec',
+        type=float,
+        help="Maximum time generated tokens are held in the picoLLM process to be sent to Orca as a single message. "
+             "Set to `0` to send every token as soon as it is generated.")
     parser.add_argument(
         '--porcupine_sensitivity',
         type=float,
         help="Sensitivity for detecting keywords.")
+    parser.add_argument(
+        '--cpu_plan',
+        help="Cores to pin speech recognition (`asr`), speech synthesis (`tts`), and the LLM (`llm`) to, e.g., "
+             "`asr=0;tts=1;llm=2-7`. picoLLM then runs one thread per physical core of its set, unless a GPU is "
+             "used. If set to `auto`, one core is given to each of `asr` and `tts` and the rest to `llm` when there "
+             "are at least six physical cores, and otherwise there is no plan. Set to `none` to let the processes "
+             "share all cores. Only supported on Linux.")
+    parser.add_argument(
+        '--orca_workers',
+        type=int,
+        help="Number of Orca processes. With more than one, the first sentence of an answer is streamed to the first "
+             "process and the following sentences are synthesized in parallel, one per process.")
+    parser.add_argument(
+        '--audio_priority',
+        action='store_true',
+        help="Raise the priority of audio capture (when permitted) and lower the priority of picoLLM.")
+    parser.add_argument(
+        '--standby_min',
+        type=float,
+        help="Minutes of inactivity after which picoLLM and Orca are released to save memory. They are loaded again "
+             "when the wake word is detected, while the request is being spoken. Set to `0` (default) to keep them "
+             "loaded.")
+    parser.add_argument(
+        '--audio_capture',
+        choices=['process', 'thread'],
+        help="Read the microphone in a dedicated process (default) or in a thread of the main process. Either way, "
+             "frames go through a shared ring buffer that holds the last ten seconds of audio.")
     parser.add_argument('--short_answers', action='store_true')
     parser.add_argument('--profile', action='store_true', help='Show runtime profiling information.')
+    parser.add_argument(
+        '--trace_path',
+        help='Path to a file to export the timeline of every utterance to.')
+    parser.add_argument(
+        '--trace_format',
+        choices=['jsonl', 'chrome'],
+        help='Format of the exported timelines. `jsonl` writes one JSON record per utterance and `chrome` writes '
+             'Chrome trace events that can be opened in `chrome://tracing` or Perfetto.')
+    parser.add_argument(
+        '--metrics_address',
+        help="Serve metrics in the Prometheus text format at `http://${ADDRESS}/metrics`, e.g. `127.0.0.1:9464` (or "
+             "`:9464` for localhost).")
+    parser.add_argument(
+        '--metrics_textfile_path',
+        help="Write metrics in the Prometheus text format to this file, for the textfile collector of the node "
+             "exporter.")
+    parser.add_argument(
+        '--metrics_textfile_interval_sec',
+        type=float,
+        help="Interval between two writes of `--metrics_textfile_path`.")
     parser.add_argument(
         '--audio_device_index',
         type=int,
@@ -627,13 +2370,10 @@ def main():
         '--show_audio_devices',
         action='store_true',
         help='Only list available input audio devices and exit')
-    args = parser.parse_args()
+    return parser
 
-    if args.show_audio_devices:
-        for index, name in enumerate(PvRecorder.get_available_devices()):
-            print('Device #%d: %s' % (index, name))
-        return
 
+def load_config(parser: ArgumentParser, args) -> Dict[str, Any]:
     if args.config is not None:
         config_path = os.path.realpath(args.config)
     else:
@@ -659,14 +2399,51 @@ def main():
         if key not in config:
             config[key] = value
 
-    stop = [False]
+    return config
 
-    def handler(_, __) -> None:
-        stop[0] = True
-    signal.signal(signal.SIGINT, handler)
 
-    pllm_connection, pllm_process = Generator.create_worker(config)
-    orca_connection, orca_process = Synthesizer.create_worker(config)
+def run(
+        config: Dict[str, Any],
+        stop: Event,
+        create_recorder: Callable[[int], PvRecorder],
+        create_speaker: Callable[[int], PvSpeaker],
+        tracer: Tracer,
+        create_pllm: Callable[..., picollm.PicoLLM] = picollm.create,
+        create_orca: Callable[..., pvorca.Orca] = pvorca.create) -> None:
+    try:
+        cpu_plan = CPUPlan.create(config['cpu_plan'])
+    except ValueError as e:
+        sys.stderr.write(f'Ignoring the CPU plan: {e}\n')
+        cpu_plan = None
+    tuned = None
+    if config['picollm_device'] in ('best', 'tuned'):
+        # tuning only runs when asked for, as it loads the model once per candidate device, and stand-in engines are
+        # never tuned
+        tune = config['picollm_device'] == 'tuned' and create_pllm is picollm.create
+        tuned = tuned_device(config['picollm_model_path'], access_key=config['access_key'] if tune else None)
+        config['picollm_device'] = 'best'
+    if tuned is not None:
+        config['picollm_device'] = tuned
+    if cpu_plan is not None:
+        config['cpu_plan_cpus'] = cpu_plan.cpus
+        device = config['picollm_device']
+        num_threads = cpu_plan.num_threads('llm')
+        if tuned is not None and device.startswith('cpu:'):
+            config['picollm_device'] = f"cpu:{min(num_threads, int(device[len('cpu:'):]))}"
+        elif device == 'cpu' or (
+                device == 'best' and not any(x.startswith('gpu') for x in picollm.available_devices())):
+            config['picollm_device'] = f"cpu:{num_threads}"
+
+    pllm_connection, pllm_process = Generator.create_worker(config, create_pllm)
+    orca_workers = [Synthesizer.create_worker(config, create_orca) for _ in range(max(1, config['orca_workers']))]
+    orca_connections = [x[0] for x in orca_workers]
+    orca_processes = [x[1] for x in orca_workers]
+    if cpu_plan is not None:
+        cpu_plan.apply('asr')
+        if config['profile']:
+            print(f"[CPU plan: {cpu_plan}, picoLLM device `{config['picollm_device']}`]")
+    elif tuned is not None and config['profile']:
+        print(f"[Auto-tuned picoLLM device `{config['picollm_device']}`]")
 
     if 'keyword_model_path' not in config:
         porcupine = pvporcupine.create(
@@ -691,53 +2468,139 @@ def main():
     print(f"→ Cheetah v{cheetah.version}")
 
     try:
-        pv_recorder = PvRecorder(
-            device_index=args.audio_device_index,
-            frame_length=porcupine.frame_length)
-        pv_speaker = PvSpeaker(sample_rate=int(orca_connection.recv()), bits_per_sample=16, buffer_size_secs=1)
+        sample_rates = [int(x.recv()) for x in orca_connections]
+        pv_speaker = create_speaker(sample_rates[0])
 
         pllm_info = pllm_connection.recv()
         print(f"→ picoLLM v{pllm_info['version']} <{pllm_info['model']}>")
+        if config['profile'] and pllm_info['context'] is not None:
+            print(f"[picoLLM context {pllm_info['context']} in {round(pllm_info['context_sec'], 2)} sec]")
 
-        orca_info = orca_connection.recv()
-        print(f"→ Orca v{orca_info['version']}")
+        orca_infos = [x.recv() for x in orca_connections]
+        orca_info = orca_infos[0]
+        pcm_buffers = [x['pcm_buffer'] for x in orca_infos]
+        print(f"→ Orca v{orca_info['version']}" + (f" ({len(orca_infos)} workers)" if len(orca_infos) > 1 else ''))
     except EOFError:
         for child in active_children():
             child.kill()
         exit(1)
 
-    speaker = Speaker(pv_speaker, config)
-    synthesizer = Synthesizer(speaker, orca_connection, orca_process, config)
-    generator = Generator(synthesizer, pllm_connection, pllm_process, config)
-    listener = Listener(generator, porcupine, cheetah, config)
-    recorder = Recorder(listener, pv_recorder)
+    answer_cache = None
+    if config['answer_cache_size'] > 0 and config['picollm_history_token_budget'] > 0:
+        # the key does not cover the earlier turns, and a replayed answer would be missing from them
+        sys.stderr.write('Ignoring the answer cache, as answers depend on the dialog history\n')
+    elif config['answer_cache_size'] > 0:
+        answer_cache = AnswerCache(
+            config['answer_cache_size'],
+            config['answer_cache_dir'],
+            int(config['answer_cache_disk_mb'] * 1024 * 1024),
+            '\0'.join(str(x) for x in (
+                pllm_info['model'],
+                orca_info['version'],
+                pv_speaker.sample_rate,
+                config['orca_speech_rate'],
+                config['picollm_system_prompt'],
+                config['short_answers'])))
+
+    speaker = Speaker(pv_speaker, pcm_buffers[0], tracer, config, answer_cache)
+    if len(orca_connections) > 1:
+        synthesizer = ParallelSynthesizer(speaker, orca_connections, orca_processes, pcm_buffers, tracer, config)
+    else:
+        synthesizer = Synthesizer(speaker, orca_connections[0], orca_processes[0], tracer, config)
+    generator = Generator(synthesizer, pllm_connection, pllm_process, tracer, config, answer_cache)
+    listener = Listener(generator, porcupine, cheetah, tracer, config)
+    recorder = Recorder(listener, create_recorder, porcupine.frame_length, porcupine.sample_rate, config)
+    standby = Standby(listener, generator, synthesizer, tracer, config)
 
     ppn_prompt = config['ppn_prompt']
     print(f'$ Say {ppn_prompt} ...', flush=True)
 
+    recorder.start()
+    exporter = None
+    if tracer.metrics is not None:
+        pids = {'main': os.getpid(), 'picollm': pllm_process.pid}
+        for i, orca_process in enumerate(orca_processes):
+            pids[f'orca{i}' if len(orca_processes) > 1 else 'orca'] = orca_process.pid
+        if recorder.recorder_process is not None:
+            pids['capture'] = recorder.recorder_process.pid
+        try:
+            exporter = MetricsExporter(
+                tracer.metrics,
+                pids,
+                address=config['metrics_address'],
+                textfile_path=config['metrics_textfile_path'],
+                interval_sec=config['metrics_textfile_interval_sec'])
+            exporter.start()
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f'Not exporting metrics: {e}\n')
+            exporter = None
+
+    connections = [recorder.connection, pllm_connection] + orca_connections
+    sentinels = [pllm_process.sentinel] + [x.sentinel for x in orca_processes] + recorder.sentinels
+
     try:
-        while not stop[0]:
-            if not pllm_process.is_alive() or not orca_process.is_alive():
+        while not stop.is_set():
+            ready = wait(connections + sentinels, timeout=speaker.timeout())
+            if any(sentinel in ready for sentinel in sentinels):
                 break
 
             recorder.tick()
             generator.tick()
             synthesizer.tick()
             speaker.tick()
+            standby.tick()
     finally:
+        if exporter is not None:
+            exporter.close()
         recorder.close()
         listener.close()
         generator.close()
         synthesizer.close()
         speaker.close()
 
+        if config['profile']:
+            for name, (p50, p95) in tracer.summary().items():
+                print(f'[Trace {name}: p50 {round(p50, 2)} sec, p95 {round(p95, 2)} sec]')
+        tracer.close()
+
         for child in active_children():
             child.kill()
 
         porcupine.delete()
         cheetah.delete()
-        pv_recorder.delete()
         pv_speaker.delete()
+        for pcm_buffer in pcm_buffers:
+            pcm_buffer.close()
+
+
+def main():
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.show_audio_devices:
+        for index, name in enumerate(PvRecorder.get_available_devices()):
+            print('Device #%d: %s' % (index, name))
+        return
+
+    config = load_config(parser, args)
+
+    stop = Event()
+
+    def handler(_, __) -> None:
+        stop.set()
+    signal.signal(signal.SIGINT, handler)
+
+    run(
+        config,
+        stop,
+        partial(PvRecorder, device_index=args.audio_device_index),
+        lambda sample_rate: PvSpeaker(sample_rate=sample_rate, bits_per_sample=16, buffer_size_secs=1),
+        Tracer(
+            config['trace_path'],
+            config['trace_format'],
+            Tracer.create_metrics() if config['metrics_address'] or config['metrics_textfile_path'] else None))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,420 @@
+import csv
+import os
+import signal
+import sys
+import time
+import wave
+import zlib
+from argparse import ArgumentParser
+from array import array
+from collections import deque
+from functools import partial
+from threading import Event
+from typing import Any, Dict, List, Optional, Sequence
+
+import picollm
+
+from main import Tracer, create_parser, load_config, run
+
+CSV_FIELDS = ('file', 'utterance', 'interrupted', 'wake_sec', 'endpoint_sec', 'first_token_sec', 'first_audio_sec',
+              'total_sec')
+
+
+class WavRecorder(object):
+    """
+    Stands in for `PvRecorder` by replaying WAV files at the rate a microphone would produce them. After each file, it
+    feeds silence until the assistant has finished answering before moving on to the next one.
+    """
+
+    SAMPLE_RATE = 16000
+
+    def __init__(
+            self,
+            paths: Sequence[str],
+            frame_length: int,
+            tracer: Tracer,
+            stop: Event,
+            gap_sec: float,
+            timeout_sec: float) -> None:
+        for path in paths:
+            with wave.open(path, 'rb') as f:
+                if f.getnchannels() != 1 or f.getsampwidth() != 2 or f.getframerate() != self.SAMPLE_RATE:
+                    raise ValueError(f'`{path}` must be a single-channel, 16-bit WAV file sampled at 16 kHz')
+
+        self.frame_length = frame_length
+        self.sample_rate = self.SAMPLE_RATE
+        self.tracer = tracer
+        self.stop_event = stop
+        self.gap_sec = gap_sec
+        self.timeout_sec = timeout_sec
+        self.pending = deque(paths)
+        self.files: List[Dict[str, Any]] = []
+        self.wav: Optional[wave.Wave_read] = None
+        self.start_sec = 0.
+        self.num_frames = 0
+
+    def _open_next(self, now_sec: float) -> None:
+        if len(self.pending) == 0:
+            self.stop_event.set()
+            return
+        path = self.pending.popleft()
+        self.wav = wave.open(path, 'rb')
+        self.files.append({'file': os.path.basename(path), 'start_sec': now_sec, 'end_sec': None})
+        print(f'[Replaying {path}]', flush=True)
+
+    def start(self) -> None:
+        self.start_sec = time.perf_counter()
+        self.num_frames = 0
+        self._open_next(self.start_sec)
+
+    def stop(self) -> None:
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+    def delete(self) -> None:
+        self.stop()
+
+    def read(self) -> List[int]:
+        self.num_frames += 1
+        due_sec = self.start_sec + (self.num_frames * self.frame_length) / self.sample_rate
+        delay_sec = due_sec - time.perf_counter()
+        if delay_sec > 0:
+            time.sleep(delay_sec)
+
+        pcm = array('h')
+        if self.wav is not None:
+            pcm.frombytes(self.wav.readframes(self.frame_length))
+            if sys.byteorder == 'big':
+                pcm.byteswap()
+            if len(pcm) < self.frame_length:
+                self.wav.close()
+                self.wav = None
+                self.files[-1]['end_sec'] = due_sec
+        elif not self.stop_event.is_set():
+            idle_sec = due_sec - self.files[-1]['end_sec']
+            if (self.tracer.current is None and idle_sec >= self.gap_sec) or idle_sec >= self.timeout_sec:
+                self._open_next(due_sec)
+
+        pcm.extend([0] * (self.frame_length - len(pcm)))
+        return pcm.tolist()
+
+
+class WavSpeaker(object):
+    """
+    Stands in for `PvSpeaker` by consuming its buffer at the rate a sound card would and optionally saving what was
+    played to a WAV file.
+    """
+
+    def __init__(self, sample_rate: int, buffer_size_secs: int = 1, output_path: Optional[str] = None) -> None:
+        self.sample_rate = sample_rate
+        self.capacity = sample_rate * buffer_size_secs
+        self.queue = deque()
+        self.num_queued = 0
+        self.last_sec: Optional[float] = None
+        self.output = None
+        if output_path is not None:
+            self.output = wave.open(output_path, 'wb')
+            self.output.setnchannels(1)
+            self.output.setsampwidth(2)
+            self.output.setframerate(sample_rate)
+
+    def _play(self) -> None:
+        if self.last_sec is None:
+            return
+        now_sec = time.perf_counter()
+        num_samples = min(self.num_queued, int((now_sec - self.last_sec) * self.sample_rate))
+        if num_samples == self.num_queued:
+            self.last_sec = now_sec
+        else:
+            self.last_sec += num_samples / self.sample_rate
+        self.num_queued -= num_samples
+        while num_samples > 0:
+            chunk = self.queue[0]
+            played = chunk[:num_samples]
+            if len(played) < len(chunk):
+                self.queue[0] = chunk[num_samples:]
+            else:
+                self.queue.popleft()
+            num_samples -= len(played)
+            if self.output is not None:
+                self.output.writeframes(played.tobytes())
+
+    def start(self) -> None:
+        self.last_sec = time.perf_counter()
+
+    def stop(self) -> None:
+        self._play()
+        self.queue.clear()
+        self.num_queued = 0
+        self.last_sec = None
+
+    def write(self, pcm: Sequence[int]) -> int:
+        self._play()
+        num_samples = min(len(pcm), self.capacity - self.num_queued)
+        if num_samples > 0:
+            self.queue.append(array('h', pcm[:num_samples]))
+            self.num_queued += num_samples
+        return num_samples
+
+    def flush(self, pcm: Optional[Sequence[int]] = None) -> int:
+        written = 0
+        if pcm is not None:
+            while written < len(pcm):
+                written += self.write(pcm[written:])
+                time.sleep(0.01)
+        self._play()
+        time.sleep(self.num_queued / self.sample_rate)
+        self._play()
+        return written
+
+    def delete(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+class FakePicoLLM(object):
+    """Answers every request with the same text at a fixed rate, so replays can run without a model or an AccessKey."""
+
+    ANSWER = "This answer comes from the fake picoLLM backend. It is long enough to take a few seconds to speak."
+
+    def __init__(self, tokens_per_sec: float, prefill_tokens_per_sec: float) -> None:
+        self.version = 'fake'
+        self.model = 'fake'
+        self.tokens_per_sec = tokens_per_sec
+        self.prefill_tokens_per_sec = prefill_tokens_per_sec
+        self.interrupted = False
+
+    def get_dialog(self, mode: Optional[str] = None, history: Optional[int] = 0, system: Optional[str] = None):
+        return picollm.Llama3ChatDialog(history=history, system=system)
+
+    def tokenize(self, text: str, bos: bool, eos: bool) -> List[int]:
+        tokens = [zlib.crc32(x.encode('utf-8')) for x in text.split(' ')]
+        return ([0] if bos else []) + tokens + ([1] if eos else [])
+
+    def generate(
+            self,
+            prompt: str,
+            completion_token_limit: Optional[int] = None,
+            stream_callback=None,
+            **_) -> picollm.PicoLLMCompletion:
+        self.interrupted = False
+        time.sleep(len(self.tokenize(prompt, bos=True, eos=False)) / self.prefill_tokens_per_sec)
+
+        tokens = [f' {x}' for x in self.ANSWER.split(' ')]
+        if completion_token_limit is not None:
+            tokens = tokens[:completion_token_limit]
+        endpoint = picollm.PicoLLMEndpoints.END_OF_SENTENCE
+        completion = ''
+        for token in tokens:
+            if self.interrupted:
+                endpoint = picollm.PicoLLMEndpoints.INTERRUPTED
+                break
+            time.sleep(1 / self.tokens_per_sec)
+            completion += token
+            if stream_callback is not None:
+                stream_callback(token)
+
+        return picollm.PicoLLMCompletion(
+            usage=picollm.PicoLLMUsage(prompt_tokens=0, completion_tokens=len(completion.split(' '))),
+            endpoint=endpoint,
+            completion_tokens=[],
+            completion=completion)
+
+    def interrupt(self) -> None:
+        self.interrupted = True
+
+    def context_save(self, path: str) -> None:
+        with open(path, 'wb'):
+            pass
+
+    def context_load(self, path: str) -> None:
+        pass
+
+    def release(self) -> None:
+        pass
+
+
+class FakeOrca(object):
+    """Synthesizes silence of a plausible duration for every complete word, at a fixed real-time factor."""
+
+    SAMPLE_RATE = 22050
+    SEC_PER_CHARACTER = 0.06
+
+    class Stream(object):
+        def __init__(self, rtf: float) -> None:
+            self.rtf = rtf
+            self.text = ''
+
+        def _synthesize(self, text: str) -> Optional[Sequence[int]]:
+            if len(text) == 0:
+                return None
+            duration_sec = len(text) * FakeOrca.SEC_PER_CHARACTER
+            time.sleep(duration_sec * self.rtf)
+            return [0] * int(duration_sec * FakeOrca.SAMPLE_RATE)
+
+        def synthesize(self, text: str) -> Optional[Sequence[int]]:
+            self.text += text
+            end = self.text.rfind(' ') + 1
+            text, self.text = self.text[:end], self.text[end:]
+            return self._synthesize(text)
+
+        def flush(self) -> Optional[Sequence[int]]:
+            text, self.text = self.text, ''
+            return self._synthesize(text)
+
+        def close(self) -> None:
+            pass
+
+    def __init__(self, rtf: float) -> None:
+        self.version = 'fake'
+        self.sample_rate = self.SAMPLE_RATE
+        self.rtf = rtf
+
+    def stream_open(self, speech_rate: float = 1.0) -> 'FakeOrca.Stream':
+        return FakeOrca.Stream(self.rtf)
+
+    def delete(self) -> None:
+        pass
+
+
+def create_fake_pllm(tokens_per_sec: float, prefill_tokens_per_sec: float, **_) -> FakePicoLLM:
+    return FakePicoLLM(tokens_per_sec, prefill_tokens_per_sec)
+
+
+def create_fake_orca(rtf: float, **_) -> FakeOrca:
+    return FakeOrca(rtf)
+
+
+def latencies(records: Sequence[Dict[str, Any]], files: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def since(events: Dict[str, float], event: str, origin: Optional[float]) -> Optional[float]:
+        if event not in events or origin is None:
+            return None
+        return round(events[event] - origin, 3)
+
+    rows = []
+    for record in records:
+        events = record['events']
+        owner = [x for x in files if x['start_sec'] <= events['wake']]
+        file = owner[-1] if len(owner) > 0 else None
+        start_sec = file['start_sec'] if file is not None else None
+        endpoint_sec = events.get('endpoint')
+        rows.append({
+            'file': file['file'] if file is not None else '',
+            'utterance': record['utterance'],
+            'interrupted': record['interrupted'],
+            'wake_sec': since(events, 'wake', start_sec),
+            'endpoint_sec': since(events, 'endpoint', start_sec),
+            'first_token_sec': since(events, 'first_token', endpoint_sec),
+            'first_audio_sec': since(events, 'first_write', endpoint_sec),
+            'total_sec': since(events, 'last_sample', endpoint_sec),
+        })
+    return rows
+
+
+def main() -> None:
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    backend_parser = ArgumentParser(add_help=False)
+    backend_parser.add_argument('--backend', choices=['picovoice', 'fake'], default='picovoice')
+    backend = backend_parser.parse_known_args()[0].backend
+
+    parser = create_parser()
+    if backend == 'fake':
+        parser.set_defaults(picollm_model_path='fake')
+    parser.add_argument(
+        '--wav_dir',
+        required=True,
+        help='Directory of single-channel, 16-bit, 16 kHz WAV files to replay in alphabetical order. Each file should '
+             'contain the wake word followed by a request.')
+    parser.add_argument(
+        '--csv_path',
+        default='replay.csv',
+        help='Path to the CSV file to write the latencies of every utterance to.')
+    parser.add_argument(
+        '--output_wav_path',
+        help='Path to a WAV file to save the synthesized answers to.')
+    parser.add_argument(
+        '--gap_sec',
+        type=float,
+        default=1.,
+        help='Duration of silence to replay after an answer ends before moving on to the next file.')
+    parser.add_argument(
+        '--timeout_sec',
+        type=float,
+        default=60.,
+        help='Maximum duration of silence to replay after a file before moving on to the next one.')
+    parser.add_argument(
+        '--backend',
+        choices=['picovoice', 'fake'],
+        default='picovoice',
+        help='Engines to answer with. `fake` replaces picoLLM and Orca with stand-ins of configurable speed, so no '
+             'model is needed. Porcupine and Cheetah are used in both cases.')
+    parser.add_argument(
+        '--fake_tokens_per_sec',
+        type=float,
+        default=20.,
+        help='Completion speed of the fake picoLLM.')
+    parser.add_argument(
+        '--fake_prefill_tokens_per_sec',
+        type=float,
+        default=200.,
+        help='Prompt processing speed of the fake picoLLM.')
+    parser.add_argument(
+        '--fake_orca_rtf',
+        type=float,
+        default=0.1,
+        help='Real-time factor of the fake Orca.')
+    args = parser.parse_args()
+
+    config = load_config(parser, args)
+    # `WavRecorder` follows the tracer of this process to pace the files, so it has to be read by a thread of it.
+    config['audio_capture'] = 'thread'
+
+    paths = sorted(
+        os.path.join(args.wav_dir, x) for x in os.listdir(args.wav_dir) if x.lower().endswith('.wav'))
+    if len(paths) == 0:
+        parser.error(f'`{args.wav_dir}` does not contain any WAV files')
+
+    stop = Event()
+
+    def handler(_, __) -> None:
+        stop.set()
+    signal.signal(signal.SIGINT, handler)
+
+    engines = dict()
+    if args.backend == 'fake':
+        engines['create_pllm'] = partial(
+            create_fake_pllm,
+            tokens_per_sec=args.fake_tokens_per_sec,
+            prefill_tokens_per_sec=args.fake_prefill_tokens_per_sec)
+        engines['create_orca'] = partial(create_fake_orca, rtf=args.fake_orca_rtf)
+
+    # every record is needed to match the latencies to the files, and a replay is finite
+    tracer = Tracer(config['trace_path'], config['trace_format'], max_records=None)
+    recorders = []
+
+    def create_recorder(frame_length: int) -> WavRecorder:
+        recorders.append(WavRecorder(paths, frame_length, tracer, stop, args.gap_sec, args.timeout_sec))
+        return recorders[0]
+
+    run(
+        config,
+        stop,
+        create_recorder,
+        lambda sample_rate: WavSpeaker(sample_rate, output_path=args.output_wav_path),
+        tracer,
+        **engines)
+
+    if len(recorders) > 0:
+        rows = latencies(tracer.records(), recorders[0].files)
+        with open(args.csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f'[Wrote the latencies of {len(rows)} utterances to {args.csv_path}]')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,514 @@
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+from collections import deque
+from itertools import count
+from multiprocessing import Process, active_children
+from multiprocessing.connection import Connection, wait
+from threading import Event
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pvcheetah
+import pvporcupine
+
+from autotune import tuned_device
+from main import Commands, Generator, PCMRingBuffer, Synthesizer, Tracer, create_parser, load_config
+
+# every message on the socket is a one-byte kind and a little-endian payload length, followed by the payload
+HEADER = struct.Struct('<cI')
+AUDIO = b'A'  # client -> server: 16-bit, 16 kHz, single-channel PCM
+PCM = b'P'  # server -> client: 16-bit, single-channel PCM at the sample rate in the `ready` event
+EVENT = b'E'  # server -> client: JSON event
+
+
+def encode(kind: bytes, payload: bytes) -> bytes:
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+class Request(object):
+    def __init__(self, request_id: int, session: 'Session', text: str, utterance_end_sec: float) -> None:
+        self.id = request_id
+        self.session = session
+        self.text = text
+        self.utterance_end_sec = utterance_end_sec
+        self.generator: Optional[GeneratorWorker] = None
+        self.synthesizer: Optional[SynthesizerWorker] = None
+        self.cancelled = False
+
+
+class GeneratorWorker(object):
+    def __init__(self, index: int, connection: Connection, process: Process) -> None:
+        self.index = index
+        self.connection = connection
+        self.process = process
+        self.request: Optional[Request] = None
+
+
+class SynthesizerWorker(object):
+    def __init__(self, index: int, connection: Connection, process: Process, pcm_buffer: PCMRingBuffer) -> None:
+        self.index = index
+        self.connection = connection
+        self.process = process
+        self.pcm_buffer = pcm_buffer
+        self.request: Optional[Request] = None
+        self.pending_starts = 0
+        self.flushed = False
+
+
+class Session(object):
+    """
+    A connected client. Each session has its own wake word and speech-to-text engines, dialog, and latency metrics, and
+    at most one request in flight.
+
+    The outbox is bounded: synthesized audio is only taken from the Orca worker while the outbox holds less than
+    `max_outbox_bytes`, so a slow client holds back its own synthesis instead of growing the memory of the server. A
+    client that reads nothing for `send_timeout_sec` while data is waiting is disconnected.
+    """
+
+    def __init__(
+            self,
+            session_id: int,
+            connection: socket.socket,
+            porcupine: pvporcupine.Porcupine,
+            cheetah: pvcheetah.Cheetah,
+            max_outbox_bytes: int,
+            send_timeout_sec: float) -> None:
+        self.id = session_id
+        self.connection = connection
+        self.porcupine = porcupine
+        self.cheetah = cheetah
+        self.max_outbox_bytes = max_outbox_bytes
+        self.send_timeout_sec = send_timeout_sec
+        self.last_send_sec = time.perf_counter()
+        self.tracer = Tracer()
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.pcm = bytearray()
+        self.sleeping = True
+        self.user_request = ''
+        self.turns: List[Tuple[str, str, int]] = []
+        self.request: Optional[Request] = None
+        self.closed = False
+
+    def fileno(self) -> int:
+        return self.connection.fileno()
+
+    def send_event(self, event: str, **kwargs) -> None:
+        kwargs['event'] = event
+        self.outbox += encode(EVENT, json.dumps(kwargs).encode('utf-8'))
+
+    def send_pcm(self, pcm: memoryview) -> None:
+        self.outbox += encode(PCM, pcm.tobytes())
+
+    def outbox_room(self) -> int:
+        """Number of samples that still fit in the outbox."""
+
+        return max(0, self.max_outbox_bytes - len(self.outbox) - HEADER.size) // 2
+
+    def receive(self) -> bool:
+        try:
+            data = self.connection.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if len(data) == 0:
+            return False
+        self.inbox += data
+        while len(self.inbox) >= HEADER.size:
+            kind, length = HEADER.unpack_from(self.inbox)
+            if len(self.inbox) < HEADER.size + length:
+                break
+            if kind == AUDIO:
+                self.pcm += self.inbox[HEADER.size:HEADER.size + length]
+            del self.inbox[:HEADER.size + length]
+        return True
+
+    def frames(self):
+        frame_bytes = self.porcupine.frame_length * 2
+        while len(self.pcm) >= frame_bytes:
+            frame = memoryview(bytes(self.pcm[:frame_bytes])).cast('h')
+            del self.pcm[:frame_bytes]
+            yield frame
+
+    def send(self) -> bool:
+        now_sec = time.perf_counter()
+        if len(self.outbox) == 0:
+            self.last_send_sec = now_sec
+            return True
+        try:
+            sent = self.connection.send(self.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return False
+        if sent > 0:
+            del self.outbox[:sent]
+            self.last_send_sec = now_sec
+        return now_sec - self.last_send_sec < self.send_timeout_sec
+
+    def close(self) -> None:
+        self.closed = True
+        self.connection.close()
+        self.porcupine.delete()
+        self.cheetah.delete()
+
+
+class Server(object):
+    """
+    Serves concurrent sessions over a Unix domain socket. Wake word detection and speech-to-text run in the server
+    process for every session, while the requests are scheduled onto a fixed pool of picoLLM and Orca workers, each of
+    which loads its model once.
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.request_ids = count(1)
+        self.session_ids = count(1)
+        self.sessions: List[Session] = []
+        self.queue = deque()
+        self.generators: List[GeneratorWorker] = []
+        self.synthesizers: List[SynthesizerWorker] = []
+        self.sample_rate = 0
+        self.listener: Optional[socket.socket] = None
+
+    def start(self) -> None:
+        for i in range(self.config['num_generators']):
+            connection, process = Generator.create_worker(self.config)
+            self.generators.append(GeneratorWorker(i, connection, process))
+        # all workers are started before attaching to any ring buffer, so that none of them inherits the resource
+        # tracker of the server process
+        orca_workers = [Synthesizer.create_worker(self.config) for _ in range(self.config['num_synthesizers'])]
+        for i, (connection, process) in enumerate(orca_workers):
+            self.sample_rate = int(connection.recv())
+            info = connection.recv()
+            self.synthesizers.append(SynthesizerWorker(i, connection, process, info['pcm_buffer']))
+        print(f"→ Orca v{info['version']} x {len(self.synthesizers)}")
+        for worker in self.generators:
+            info = worker.connection.recv()
+        print(f"→ picoLLM v{info['version']} <{info['model']}> x {len(self.generators)}")
+
+        socket_path = self.config['socket_path']
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        print(f'$ Serving on {socket_path} ...', flush=True)
+
+    def close(self) -> None:
+        for session in list(self.sessions):
+            self.close_session(session)
+        for worker in self.generators + self.synthesizers:
+            try:
+                worker.connection.send({'command': Commands.CLOSE})
+                worker.process.join(1.0)
+            except Exception as e:
+                sys.stderr.write(str(e))
+        for worker in self.synthesizers:
+            worker.pcm_buffer.close()
+        if self.listener is not None:
+            self.listener.close()
+            os.remove(self.config['socket_path'])
+
+    def accept(self) -> None:
+        try:
+            connection, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+
+        if len(self.sessions) >= self.config['max_sessions']:
+            connection.sendall(encode(EVENT, json.dumps({'event': 'rejected', 'reason': 'busy'}).encode('utf-8')))
+            connection.close()
+            return
+
+        try:
+            if 'keyword_model_path' not in self.config:
+                porcupine = pvporcupine.create(
+                    access_key=self.config['access_key'],
+                    keywords=['picovoice'],
+                    sensitivities=[self.config['porcupine_sensitivity']])
+            else:
+                porcupine = pvporcupine.create(
+                    access_key=self.config['access_key'],
+                    keyword_paths=[self.config['keyword_model_path']],
+                    sensitivities=[self.config['porcupine_sensitivity']])
+            cheetah = pvcheetah.create(
+                access_key=self.config['access_key'],
+                endpoint_duration_sec=self.config['cheetah_endpoint_duration_sec'],
+                enable_automatic_punctuation=True)
+        except (pvporcupine.PorcupineError, pvcheetah.CheetahError) as e:
+            connection.sendall(encode(EVENT, json.dumps({'event': 'rejected', 'reason': str(e)}).encode('utf-8')))
+            connection.close()
+            return
+
+        connection.setblocking(False)
+        session = Session(
+            next(self.session_ids),
+            connection,
+            porcupine,
+            cheetah,
+            max_outbox_bytes=int(self.config['max_outbox_sec'] * self.sample_rate) * 2,
+            send_timeout_sec=self.config['send_timeout_sec'])
+        self.sessions.append(session)
+        session.send_event('ready', session=session.id, sample_rate=self.sample_rate)
+        print(f'[Session {session.id}: connected ({len(self.sessions)} of {self.config["max_sessions"]})]', flush=True)
+
+    def close_session(self, session: Session) -> None:
+        self.interrupt(session)
+        session.close()
+        self.sessions.remove(session)
+        message = f'[Session {session.id}: disconnected'
+        summary = session.tracer.summary()
+        if 'response' in summary:
+            p50, p95 = summary['response']
+            message += f', response p50 {round(p50, 2)} sec, p95 {round(p95, 2)} sec'
+        print(message + ']', flush=True)
+
+    def process(self, session: Session, pcm: Sequence[int]) -> None:
+        if session.sleeping:
+            if session.porcupine.process(pcm) == 0:
+                session.tracer.begin()
+                session.sleeping = False
+                session.user_request = ''
+                self.interrupt(session)
+                session.send_event('wake')
+        else:
+            partial_transcript, endpoint_reached = session.cheetah.process(pcm)
+            session.user_request += partial_transcript
+            if endpoint_reached:
+                utterance_end_sec = time.perf_counter()
+                session.tracer.stamp('endpoint', utterance_end_sec)
+                session.sleeping = True
+                session.user_request += session.cheetah.flush()
+                session.send_event('transcript', text=session.user_request)
+                self.submit(session, session.user_request, utterance_end_sec)
+
+    def submit(self, session: Session, text: str, utterance_end_sec: float) -> None:
+        if len(self.queue) >= self.config['max_queued_requests']:
+            session.send_event('rejected', reason='busy')
+            session.tracer.finish(session.tracer.current, interrupted=True)
+            return
+        session.request = Request(next(self.request_ids), session, text, utterance_end_sec)
+        self.queue.append(session.request)
+        self.schedule()
+
+    def interrupt(self, session: Session) -> None:
+        request = session.request
+        if request is None:
+            return
+        session.request = None
+        request.cancelled = True
+        if request in self.queue:
+            self.queue.remove(request)
+        if request.generator is not None:
+            request.generator.connection.send({'command': Commands.INTERRUPT})
+        if request.synthesizer is not None:
+            request.synthesizer.connection.send({'command': Commands.INTERRUPT})
+            request.synthesizer.request = None
+            request.synthesizer = None
+        session.send_event('interrupted')
+
+    def schedule(self) -> None:
+        while len(self.queue) > 0:
+            generator = next((x for x in self.generators if x.request is None), None)
+            synthesizer = next((x for x in self.synthesizers if x.request is None), None)
+            if generator is None or synthesizer is None:
+                return
+            request = self.queue.popleft()
+            request.generator = generator
+            request.synthesizer = synthesizer
+            generator.request = request
+            synthesizer.request = request
+            synthesizer.pending_starts += 1
+            synthesizer.flushed = False
+            synthesizer.connection.send({'command': Commands.START, 'utterance_end_sec': request.utterance_end_sec})
+            generator.connection.send({
+                'command': Commands.PROCESS,
+                'id': request.id,
+                'text': request.text,
+                'turns': request.session.turns
+            })
+            request.session.tracer.stamp('prompt')
+
+    @staticmethod
+    def synthesize(request: Request, text: str) -> None:
+        if len(text) > 0 and request.synthesizer is not None:
+            request.session.send_event('answer', text=text)
+            request.synthesizer.connection.send({'command': Commands.PROCESS, 'text': text})
+
+    def tick_generator(self, worker: GeneratorWorker) -> None:
+        text = ''
+        while worker.connection.poll():
+            message = worker.connection.recv()
+            request = worker.request
+            if request is None or message.get('id') != request.id:
+                continue
+            if message['command'] == Commands.SYNTHESIZE:
+                text += message['text']
+            elif message['command'] in (Commands.FLUSH, Commands.INTERRUPT):
+                worker.request = None
+                request.generator = None
+                if message['command'] == Commands.FLUSH and not request.cancelled:
+                    request.session.turns = message['turns']
+                    if message['first_token_sec'] > 0:
+                        request.session.tracer.stamp('first_token', message['first_token_sec'])
+                    self.synthesize(request, text)
+                    if request.synthesizer is not None:
+                        request.synthesizer.connection.send({'command': Commands.FLUSH})
+                text = ''
+        if worker.request is not None:
+            self.synthesize(worker.request, text)
+
+    def tick_synthesizer(self, worker: SynthesizerWorker) -> None:
+        while worker.connection.poll():
+            message = worker.connection.recv()
+            if message['command'] == Commands.START:
+                worker.pending_starts -= 1
+                if worker.pending_starts == 0:
+                    worker.pcm_buffer.seek(message['index'])
+            elif message['command'] == Commands.FLUSH and worker.pending_starts == 0 and worker.request is not None:
+                worker.flushed = True
+                if message['first_pcm_sec'] > 0:
+                    worker.request.session.tracer.stamp('first_pcm', message['first_pcm_sec'])
+
+        request = worker.request
+        if request is None or worker.pending_starts > 0:
+            return
+        session = request.session
+        # once the outbox is full, the samples stay in the ring buffer and the worker waits for room to write more
+        while worker.pcm_buffer.available() > 0 and session.outbox_room() > 0:
+            pcm = worker.pcm_buffer.read(min(worker.pcm_buffer.available(), session.outbox_room()))
+            session.send_pcm(pcm)
+            worker.pcm_buffer.advance(len(pcm))
+            pcm.release()
+            session.tracer.stamp('first_write')
+        if worker.flushed and worker.pcm_buffer.available() == 0:
+            worker.request = None
+            request.synthesizer = None
+            session.request = None
+            session.tracer.stamp('last_sample')
+            record = session.tracer.current
+            session.tracer.finish(record)
+            if record is not None:
+                session.send_event('done', spans={k: round(v, 3) for k, v in record['spans'].items()})
+
+    def run(self, stop: Event) -> None:
+        sentinels = [x.process.sentinel for x in self.generators + self.synthesizers]
+        while not stop.is_set():
+            # synthesized audio arrives through the shared ring buffers without a message, so they are polled while
+            # any synthesizer is busy. otherwise, the timeout only bounds how long it takes to notice `stop`.
+            busy = any(len(x.outbox) > 0 for x in self.sessions) or \
+                any(x.request is not None for x in self.synthesizers)
+            connections = [self.listener] + self.sessions + [x.connection for x in self.generators + self.synthesizers]
+            ready = wait(connections + sentinels, timeout=0.01 if busy else 0.1)
+            if any(sentinel in ready for sentinel in sentinels):
+                break
+
+            if self.listener in ready:
+                self.accept()
+            for session in [x for x in self.sessions if x in ready]:
+                if not session.receive():
+                    self.close_session(session)
+                    continue
+                for pcm in session.frames():
+                    self.process(session, pcm)
+            for worker in self.generators:
+                self.tick_generator(worker)
+            for worker in self.synthesizers:
+                self.tick_synthesizer(worker)
+            self.schedule()
+            for session in list(self.sessions):
+                if not session.send():
+                    self.close_session(session)
+
+
+def main() -> None:
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    parser = create_parser()
+    parser.add_argument(
+        '--socket_path',
+        default='/tmp/llm-voice-assistant.sock',
+        help='Path of the Unix domain socket to serve on.')
+    parser.add_argument(
+        '--num_generators',
+        type=int,
+        default=1,
+        help='Number of picoLLM worker processes. Each one loads its own copy of the model.')
+    parser.add_argument(
+        '--num_synthesizers',
+        type=int,
+        default=1,
+        help='Number of Orca worker processes.')
+    parser.add_argument(
+        '--max_sessions',
+        type=int,
+        default=8,
+        help='Maximum number of connected sessions. Further connections are rejected.')
+    parser.add_argument(
+        '--max_queued_requests',
+        type=int,
+        default=8,
+        help='Maximum number of requests waiting for a free worker. Further requests are rejected.')
+    parser.add_argument(
+        '--max_outbox_sec',
+        type=float,
+        default=2.,
+        help='Seconds of synthesized audio buffered for a session that reads slower than it is synthesized. Beyond '
+             'that, synthesis for the session waits for the client to catch up.')
+    parser.add_argument(
+        '--send_timeout_sec',
+        type=float,
+        default=10.,
+        help='Sessions that read nothing for this long while data is waiting are disconnected.')
+    args = parser.parse_args()
+
+    config = load_config(parser, args)
+    for key in (
+            'socket_path',
+            'num_generators',
+            'num_synthesizers',
+            'max_sessions',
+            'max_queued_requests',
+            'max_outbox_sec',
+            'send_timeout_sec'):
+        config[key] = getattr(args, key)
+    tuned = None
+    if config['picollm_device'] in ('best', 'tuned'):
+        tuned = tuned_device(
+            config['picollm_model_path'],
+            access_key=config['access_key'] if config['picollm_device'] == 'tuned' else None)
+        config['picollm_device'] = 'best'
+    if tuned is not None:
+        # The tuned thread count is for a single picoLLM instance, so the generators split it.
+        if tuned.startswith('cpu:'):
+            tuned = f"cpu:{max(1, int(tuned[len('cpu:'):]) // config['num_generators'])}"
+        config['picollm_device'] = tuned
+
+    stop = Event()
+
+    def handler(_, __) -> None:
+        stop.set()
+    signal.signal(signal.SIGINT, handler)
+
+    server = Server(config)
+    try:
+        server.start()
+        server.run(stop)
+    except EOFError:
+        pass
+    finally:
+        server.close()
+        for child in active_children():
+            child.kill()
+
+
+if __name__ == '__main__':
+    main()
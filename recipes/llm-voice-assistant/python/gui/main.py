@@ -1,18 +1,22 @@
 import cpuinfo
 import json
 import math
+import operator
 import os
+import shutil
 import signal
 import subprocess
 import sys
 import time
 from argparse import ArgumentParser
-from itertools import chain
-from multiprocessing import Event, Pipe, Process, Queue, active_children
+from array import array
+from collections import deque
+from itertools import accumulate, chain
+from multiprocessing import Pipe, Process, Queue, active_children
 # noinspection PyProtectedMember
 from multiprocessing.connection import Connection
-from threading import Thread
-from typing import Optional, Sequence, Set
+from threading import Event, Thread
+from typing import List, Optional, Sequence, Set, Tuple
 
 import picollm
 import psutil
@@ -22,6 +26,8 @@ import pvporcupine
 from pvrecorder import PvRecorder
 from pvspeaker import PvSpeaker
 
+from metrics import Metrics, MetricsExporter
+
 
 class Commands:
     START = 'start'
@@ -40,36 +46,83 @@ class Commands:
 
 
 class CompletionText(object):
+    """
+    Streams the completion while holding back any text that is, or could become, a stop phrase. The stop phrases are
+    matched with an Aho-Corasick automaton whose state carries over between tokens, so each token costs time
+    proportional to its own length.
+    """
+
     def __init__(self, stop_phrases: Set[str]) -> None:
         self.stop_phrases = stop_phrases
-        self.start: int = 0
-        self.text: str = ''
+        self._transitions = [dict()]
+        self._failures = [0]
+        self._depths = [0]
+        self._match_lengths = [0]
+
+        for stop_phrase in stop_phrases:
+            state = 0
+            for character in stop_phrase:
+                if character not in self._transitions[state]:
+                    self._transitions[state][character] = len(self._transitions)
+                    self._transitions.append(dict())
+                    self._failures.append(0)
+                    self._depths.append(self._depths[state] + 1)
+                    self._match_lengths.append(0)
+                state = self._transitions[state][character]
+            self._match_lengths[state] = len(stop_phrase)
+
+        states = deque(self._transitions[0].values())
+        while len(states) > 0:
+            state = states.popleft()
+            for character, next_state in self._transitions[state].items():
+                states.append(next_state)
+                self._failures[next_state] = self._next_state(self._failures[state], character)
+                # a state that is not a stop phrase itself may still end with one, through its failure link
+                if self._match_lengths[next_state] == 0:
+                    self._match_lengths[next_state] = self._match_lengths[self._failures[next_state]]
+
+        self.state: int = 0
+        self.pending: str = ''
+        self.stopped: bool = False
         self.new_tokens: str = ''
 
+    def _next_state(self, state: int, character: str) -> int:
+        while state > 0 and character not in self._transitions[state]:
+            state = self._failures[state]
+        return self._transitions[state].get(character, 0)
+
     def reset(self):
-        self.start: int = 0
-        self.text: str = ''
+        self.state: int = 0
+        self.pending: str = ''
+        self.stopped: bool = False
         self.new_tokens: str = ''
 
     def append(self, text: str) -> None:
-        self.text += text
-        end = len(self.text)
-
-        for stop_phrase in self.stop_phrases:
-            if stop_phrase in self.text:
-                contains = self.text.index(stop_phrase)
-                if end > contains:
-                    end = contains
-            for i in range(len(stop_phrase) - 1, 0, -1):
-                if self.text.endswith(stop_phrase[:i]):
-                    ends = len(self.text) - i
-                    if end > ends:
-                        end = ends
-                    break
-
-        start = self.start
-        self.start = end
-        self.new_tokens = self.text[start:end]
+        if self.stopped:
+            self.new_tokens = ''
+            return
+
+        pending = self.pending + text
+        state = self.state
+        stop = -1
+        for i, character in enumerate(text):
+            state = self._next_state(state, character)
+            if self._match_lengths[state] > 0:
+                # a longer stop phrase that ends later in the same token may start before this one
+                start = len(self.pending) + i + 1 - self._match_lengths[state]
+                stop = start if stop < 0 else min(stop, start)
+
+        if stop >= 0:
+            self.stopped = True
+            self.new_tokens = pending[:stop]
+            self.pending = ''
+            return
+
+        # the state is the longest suffix that is still the start of a stop phrase, so it is all that is held back
+        end = len(pending) - self._depths[state]
+        self.state = state
+        self.pending = pending[end:]
+        self.new_tokens = pending[:end]
 
     def get_new_tokens(self) -> str:
         return self.new_tokens
@@ -80,10 +133,13 @@ class Speaker:
             self,
             queue: Queue,
             speaker: PvSpeaker,
-            orca_warmup_sec: int):
+            orca_warmup_sec: int,
+            metrics: Optional[Metrics] = None):
         self.queue = queue
         self.speaker = speaker
         self.orca_warmup = self.speaker.sample_rate * orca_warmup_sec
+        self.metrics = metrics
+        self.start_sec = 0.
         self.started = False
         self.speaking = False
         self.flushing = False
@@ -95,6 +151,7 @@ class Speaker:
 
     def start(self):
         self.started = True
+        self.start_sec = time.perf_counter()
 
     def process(self, pcm: Optional[Sequence[int]]):
         if self.started and pcm is not None:
@@ -123,6 +180,9 @@ class Speaker:
         if self.speaking and len(self.pcmBuffer) > 0:
             written = self.speaker.write(self.pcmBuffer)
             if written > 0:
+                if self.metrics is not None and self.start_sec > 0:
+                    self.metrics.observe('response_latency_seconds', time.perf_counter() - self.start_sec)
+                self.start_sec = 0.
                 self.queue.put({
                     'command': Commands.PCM_OUT,
                     'pcm': self.pcmBuffer[:written],
@@ -375,11 +435,13 @@ class Listener:
             queue: Queue,
             generator: Generator,
             porcupine: pvporcupine.Porcupine,
-            cheetah: pvcheetah.Cheetah):
+            cheetah: pvcheetah.Cheetah,
+            metrics: Optional[Metrics] = None):
         self.queue = queue
         self.generator = generator
         self.porcupine = porcupine
         self.cheetah = cheetah
+        self.metrics = metrics
 
         self.sleeping = True
         self.listening = False
@@ -392,6 +454,10 @@ class Listener:
     def process(self, pcm: Optional[Sequence[int]]):
         if self.sleeping:
             if self.porcupine.process(pcm) == 0:
+                if self.metrics is not None:
+                    self.metrics.inc('wakes_total')
+                    if self.generator.synthesizer.speaker.started:
+                        self.metrics.inc('interrupts_total')
                 self.sleeping = False
                 self.tick_count = 4
                 self.generator.interrupt()
@@ -542,10 +608,335 @@ class HorizontalBar:
                 self.window.write(i, 2, Window.color(self.color), display1)
 
 
+class ProcessStats(object):
+    """
+    CPU time and resident memory of a set of processes, read through one `psutil.Process` handle per process that is
+    kept for the whole session.
+    """
+
+    def __init__(self, pids: Sequence[int]) -> None:
+        self._processes = [psutil.Process(pid) for pid in pids]
+
+    def cpu_sec(self) -> float:
+        cpu_sec = 0.
+        for process in self._processes:
+            try:
+                times = process.cpu_times()
+                cpu_sec += times.user + times.system
+            except psutil.Error:
+                pass
+        return cpu_sec
+
+    def rss_bytes(self) -> int:
+        rss = 0
+        for process in self._processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def close(self) -> None:
+        pass
+
+
+class ProcStats(ProcessStats):
+    """
+    Reads the same numbers straight from `/proc` on Linux. The `stat` and `statm` files of each process are opened once
+    and re-read in place, which is a small fraction of the work `psutil` does per call.
+    """
+
+    def __init__(self, pids: Sequence[int]) -> None:
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._stat_fds = [os.open(f'/proc/{pid}/stat', os.O_RDONLY) for pid in pids]
+        self._statm_fds = [os.open(f'/proc/{pid}/statm', os.O_RDONLY) for pid in pids]
+
+    def cpu_sec(self) -> float:
+        ticks = 0
+        for fd in self._stat_fds:
+            try:
+                stat = os.pread(fd, 1024, 0)
+                # `utime` and `stime` are the 14th and 15th fields, counting from the pid before the command name
+                fields = stat[stat.rindex(b')') + 2:].split()
+                ticks += int(fields[11]) + int(fields[12])
+            except (OSError, ValueError, IndexError):
+                pass
+        return ticks / self._clock_ticks
+
+    def rss_bytes(self) -> int:
+        pages = 0
+        for fd in self._statm_fds:
+            try:
+                pages += int(os.pread(fd, 256, 0).split()[1])
+            except (OSError, ValueError, IndexError):
+                pass
+        return pages * self._page_size
+
+    def close(self) -> None:
+        for fd in self._stat_fds + self._statm_fds:
+            os.close(fd)
+
+
+class GPUUsage(object):
+    """
+    Utilization of the GPU in percent. This base backend is a no-op, used when there is no tool to read it from.
+    """
+
+    available = False
+
+    def usage(self) -> Optional[float]:
+        return None
+
+    def cpu_sec(self) -> float:
+        """CPU time used by the processes the backend started to read the utilization."""
+
+        return 0.
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def create(pids: Sequence[int], interval_sec: float) -> 'GPUUsage':
+        if sys.platform.lower().startswith('win') and shutil.which('powershell') is not None:
+            return WindowsGPUUsage(pids, interval_sec)
+        if shutil.which('nvidia-smi') is not None:
+            return NvidiaGPUUsage(interval_sec)
+        return GPUUsage()
+
+
+class StreamedGPUUsage(GPUUsage):
+    """
+    Keeps one command running that prints the utilization on a line of its own once per interval, and keeps the latest
+    value. Starting the command for every sample would take longer than the sample itself.
+    """
+
+    available = True
+
+    def __init__(self, command: List[str]) -> None:
+        self._usage = None
+        self._cpu_sec = 0.
+        self._process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        try:
+            self._stats = ProcessStats([self._process.pid])
+        except psutil.Error:
+            self._stats = ProcessStats([])
+        self._thread = Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self) -> None:
+        for line in self._process.stdout:
+            try:
+                self._usage = float(line.decode('ascii').strip().replace(',', '.'))
+            except ValueError:
+                pass
+
+    def usage(self) -> Optional[float]:
+        return self._usage
+
+    def cpu_sec(self) -> float:
+        # the last value is kept once the command has exited, so the monitor's CPU time never goes backwards
+        self._cpu_sec = max(self._cpu_sec, self._stats.cpu_sec())
+        return self._cpu_sec
+
+    def close(self) -> None:
+        self._process.terminate()
+        try:
+            self._process.wait(1.0)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+        self._stats.close()
+
+
+class WindowsGPUUsage(StreamedGPUUsage):
+    """Utilization of the GPU engines used by the given processes, from the Windows performance counters."""
+
+    def __init__(self, pids: Sequence[int], interval_sec: float) -> None:
+        gpu_usage_counters_format = r'"\GPU Engine(pid_{}_*)\Utilization Percentage"'
+        gpu_usage_counters = ', '.join([gpu_usage_counters_format.format(pid) for pid in pids])
+        gpu_usage_cmd = (
+            r'while ($true) {{ [Console]::WriteLine((((Get-Counter {} -SampleInterval {}).CounterSamples | '
+            r'where CookedValue).CookedValue | measure -sum).sum) }}')
+        super().__init__([
+            'powershell',
+            '-Command',
+            gpu_usage_cmd.format(gpu_usage_counters, max(1, round(interval_sec)))])
+
+
+class NvidiaGPUUsage(StreamedGPUUsage):
+    """Utilization of the first NVIDIA GPU, from `nvidia-smi`. It covers every process using the GPU."""
+
+    def __init__(self, interval_sec: float) -> None:
+        super().__init__([
+            'nvidia-smi',
+            '--id=0',
+            '--query-gpu=utilization.gpu',
+            '--format=csv,noheader,nounits',
+            f'--loop-ms={max(1, round(interval_sec * 1000))}'])
+
+
+class MetricsSampler(object):
+    """
+    Samples the CPU, RAM, and GPU usage of the demo's processes on a single thread of the main process and posts them
+    to the display. The GPU is read by a command that runs alongside at its own, slower interval. The CPU time of the
+    thread and of that command is measured as well, so that the cost of monitoring is shown next to what it monitors.
+    """
+
+    def __init__(
+            self,
+            queue: Queue,
+            pids: Sequence[int],
+            interval_sec: float,
+            gpu_interval_sec: float,
+            metrics: Optional[Metrics] = None) -> None:
+        self.queue = queue
+        self.interval_sec = interval_sec
+        self.metrics = metrics
+        if sys.platform.lower().startswith('linux'):
+            self.stats = ProcStats(pids)
+        else:
+            self.stats = ProcessStats(pids)
+        self.gpu = GPUUsage.create(pids, gpu_interval_sec)
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join(1.0)
+        self.stats.close()
+        self.gpu.close()
+
+    def _run(self) -> None:
+        try:
+            title = cpuinfo.get_cpu_info()['brand_raw']
+            num_cpus = psutil.cpu_count()
+            ram_total = psutil.virtual_memory().total / 1024 / 1024 / 1024
+
+            prev_sec = time.perf_counter()
+            prev_cpu_sec = self.stats.cpu_sec()
+            prev_thread_sec = time.thread_time() + self.gpu.cpu_sec()
+            while not self._stop.wait(self.interval_sec):
+                cpu_sec = self.stats.cpu_sec()
+                ram_usage = self.stats.rss_bytes() / 1024 / 1024 / 1024
+                gpu_usage = self.gpu.usage()
+                current_sec = time.perf_counter()
+                thread_sec = time.thread_time() + self.gpu.cpu_sec()
+
+                elapsed_sec = current_sec - prev_sec
+                cpu_usage = 100 * (cpu_sec - prev_cpu_sec) / elapsed_sec / num_cpus
+                overhead = 100 * (thread_sec - prev_thread_sec) / elapsed_sec
+                prev_sec, prev_cpu_sec, prev_thread_sec = current_sec, cpu_sec, thread_sec
+
+                if self.metrics is not None:
+                    self.metrics.set('cpu_usage_percent', cpu_usage)
+                    self.metrics.set('resident_memory_bytes', ram_usage * 1024 * 1024 * 1024)
+                    self.metrics.set('monitor_cpu_percent', overhead)
+                    if gpu_usage is not None:
+                        self.metrics.set('gpu_usage_percent', gpu_usage)
+
+                self.queue.put({
+                    'command': Commands.USAGE,
+                    'name': 'CPU',
+                    'title': title,
+                    'text': f"{math.ceil(cpu_usage)}% (monitor {round(overhead, 1)}%)",
+                    'bar': (cpu_usage / 100)
+                })
+                self.queue.put({
+                    'command': Commands.USAGE,
+                    'name': 'RAM',
+                    'text': f"{round(ram_usage, 2)}GB / {round(ram_total, 2)}GB",
+                    'bar': (ram_usage / ram_total)
+                })
+                if gpu_usage is not None:
+                    gpu_usage = max(0., min(100., gpu_usage))
+                    self.queue.put({
+                        'command': Commands.USAGE,
+                        'name': 'GPU',
+                        'text': f"{math.ceil(gpu_usage)}%",
+                        'bar': (gpu_usage / 100)
+                    })
+        except Exception as e:
+            sys.stderr.write(str(e))
+
+
+class SampleRing(object):
+    """
+    Fixed-capacity ring of int16 samples. Writing more than it can hold drops the oldest samples, so the cost of a write
+    only depends on the number of samples written. Along with each sample it keeps the running sum of the squares of
+    all the samples written up to it, so the sum of the squares of the samples consumed is one subtraction.
+    """
+
+    # the running sums are kept modulo 2 ** 63 to fit in int64, and the sum over the ring's samples is still exact
+    _MODULUS = 1 << 63
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._samples = array('h', bytes(2 * capacity))
+        self._sums = array('q', bytes(8 * capacity))
+        self._start = 0
+        self._length = 0
+        self._sum = 0
+        self._sum_before = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def clear(self) -> None:
+        self._start = 0
+        self._length = 0
+        self._sum = 0
+        self._sum_before = 0
+
+    def write(self, pcm: Sequence[int]) -> None:
+        pcm = pcm[-self.capacity:]
+        if len(pcm) == 0:
+            return
+
+        sums = accumulate(map(operator.mul, pcm, pcm), initial=self._sum)
+        next(sums)
+        sums = array('q', map(self._MODULUS.__rmod__, sums))
+
+        end = (self._start + self._length) % self.capacity
+        head_length = min(len(pcm), self.capacity - end)
+        self._samples[end:end + head_length] = array('h', pcm[:head_length])
+        self._samples[:len(pcm) - head_length] = array('h', pcm[head_length:])
+        self._sums[end:end + head_length] = sums[:head_length]
+        self._sums[:len(pcm) - head_length] = sums[head_length:]
+        self._sum = sums[-1]
+
+        num_dropped = max(0, self._length + len(pcm) - self.capacity)
+        if num_dropped > 0:
+            self._start = (self._start + num_dropped) % self.capacity
+            # the newest dropped sample may have been overwritten, so its running sum is taken from the oldest kept one
+            self._sum_before = (self._sums[self._start] - self._samples[self._start] ** 2) % self._MODULUS
+        self._length = min(self.capacity, self._length + len(pcm))
+
+    def consume(self, length: int) -> Tuple[int, int]:
+        """Drops up to `length` of the oldest samples and returns how many it dropped and the sum of their squares."""
+
+        length = min(length, self._length)
+        if length == 0:
+            return 0, 0
+
+        self._start = (self._start + length) % self.capacity
+        self._length -= length
+        sum_before = self._sum_before
+        self._sum_before = self._sums[(self._start - 1) % self.capacity]
+        return length, (self._sum_before - sum_before) % self._MODULUS
+
+
 class Display:
-    def __init__(self, queue: Queue, config):
+    def __init__(self, queue: Queue, config, metrics: Optional[Metrics] = None):
         self.queue = queue
         self.config = config
+        self.metrics = metrics
         self.screen = None
         self.prev_time = 0
         self.current_time = time.time()
@@ -555,11 +946,11 @@ class Display:
         self.text_state = 0
 
         self.sample_rate_in = 1
-        self.samples_in = []
+        self.level_in = 0.0
         self.volume_in = [0.0] * 4
         self.volume_index_in = 0
         self.sample_rate_out = 1
-        self.samples_out = []
+        self.samples_out = SampleRing(self.sample_rate_out * 2)
         self.volume_out = [0.0] * 12
         self.volume_index_out = 0
 
@@ -584,8 +975,7 @@ class Display:
         self.prompt = None
         self.widgets = {}
 
-        self.should_close = None
-        self.processes = None
+        self.sampler = None
 
     def set_display_size(self, height, width):
         self.display_width = width
@@ -612,7 +1002,7 @@ class Display:
             if self.display_width >= 80:
                 show_cpu = True
                 show_ram = True
-                if self.display_height >= 30 and sys.platform.lower().startswith('win'):
+                if self.display_height >= 30 and self.sampler is not None and self.sampler.gpu.available:
                     show_gpu = True
 
         if show_vu:
@@ -659,19 +1049,16 @@ class Display:
         Window.present()
 
     def start(self, pids: list):
-        self.should_close = Event()
-        self.processes = [
-            Process(target=Display.worker_cpu, args=(self.queue, self.should_close, pids)),
-            Process(target=Display.worker_ram, args=(self.queue, self.should_close, pids)),
-            Process(target=Display.worker_gpu, args=(self.queue, self.should_close, pids))
-        ]
-        for process in self.processes:
-            process.start()
+        self.sampler = MetricsSampler(
+            self.queue,
+            pids,
+            self.config['metrics_interval_sec'],
+            self.config['gpu_interval_sec'],
+            self.metrics)
+        self.sampler.start()
 
     def close(self):
-        self.should_close.set()
-        for process in self.processes:
-            process.join(1.0)
+        self.sampler.close()
         Window.reset()
 
     def render_prompt(self, text_state=None):
@@ -696,11 +1083,13 @@ class Display:
             if message['command'] == Commands.TEXT_STATE:
                 self.render_prompt(int(message['state']))
             elif message['command'] == Commands.PCM_IN:
-                self.samples_in = message['pcm']
+                self.level_in = Display.compute_amplitude(message['pcm'])
                 self.sample_rate_in = message['sample-rate']
             elif message['command'] == Commands.PCM_OUT:
-                self.samples_out.extend(message['pcm'])
-                self.sample_rate_out = message['sample-rate']
+                if message['sample-rate'] != self.sample_rate_out:
+                    self.sample_rate_out = message['sample-rate']
+                    self.samples_out = SampleRing(self.sample_rate_out * 2)
+                self.samples_out.write(message['pcm'])
             elif message['command'] == Commands.INTERRUPT:
                 self.samples_out.clear()
             elif message['command'] == Commands.USAGE:
@@ -721,30 +1110,12 @@ class Display:
             self.in_blink = not self.in_blink
             self.render_prompt()
 
-        if len(self.samples_out) > 0:
-            if len(self.samples_out) > self.sample_rate_out * 2:
-                del self.samples_out[:-(self.sample_rate_out * 2)]
-
-        def compute_amplitude(samples, sample_max=32768, scale=1.0):
-            rms = math.sqrt(sum([(x / sample_max) ** 2 for x in samples]) / len(samples))
-            dbfs = 20 * math.log10(max(rms, 1e-9))
-            dbfs = min(0., dbfs)
-            dbfs = max(0., dbfs + 40)
-            return min(1., (dbfs / 40) * scale)
-
-        if len(self.samples_in) > 0:
-            volume_in = compute_amplitude(self.samples_in)
-            self.volume_in[self.volume_index_in] = volume_in
-            self.volume_index_in = (self.volume_index_in + 1) % len(self.volume_in)
-        else:
-            self.volume_in[self.volume_index_in] = 0
-            self.volume_index_in = (self.volume_index_in + 1) % len(self.volume_in)
+        self.volume_in[self.volume_index_in] = self.level_in
+        self.volume_index_in = (self.volume_index_in + 1) % len(self.volume_in)
 
         if len(self.samples_out) > 0:
-            frame_size_out = min(len(self.samples_out), int(delta * self.sample_rate_out + 1))
-            frame_out = self.samples_out[:frame_size_out]
-            del self.samples_out[:frame_size_out]
-            volume_out = compute_amplitude(frame_out)
+            num_samples, sum_squares = self.samples_out.consume(int(delta * self.sample_rate_out + 1))
+            volume_out = Display.mean_square_amplitude(sum_squares / num_samples)
             self.volume_out[self.volume_index_out] = volume_out
             self.volume_index_out = (self.volume_index_out + 1) % len(self.volume_out)
         else:
@@ -763,87 +1134,19 @@ class Display:
         Window.present()
 
     @staticmethod
-    def run_command(command) -> Optional[float]:
-        val = subprocess.run(
-            ['powershell', '-Command', command],
-            capture_output=True,
-            check=False).stdout.decode("ascii")
-        try:
-            return float(val.strip().replace(',', '.'))
-        except FloatingPointError:
-            return None
-
-    @staticmethod
-    def worker_cpu(queue: Queue, should_close, pids: list):
-        def handler(_, __) -> None:
-            pass
-
-        signal.signal(signal.SIGINT, handler)
-
-        title = cpuinfo.get_cpu_info()['brand_raw']
-
-        try:
-            while not should_close.is_set():
-                cpu_usage = sum([psutil.Process(pid).cpu_percent(0.25) for pid in pids]) / psutil.cpu_count()
-                queue.put({
-                    'command': Commands.USAGE,
-                    'name': 'CPU',
-                    'title': title,
-                    'text': f"{math.ceil(cpu_usage)}%",
-                    'bar': (cpu_usage / 100)
-                })
-        except Exception as e:
-            sys.stderr.write(str(e))
+    def compute_amplitude(samples: Sequence[int], sample_max=32768, scale=1.0) -> float:
+        if len(samples) == 0:
+            return 0.
+        # the squares are summed in C by `map`, without building a list of floats
+        return Display.mean_square_amplitude(sum(map(operator.mul, samples, samples)) / len(samples), sample_max, scale)
 
     @staticmethod
-    def worker_gpu(queue: Queue, should_close, pids: list):
-        def handler(_, __) -> None:
-            pass
-
-        signal.signal(signal.SIGINT, handler)
-
-        if not sys.platform.lower().startswith('win'):
-            return
-
-        try:
-            gpu_usage_counters_format = r'"\GPU Engine(pid_{}_*)\Utilization Percentage"'
-            gpu_usage_counters = ', '.join([gpu_usage_counters_format.format(pid) for pid in pids])
-            gpu_usage_cmd = r'(((Get-Counter {}).CounterSamples | where CookedValue).CookedValue | measure -sum).sum'
-            gpu_usage_cmd = gpu_usage_cmd.format(gpu_usage_counters)
-            while not should_close.is_set():
-                gpu_usage = Display.run_command(gpu_usage_cmd)
-                if gpu_usage is not None:
-                    gpu_usage = max(0., min(100., gpu_usage))
-                    queue.put({
-                        'command': Commands.USAGE,
-                        'name': 'GPU',
-                        'text': f"{math.ceil(gpu_usage)}%",
-                        'bar': (float(gpu_usage) / 100)
-                    })
-        except Exception as e:
-            sys.stderr.write(str(e))
-
-    @staticmethod
-    def worker_ram(queue: Queue, should_close, pids: list):
-        def handler(_, __) -> None:
-            pass
-
-        signal.signal(signal.SIGINT, handler)
-
-        try:
-            ram_total = psutil.virtual_memory().total / 1024 / 1024 / 1024
-            while not should_close.is_set():
-                time.sleep(0.25)
-                ram_usage = sum([psutil.Process(pid).memory_info().rss for pid in pids]) / 1024 / 1024 / 1024
-                if ram_usage is not None:
-                    queue.put({
-                        'command': Commands.USAGE,
-                        'name': 'RAM',
-                        'text': f"{round(ram_usage, 2)}GB / {round(ram_total, 2)}GB",
-                        'bar': (float(ram_usage) / float(ram_total))
-                    })
-        except Exception as e:
-            sys.stderr.write(str(e))
+    def mean_square_amplitude(mean_square: float, sample_max=32768, scale=1.0) -> float:
+        rms = math.sqrt(mean_square) / sample_max
+        dbfs = 20 * math.log10(max(rms, 1e-9))
+        dbfs = min(0., dbfs)
+        dbfs = max(0., dbfs + 40)
+        return min(1., (dbfs / 40) * scale)
 
 
 REQUIRED_ARGS = [
@@ -865,10 +1168,27 @@ DEFAULT_ARGS = {
     'orca_speech_rate': 1.0,
     'porcupine_sensitivity': 0.5,
     'display_keyword': 'Jarvis',
+    'metrics_interval_sec': 0.5,
+    'gpu_interval_sec': 2.0,
+    'metrics_address': None,
+    'metrics_textfile_path': None,
+    'metrics_textfile_interval_sec': 15,
     'short_answers': False
 }
 
 
+def create_metrics() -> Metrics:
+    metrics = Metrics('llm_voice_assistant')
+    metrics.counter('wakes_total', 'Wake words detected.')
+    metrics.counter('interrupts_total', 'Answers cut short by the wake word.')
+    metrics.gauge('cpu_usage_percent', "CPU usage of the assistant's processes, as a share of all cores.")
+    metrics.gauge('resident_memory_bytes', "Resident memory of the assistant's processes.")
+    metrics.gauge('gpu_usage_percent', 'GPU utilization, where it can be read.')
+    metrics.gauge('monitor_cpu_percent', 'CPU usage of the resource sampler itself, as a share of one core.')
+    metrics.histogram('response_latency_seconds', 'Time from the end of a request to the first audio of the answer.')
+    return metrics
+
+
 def main() -> None:
     parser = ArgumentParser()
     parser.add_argument(
@@ -944,6 +1264,26 @@ def main() -> None:
     parser.add_argument(
         '--display_keyword',
         help="Display name for the keyword. If not set, `Jarvis` will be used.")
+    parser.add_argument(
+        '--metrics_interval_sec',
+        type=float,
+        help="Interval between two samples of the CPU and RAM usage.")
+    parser.add_argument(
+        '--gpu_interval_sec',
+        type=float,
+        help="Interval between two samples of the GPU usage, which are read by `nvidia-smi` or PowerShell.")
+    parser.add_argument(
+        '--metrics_address',
+        help="Serve metrics in the Prometheus text format at `http://${ADDRESS}/metrics`, e.g. `127.0.0.1:9464` (or "
+             "`:9464` for localhost).")
+    parser.add_argument(
+        '--metrics_textfile_path',
+        help="Write metrics in the Prometheus text format to this file, for the textfile collector of the node "
+             "exporter.")
+    parser.add_argument(
+        '--metrics_textfile_interval_sec',
+        type=float,
+        help="Interval between two writes of `--metrics_textfile_path`.")
     parser.add_argument('--short_answers', action='store_true')
     parser.add_argument(
         '--audio_device_index',
@@ -986,9 +1326,13 @@ def main() -> None:
         if key not in config:
             config[key] = value
 
+    metrics = None
+    if config['metrics_address'] is not None or config['metrics_textfile_path'] is not None:
+        metrics = create_metrics()
+
     stop = [False]
     queue = Queue()
-    display = Display(queue, config)
+    display = Display(queue, config, metrics)
 
     terminal_width, terminal_height = os.get_terminal_size()
     terminal_width = min(terminal_width, 120)
@@ -1015,6 +1359,21 @@ def main() -> None:
     display.start([os.getpid(), pllm_process.pid, orca_process.pid])
     display.tick()
 
+    exporter = None
+    if metrics is not None:
+        # the display's sampler already measures the processes, so the exporter does not sample them again
+        try:
+            exporter = MetricsExporter(
+                metrics,
+                dict(),
+                address=config['metrics_address'],
+                textfile_path=config['metrics_textfile_path'],
+                interval_sec=config['metrics_textfile_interval_sec'])
+            exporter.start()
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f'Not exporting metrics: {e}\n')
+            exporter = None
+
     if 'keyword_model_path' not in config:
         porcupine = pvporcupine.create(
             access_key=config['access_key'],
@@ -1041,10 +1400,10 @@ def main() -> None:
             child.kill()
         exit(1)
 
-    speaker = Speaker(queue, pv_speaker, config['orca_warmup_sec'])
+    speaker = Speaker(queue, pv_speaker, config['orca_warmup_sec'], metrics)
     synthesizer = Synthesizer(queue, speaker, orca_connection, orca_process)
     generator = Generator(queue, synthesizer, pllm_connection, pllm_process)
-    listener = Listener(queue, generator, porcupine, cheetah)
+    listener = Listener(queue, generator, porcupine, cheetah, metrics)
     recorder = Recorder(queue, listener, pv_recorder)
 
     queue.put({'command': Commands.TEXT_STATE, 'state': 1})
@@ -1061,6 +1420,8 @@ def main() -> None:
             speaker.tick()
             display.tick()
     finally:
+        if exporter is not None:
+            exporter.close()
         display.close()
         recorder.close()
         listener.close()
@@ -0,0 +1,199 @@
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Lock, Thread
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1., 1.5, 2.5, 5., 10.)
+
+
+class Metrics(object):
+    """
+    Counters, gauges, and histograms rendered in the Prometheus text format. An update only takes a lock and changes a
+    dictionary entry, so updates are cheap enough for the main loop whether or not anything is exported.
+    """
+
+    def __init__(self, namespace: str) -> None:
+        self._namespace = namespace
+        self._lock = Lock()
+        self._types: Dict[str, Tuple[str, str]] = dict()
+        self._buckets: Dict[str, Sequence[float]] = dict()
+        self._values: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = dict()
+
+    def _declare(self, name: str, metric_type: str, help_text: str) -> None:
+        self._types[name] = (metric_type, help_text)
+        self._values[name] = dict()
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._declare(name, 'counter', help_text)
+
+    def gauge(self, name: str, help_text: str) -> None:
+        self._declare(name, 'gauge', help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self._declare(name, 'histogram', help_text)
+        self._buckets[name] = tuple(sorted(buckets))
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        buckets = self._buckets[name]
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0., 0]
+            histogram = values[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        def labels_text(labels: Sequence[Tuple[str, str]]) -> str:
+            if len(labels) == 0:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+        lines = list()
+        with self._lock:
+            for name, (metric_type, help_text) in self._types.items():
+                full_name = f'{self._namespace}_{name}'
+                lines.append(f'# HELP {full_name} {help_text}')
+                lines.append(f'# TYPE {full_name} {metric_type}')
+                for key, value in self._values[name].items():
+                    if metric_type != 'histogram':
+                        lines.append(f'{full_name}{labels_text(key)} {float(value)!r}')
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(self._buckets[name], counts):
+                        lines.append(f"{full_name}_bucket{labels_text(key + (('le', repr(bound)),))} {bucket_count}")
+                    lines.append(f"{full_name}_bucket{labels_text(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f'{full_name}_sum{labels_text(key)} {total!r}')
+                    lines.append(f'{full_name}_count{labels_text(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def process_usage(pid: int) -> Optional[Tuple[float, int]]:
+    """Returns the CPU seconds and resident bytes of a process from `/proc`, or `None` where there is no `/proc`."""
+
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as fd:
+            stat = fd.read()
+        with open(f'/proc/{pid}/statm', 'rb') as fd:
+            statm = fd.read()
+        # `utime` and `stime` are the 14th and 15th fields, counting from the pid before the command name
+        fields = stat[stat.rindex(b')') + 2:].split()
+        cpu_sec = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return cpu_sec, int(statm.split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MetricsExporter(object):
+    """
+    Publishes `Metrics` on a single thread. It either serves them over HTTP at `/metrics` (e.g., `--metrics_address
+    127.0.0.1:9464`), or rewrites a file for the textfile collector of the Prometheus node exporter every interval. The
+    CPU time and resident memory of the given processes are sampled on the same thread, right before each publication,
+    so nothing is sampled while nobody scrapes.
+    """
+
+    def __init__(
+            self,
+            metrics: Metrics,
+            pids: Dict[str, int],
+            address: Optional[str] = None,
+            textfile_path: Optional[str] = None,
+            interval_sec: float = 15.) -> None:
+        if (address is None) == (textfile_path is None):
+            raise ValueError('Either an address or a textfile path is needed')
+
+        self.metrics = metrics
+        self.pids = pids
+        self.textfile_path = textfile_path
+        self.interval_sec = interval_sec
+        self._stop = Event()
+        self._server: Optional[HTTPServer] = None
+
+        if len(pids) > 0:
+            metrics.counter('process_cpu_seconds_total', 'CPU time used by each process of the assistant.')
+            metrics.gauge('process_resident_memory_bytes', 'Resident memory of each process of the assistant.')
+
+        if address is not None:
+            host, _, port = address.rpartition(':')
+            self._server = HTTPServer((host if len(host) > 0 else '127.0.0.1', int(port)), self._handler())
+            self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        else:
+            self._thread = Thread(target=self._write_textfile, daemon=True)
+
+    def _handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # noqa: N802
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_) -> None:
+                pass
+
+        return Handler
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self._thread.join(1.0)
+        if self.textfile_path is not None:
+            self._publish()
+
+    def render(self) -> str:
+        for name, pid in self.pids.items():
+            usage = process_usage(pid)
+            if usage is not None:
+                self.metrics.set('process_cpu_seconds_total', usage[0], process=name)
+                self.metrics.set('process_resident_memory_bytes', usage[1], process=name)
+        return self.metrics.render()
+
+    def _publish(self) -> None:
+        # the collector may read the file at any time, so it is replaced in one step
+        path = f'{self.textfile_path}.{os.getpid()}.tmp'
+        try:
+            with open(path, 'w', encoding='utf-8') as fd:
+                fd.write(self.render())
+            os.replace(path, self.textfile_path)
+        except OSError as e:
+            sys.stderr.write(f'Failed to write the metrics: {e}\n')
+
+    def _write_textfile(self) -> None:
+        self._publish()
+        while not self._stop.wait(self.interval_sec):
+            self._publish()
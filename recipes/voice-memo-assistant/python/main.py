@@ -27,6 +27,11 @@ from pvorca import Orca
 from pvrecorder import PvRecorder
 from pvspeaker import PvSpeaker
 
+# the picoLLM device auto-tuner lives in the LLM voice assistant recipe
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'llm-voice-assistant', 'python', 'cli'))
+from autotune import tuned_device  # noqa: E402
+
 SUMMARY_TEMPLATE = (
     'In one brief sentence, write what needs doing from this memo, '
     'including any day or date: "{memo}"'
@@ -184,7 +189,10 @@ def main() -> None:
              "most suitable device. If set to `gpu`, picoLLM uses the first available GPU. To select a specific GPU, "
              "set this argument to `gpu:${GPU_INDEX}`, where `${GPU_INDEX}` is the index of the target GPU. If set to "
              "`cpu`, picoLLM runs on the CPU with the default number of threads. To specify the number of threads, set "
-             "this argument to `cpu:${NUM_THREADS}`, where `${NUM_THREADS}` is the desired number of threads.")
+             "this argument to `cpu:${NUM_THREADS}`, where `${NUM_THREADS}` is the desired number of threads. If set "
+             "to `best` after `autotune.py` was run for the model, the fastest device it found is used. If set to "
+             "`tuned`, the model is tuned on the first launch instead (which can take minutes) and the fastest device "
+             "is used from then on.")
     parser.add_argument(
         '--audio_device_index',
         type=int,
@@ -212,6 +220,12 @@ def main() -> None:
 
     endpoint_duration_sec = args.endpoint_duration_sec
     picollm_device = args.picollm_device
+    if picollm_device in (None, 'best', 'tuned'):
+        tuned = tuned_device(picollm_model_path, access_key=access_key if picollm_device == 'tuned' else None)
+        if tuned is not None:
+            picollm_device = tuned
+        elif picollm_device == 'tuned':
+            picollm_device = 'best'
 
     porcupine = None
     rhino = None